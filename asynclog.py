@@ -0,0 +1,143 @@
+"""Asynchronous, batched logging for the server.
+
+log() only appends a raw record to a bounded deque: no formatting, no
+UTF-8 decoding and no I/O on the caller's thread. A background writer
+wakes every flush_interval, formats everything queued so far and writes
+it with a single buffered write, rotating the file when it grows past
+max_bytes. If the writer falls behind and the queue fills up, the oldest
+records are discarded (and counted) rather than stalling the caller.
+
+Chatty tags can be sampled: with sample={"CHAT": 0.1} only every tenth
+CHAT record is queued at all.
+"""
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+
+class AsyncLogger:
+    def __init__(self, path=None, level=INFO, fmt="text", sample=None, max_bytes=64 * 1024 * 1024,
+                 backups=3, flush_interval=0.2, max_queue=100000):
+        self.path = path
+        self.level = level
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.records = collections.deque(maxlen=max_queue)
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.sample_every = {}  # tag -> keep one record in this many (0 = keep none)
+        self.sample_seen = collections.defaultdict(int)
+        for tag, rate in (sample or {}).items():
+            self.sample_every[tag] = round(1 / rate) if rate > 0 else 0
+
+        self.output = open(path, "ab") if path else sys.stdout.buffer
+        self.size = self.output.tell() if path else 0
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.writer = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def log(self, level, tag, message):
+        """Queue a record.
+
+        message may be a str, raw UTF-8 bytes, or a tuple of both that the
+        writer joins, so callers never format or decode on their thread.
+        """
+        if level < self.level:
+            return
+        every = self.sample_every.get(tag)
+        if every is not None:
+            self.sample_seen[tag] += 1
+            if every == 0 or self.sample_seen[tag] % every:
+                return
+        if len(self.records) >= self.max_queue:
+            self.dropped += 1
+        self.records.append((time.time(), level, tag, message))
+
+    def debug(self, tag, message):
+        self.log(DEBUG, tag, message)
+
+    def info(self, tag, message):
+        self.log(INFO, tag, message)
+
+    def warning(self, tag, message):
+        self.log(WARNING, tag, message)
+
+    def error(self, tag, message):
+        self.log(ERROR, tag, message)
+
+    def format(self, record):
+        timestamp, level, tag, message = record
+        if isinstance(message, tuple):
+            message = "".join(part if isinstance(part, str) else str(part, 'utf-8', 'replace') for part in message)
+        elif isinstance(message, (bytes, bytearray, memoryview)):
+            message = str(message, 'utf-8', 'replace')
+        if self.fmt == "json":
+            return json.dumps({"time": timestamp, "level": LEVEL_NAMES[level], "tag": tag, "message": message})
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+        return f"{stamp}.{int(timestamp % 1 * 1000):03d} {LEVEL_NAMES[level]:<7} [{tag}] {message}"
+
+    def flush(self):
+        """Format and write everything queued so far (called from the writer thread or at exit)"""
+        batch = []
+        while self.records:
+            try:
+                batch.append(self.records.popleft())
+            except IndexError:
+                break
+        if self.dropped:
+            batch.append((time.time(), WARNING, "LOG", f"dropped {self.dropped} records, writer fell behind"))
+            self.dropped = 0
+        if not batch:
+            return
+
+        data = ("\n".join(self.format(record) for record in batch) + "\n").encode('utf-8')
+        self.output.write(data)
+        self.output.flush()
+        self.size += len(data)
+        if self.path and self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.output.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.output = open(self.path, "ab")
+        self.size = 0
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                pass  # nowhere left to report a logging failure
+
+    def close(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        self.writer.join(timeout=2)
+        self.flush()
+        if self.path:
+            self.output.close()
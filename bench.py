@@ -0,0 +1,315 @@
+"""Headless load generator and fanout-latency benchmark for server.py.
+
+Starts the server locally (unless --no-spawn), connects --clients bots
+that go through the normal USERNAME handshake, lets --senders of them
+chat at --rate messages/sec each for --duration seconds, and prints a
+JSON report: join throughput, messages/sec, fanout latency percentiles
+and the server's RSS and thread count.
+
+Every bench message carries its send time, so any bot that receives it
+can work out the fanout latency; all bots share this process's clock.
+
+    python bench.py --clients 2000 --senders 50 --rate 5 --engine eventloop --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_LOGGED, RECV_SIZE, FrameDecoder,
+                      chat_frame, control_frame, split_command, split_logged)
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+# Without history or flood control, so the latency measured is fanout rather than disk or throttling
+DEFAULT_SERVER_ARGS = ["--no-history", "--rate-messages", "0", "--rate-bytes", "0",
+                       "--room-rate-messages", "0", "--room-rate-bytes", "0"]
+MARKER = b" BENCH "
+
+
+class Stats:
+    def __init__(self):
+        self.join_times = []
+        self.join_failures = 0
+        self.sent = 0
+        self.delivered = 0
+        self.latencies = []
+        self.recording = False
+        self.peak_rss_kb = 0
+        self.peak_threads = 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_message(index, size):
+    prefix = f"[bot{index}]: BENCH {time.monotonic_ns()} "
+    return chat_frame(prefix + "x" * max(0, size - len(prefix)))
+
+
+def record_delivery(stats, text):
+    """Note one delivered chat message, and its latency if it is a bench message"""
+    if not stats.recording:
+        return
+    stats.delivered += 1
+    marker = text.find(MARKER)
+    if marker < 0:
+        return
+    start = marker + len(MARKER)
+    end = text.find(b" ", start)
+    stats.latencies.append(time.monotonic_ns() - int(text[start:end]))
+
+
+async def receive_loop(reader, writer, decoder, stats):
+    while True:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return
+        for frame_type, stream, payload in decoder.feed(data):
+            if frame_type == FRAME_LOGGED:
+                record_delivery(stats, bytes(split_logged(payload)[1]))
+            elif frame_type == FRAME_CHAT:
+                record_delivery(stats, bytes(payload))
+            elif frame_type == FRAME_CONTROL and split_command(payload)[0] == "PING":
+                # Bots that only listen would otherwise be reaped as idle
+                writer.write(control_frame("PONG"))
+
+
+async def send_loop(index, writer, args, stats, stop):
+    interval = 1.0 / args.rate
+    next_send = time.monotonic()
+    while not stop.is_set():
+        writer.write(bench_message(index, args.size))
+        stats.sent += 1
+        await writer.drain()
+        next_send += interval
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+
+
+async def run_bot(index, args, stats, joined, stop, connect_slots):
+    """Connect, finish the USERNAME handshake, then listen (and chat if a sender) until stopped"""
+    async with connect_slots:
+        started = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+            decoder = FrameDecoder()
+            in_room = False
+            while not in_room:
+                data = await asyncio.wait_for(reader.read(RECV_SIZE), args.join_timeout)
+                if not data:
+                    raise ConnectionError("server closed the connection during the handshake")
+                for frame_type, stream, payload in decoder.feed(data):
+                    if frame_type != FRAME_CONTROL:
+                        continue
+                    command, argument = split_command(payload)
+                    if command == "USERNAME":
+                        writer.write(control_frame(f"USERNAME bot{index}"))
+                    elif command == "ROOM":
+                        in_room = True
+        except (OSError, asyncio.TimeoutError):
+            stats.join_failures += 1
+            return
+        stats.join_times.append(time.monotonic() - started)
+
+    receiver = asyncio.ensure_future(receive_loop(reader, writer, decoder, stats))
+    await joined.wait()
+    if index < args.senders:
+        await send_loop(index, writer, args, stats, stop)
+    else:
+        await stop.wait()
+    await asyncio.sleep(args.drain)
+    receiver.cancel()
+    # Without QUIT the session stays parked and the next run can't reuse the name
+    writer.write(control_frame("QUIT"))
+    try:
+        await writer.drain()
+    except OSError:
+        pass
+    writer.close()
+
+
+def server_processes(pid):
+    """The server's pid plus any worker processes it forked"""
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def sample_server(pid):
+    """Total RSS (kB) and thread count across the server's processes"""
+    rss_kb = threads = 0
+    for process in server_processes(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            continue
+    return rss_kb, threads
+
+
+async def monitor_server(pid, stats, stop):
+    while not stop.is_set():
+        rss_kb, threads = sample_server(pid)
+        stats.peak_rss_kb = max(stats.peak_rss_kb, rss_kb)
+        stats.peak_threads = max(stats.peak_threads, threads)
+        await asyncio.sleep(0.5)
+
+
+def start_server(args):
+    command = [sys.executable, SERVER_SCRIPT, "--host", args.host, "--port", str(args.port),
+               "--engine", args.engine, "--workers", str(args.workers), *args.server_arg]
+    # The server prints every message; send it nowhere so a full pipe can't stall it
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start listening within 10 seconds")
+
+
+async def run_benchmark(args, server_pid):
+    stats = Stats()
+    joined = asyncio.Event()
+    stop = asyncio.Event()
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+    monitor = asyncio.ensure_future(monitor_server(server_pid, stats, stop)) if server_pid else None
+
+    bots = [asyncio.ensure_future(run_bot(index, args, stats, joined, stop, connect_slots))
+            for index in range(args.clients)]
+    join_started = time.monotonic()
+    while len(stats.join_times) + stats.join_failures < args.clients:
+        await asyncio.sleep(0.05)
+    join_seconds = time.monotonic() - join_started
+
+    # Let the presence updates from the join storm settle before measuring chat
+    await asyncio.sleep(args.warmup)
+    sent_before = stats.sent
+    stats.recording = True
+    joined.set()
+    chat_started = time.monotonic()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    chat_seconds = time.monotonic() - chat_started
+    sent = stats.sent - sent_before
+    # Deliveries and latencies are both counted until the bots stop draining,
+    # so the messages still in flight when the senders stop are in both
+    await asyncio.gather(*bots, return_exceptions=True)
+    stats.recording = False
+    delivered = stats.delivered
+
+    if monitor is not None:
+        await monitor
+    rss_kb, threads = sample_server(server_pid) if server_pid else (None, None)
+
+    join_times = sorted(stats.join_times)
+    latencies_ms = [latency / 1e6 for latency in sorted(stats.latencies)]
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "join": {
+            "clients": len(join_times),
+            "failed": stats.join_failures,
+            "seconds": round(join_seconds, 3),
+            "joins_per_sec": round(len(join_times) / join_seconds, 1) if join_seconds else None,
+            "p50_ms": round(percentile(join_times, 0.5) * 1000, 2) if join_times else None,
+            "p99_ms": round(percentile(join_times, 0.99) * 1000, 2) if join_times else None,
+        },
+        "chat": {
+            "sent": sent,
+            "delivered": delivered,
+            "sent_per_sec": round(sent / chat_seconds, 1),
+            "delivered_per_sec": round(delivered / chat_seconds, 1),
+            "fanout_latency_ms": {
+                "samples": len(latencies_ms),
+                "p50": percentile(latencies_ms, 0.5),
+                "p99": percentile(latencies_ms, 0.99),
+                "p999": percentile(latencies_ms, 0.999),
+                "max": latencies_ms[-1] if latencies_ms else None,
+            },
+        },
+        "server": {
+            "pid": server_pid,
+            "rss_kb": rss_kb,
+            "peak_rss_kb": stats.peak_rss_kb or None,
+            "threads": threads,
+            "peak_threads": stats.peak_threads or None,
+        },
+    }
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the chat server and report JSON results")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23456)
+    parser.add_argument("--no-spawn", action="store_true",
+                        help="benchmark a server that is already running instead of starting one")
+    parser.add_argument("--engine", choices=["threaded", "eventloop"], default="threaded")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--server-arg", action="append", default=None,
+                        help="extra argument passed to server.py (repeatable; by default history and rate "
+                             "limits are off, which any --server-arg replaces)")
+    parser.add_argument("--clients", type=int, default=500, help="bots to connect (default: %(default)s)")
+    parser.add_argument("--senders", type=int, default=20, help="bots that send chat (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages/sec per sender (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=100, help="chat message size in bytes (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of chat to measure (default: %(default)s)")
+    parser.add_argument("--warmup", type=float, default=1.0, help="pause between joining and chatting (default: %(default)s)")
+    parser.add_argument("--drain", type=float, default=1.0,
+                        help="seconds bots keep reading after the senders stop (default: %(default)s)")
+    parser.add_argument("--connect-concurrency", type=int, default=256,
+                        help="handshakes the bots run at once (default: %(default)s)")
+    parser.add_argument("--join-timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    if args.server_arg is None:
+        args.server_arg = DEFAULT_SERVER_ARGS
+
+    raise_file_limit()
+    process = None if args.no_spawn else start_server(args)
+    try:
+        report = asyncio.run(run_benchmark(args, process.pid if process else None))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
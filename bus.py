@@ -0,0 +1,149 @@
+"""Local fanout bus for running the server as several worker processes.
+
+Each worker accepts its own share of the connections (the listening port
+is shared with SO_REUSEPORT) and connects to a hub over a Unix domain
+socket. Anything a worker publishes is relayed by the hub to every other
+worker, which is how chat and presence reach users connected elsewhere.
+
+Bus messages are FRAME_RELAY frames carrying a JSON object with a "kind"
+and the "node" that published it: here a worker id. The same messages
+also travel between separate servers (see federation.py), where the node
+is the server's name.
+"""
+
+import json
+import os
+import selectors
+import socket
+import threading
+
+from protocol import FRAME_RELAY, RECV_SIZE, FrameDecoder, ProtocolError, encode_frame
+
+
+def relay_frame(message):
+    return encode_frame(FRAME_RELAY, json.dumps(message, separators=(",", ":")))
+
+
+def decode_message(payload):
+    """A FRAME_RELAY payload as a message dict, or None if it isn't one"""
+    try:
+        message = json.loads(str(payload, 'utf-8'))
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class BusLink:
+    """A worker's connection to the hub"""
+
+    def __init__(self, path, worker_id):
+        self.node = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.decoder = FrameDecoder()
+        self.lock = threading.Lock()
+        self.publish({"kind": "hello"})
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def publish(self, message):
+        message["node"] = self.node
+        frame = relay_frame(message)
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def receive(self):
+        """Read once from the hub and return the messages that arrived"""
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("bus hub closed the connection")
+        messages = [decode_message(payload) for frame_type, stream, payload in self.decoder.feed(data)
+                    if frame_type == FRAME_RELAY]
+        return [message for message in messages if message is not None]
+
+
+def open_hub(path):
+    """Bind the hub's Unix socket; workers may connect as soon as this returns"""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    return listener
+
+
+def run_hub(listener, stop_event=None, report=print):
+    """Relay every frame a worker publishes to all the other workers.
+
+    When a worker's link goes away the others are told with a "down"
+    message so they can forget that worker's users. Connect and
+    disconnect notices go to report().
+    """
+    path = listener.getsockname()
+    listener.setblocking(False)
+
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    links = {}  # socket -> {"decoder", "outgoing", "worker"}
+
+    def queue_to_others(origin, frame):
+        for sock, link in links.items():
+            if sock is origin:
+                continue
+            if not link["outgoing"]:
+                sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            link["outgoing"] += frame
+
+    def drop(sock):
+        link = links.pop(sock)
+        sel.unregister(sock)
+        sock.close()
+        if link["worker"] is not None:
+            report(f"worker {link['worker']} disconnected.")
+            queue_to_others(None, relay_frame({"kind": "down", "nodes": [link["worker"]]}))
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            for key, events in sel.select(timeout=1.0):
+                sock = key.fileobj
+                if sock is listener:
+                    conn, _ = listener.accept()
+                    conn.setblocking(False)
+                    links[conn] = {"decoder": FrameDecoder(), "outgoing": bytearray(), "worker": None}
+                    sel.register(conn, selectors.EVENT_READ)
+                    continue
+
+                link = links[sock]
+                if events & selectors.EVENT_READ:
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                        frames = link["decoder"].feed(data) if data else None
+                    except (OSError, ProtocolError):
+                        frames = None
+                    if frames is None:
+                        drop(sock)
+                        continue
+                    for frame_type, stream, payload in frames:
+                        if link["worker"] is None:
+                            link["worker"] = json.loads(str(payload, 'utf-8')).get("node")
+                            report(f"worker {link['worker']} connected.")
+                        queue_to_others(sock, encode_frame(frame_type, payload))
+
+                if events & selectors.EVENT_WRITE and link["outgoing"]:
+                    try:
+                        sent = sock.send(link["outgoing"])
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        drop(sock)
+                        continue
+                    del link["outgoing"][:sent]
+                    if not link["outgoing"]:
+                        sel.modify(sock, selectors.EVENT_READ)
+    finally:
+        for sock in list(links):
+            sock.close()
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -1,48 +1,199 @@
+import json
+import random
 import socket
 import threading
+import time
 import sys
 import os
 
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_FILE, FRAME_LOGGED, FRAME_PRESENCE, RECV_SIZE, FrameDecoder,
+                      chat_frame, control_frame, split_command, split_logged)
+from filetransfer import Downloads, Uploads, split_cancel
+
 
 HOST = "192.168.88.22" 
 PORT = 12345
 
+# After a dropped connection, retry with exponential backoff: attempt n
+# waits a random time up to min(RECONNECT_MAX, RECONNECT_BASE * 2**n).
+# Only a SESSION from the server resets n: a server too busy to take us
+# accepts the connection and closes it, and that mustn't count as success
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+
+# Heartbeat: if the server has been quiet for HEARTBEAT_INTERVAL we PING it,
+# and after SERVER_TIMEOUT without hearing anything we treat it as a drop
+HEARTBEAT_INTERVAL = 15.0
+SERVER_TIMEOUT = 45.0
+
 username = input("Enter your username: ")
 
 client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client.connect((HOST, PORT))
+client.settimeout(HEARTBEAT_INTERVAL)
 
 
 input_active = False
+quitting = False
+session_token = None  # from the server's SESSION message; sent back in RESUME after a drop
+last_seq = 0          # newest history sequence number seen, so a resume only replays what we missed
+current_room = None
+reconnect_attempt = 0  # failed reconnects since the last SESSION
+send_lock = threading.Lock()  # file chunks go out from their own thread; frames must not interleave
+
+
+# Print a message without clobbering the input prompt
+def show(message):
+    # Clear current line and print message
+    if input_active:
+        # Move cursor to beginning of line and clear it
+        print('\r' + ' ' * 50 + '\r', end='', flush=True)
+
+    print(message, flush=True)
+
+    # Restore input prompt if input was active
+    if input_active:
+        print(f"[{username}]: ", end='', flush=True)
+
+
+# Describe a presence update: a full roster or the joins/leaves since the last one
+def describe_presence(update):
+    room, count = update["room"], update["count"]
+    if "roster" in update:
+        return f"--- Online in #{room} ({count}): {', '.join(update['roster'])} ---"
+    changes = []
+    if update["joined"]:
+        changes.append(f"{', '.join(update['joined'])} joined")
+    if update["left"]:
+        changes.append(f"{', '.join(update['left'])} left")
+    return f"--- {'; '.join(changes)} ({count} online in #{room}) ---"
+
+
+# Write one whole frame to the current connection
+def send(frame):
+    with send_lock:
+        client.sendall(frame)
+
+
+uploads = Uploads(send, lambda text: show(f"--- {text} ---"))
+downloads = Downloads()
+
+
+# Reconnect until it works, backing off with full jitter so clients dropped together don't return together
+def reconnect():
+    global client, reconnect_attempt
+    while not quitting:
+        delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** reconnect_attempt))
+        show(f"--- Connection lost, reconnecting in {delay:.1f}s ---")
+        time.sleep(delay)
+        reconnect_attempt += 1
+        try:
+            client = socket.create_connection((HOST, PORT), timeout=10)
+            client.settimeout(HEARTBEAT_INTERVAL)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+# Answer the server's USERNAME request, resuming our session if we have one
+def send_hello():
+    global session_token
+    if session_token:
+        send(control_frame(f"RESUME {session_token} {last_seq}"))
+        session_token = None  # if the server asks again, the session is gone: join afresh
+    else:
+        send(control_frame(f"USERNAME {username}"))
 
 
 # Receive messages from server
 def receive():
+    global session_token, last_seq, current_room, quitting, reconnect_attempt
+    decoder = FrameDecoder()
+    resuming = False
+    last_heard = time.monotonic()
     while True:
         try:
-            message = client.recv(1024).decode('utf-8')
-            if message == "USERNAME":
-                client.send(username.encode('utf-8'))
-            else:
-                # Clear current line and print message
-                if input_active:
-                    # Move cursor to beginning of line and clear it
-                    print('\r' + ' ' * 50 + '\r', end='', flush=True)
-                
-                print(message, flush=True)
-                
-                # Restore input prompt if input was active
-                if input_active:
-                    print(f"[{username}]: ", end='', flush=True)
+            try:
+                data = client.recv(RECV_SIZE)
+            except socket.timeout:
+                if time.monotonic() - last_heard >= SERVER_TIMEOUT:
+                    raise ConnectionError("server stopped responding")
+                send(control_frame("PING"))
+                continue
+            if not data:
+                raise ConnectionError("server closed the connection")
+            last_heard = time.monotonic()
+            for frame_type, stream, payload in decoder.feed(data):
+                if frame_type == FRAME_CONTROL:
+                    command, argument = split_command(payload)
+                    if command == "PING":
+                        send(control_frame("PONG"))
+                    elif command == "USERNAME":
+                        send_hello()
+                    elif command == "SESSION":
+                        reconnect_attempt = 0
+                        if resuming:
+                            show("--- Reconnected ---")
+                            resuming = False
+                            uploads.resume()
+                        session_token = argument
+                    elif command == "ROOM":
+                        if argument != current_room:
+                            show(f"--- You are now in #{argument} ---")
+                        current_room = argument
+                    elif command == "USERNAME_TAKEN":
+                        # The server hangs up next; there is no point reconnecting as the same name
+                        show(f"--- The username {argument} is already taken, restart and pick another ---")
+                        quitting = True
+                    elif command == "MSG":
+                        sender, _, text = argument.partition(" ")
+                        show(f"[{sender} -> you]: {text}")
+                    elif command == "ERROR":
+                        show(f"--- {argument} ---")
+                    elif command == "HISTORY":
+                        show(f"--- {argument} older messages ---")
+                    elif command == "FILE":
+                        notice = downloads.offered(argument)
+                        if notice:
+                            show(f"--- {notice} ---")
+                    elif command == "FILE_ACCEPT":
+                        uploads.accepted(argument)
+                    elif command == "FILE_DONE":
+                        uploads.finished(argument)
+                    elif command == "FILE_CANCEL":
+                        uploads.cancelled(*split_cancel(argument))
+                    elif command == "FILE_ABORT":
+                        notice = downloads.aborted(*split_cancel(argument))
+                        if notice:
+                            show(f"--- {notice} ---")
+                elif frame_type == FRAME_FILE:
+                    notice = downloads.chunk(stream, payload)
+                    if notice:
+                        show(f"--- {notice} ---")
+                elif frame_type == FRAME_LOGGED:
+                    seq, text = split_logged(payload)
+                    last_seq = max(last_seq, seq)
+                    show(str(text, 'utf-8'))
+                elif frame_type == FRAME_PRESENCE:
+                    show(describe_presence(json.loads(str(payload, 'utf-8'))))
+                elif frame_type == FRAME_CHAT:
+                    show(str(payload, 'utf-8'))
         except:
-            print("\nDisconnected from server.")
             client.close()
-            break
+            uploads.disconnected()
+            downloads.close()
+            if quitting or not reconnect():
+                print("\nDisconnected from server.")
+                break
+            decoder = FrameDecoder()
+            resuming = True
+            last_heard = time.monotonic()
 
 
 # Send messages to server
 def write():
-    global input_active
+    global input_active, quitting
     while True:
         try:
             input_active = True
@@ -51,15 +202,37 @@ def write():
             input_active = False
             
             if message.lower() == '/quit':
+                # Tell the server we're leaving for good so it doesn't hold our session
+                quitting = True
+                try:
+                    send(control_frame("QUIT"))
+                except OSError:
+                    pass
                 client.close()
                 break
+
+            if message.startswith('/send '):
+                path = os.path.expanduser(message[6:].strip())
+                if os.path.isfile(path):
+                    uploads.offer(path)
+                else:
+                    show(f"--- No such file: {path} ---")
+                continue
+
+            # Other slash commands (/join <room>, /leave, /msg <user> <text>) go to the server as control frames
+            if message.startswith('/'):
+                send(control_frame(message[1:]))
+                continue
             
 
-            client.send(f"[{username}]: {message}".encode('utf-8'))
+            send(chat_frame(f"[{username}]: {message}"))
         except KeyboardInterrupt:
             print("\nExiting...")
             client.close()
             break
+        except OSError:
+            # The receive thread is reconnecting; the message is lost
+            show("--- Not connected, message not sent ---")
         except:
             print("Error sending message.")
             client.close()
@@ -67,7 +240,7 @@ def write():
 
 
 # Start threads
-print("Connected to chat server. Type '/quit' to exit.")
+print("Connected to chat server. Type '/join <room>' to switch rooms, '/leave' to go back to the lobby, '/roster' to see who's online, '/msg <user> <text>' to message one person, '/send <path>' to share a file, '/quit' to exit.")
 print("=" * 50)
 
 receive_thread = threading.Thread(target=receive)
@@ -79,7 +252,9 @@ write_thread.daemon = True
 write_thread.start()
 
 try:
-    write_thread.join()
+    # Also stop once the receive thread has given up on the server
+    while write_thread.is_alive() and receive_thread.is_alive():
+        write_thread.join(0.5)
 except KeyboardInterrupt:
     print("\nExiting...")
 finally:
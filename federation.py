@@ -0,0 +1,376 @@
+"""Relay between separate chat servers ("nodes") so they act as one chat.
+
+Each node listens for peers on a port of its own and dials the peers it
+was given; a link works the same whichever end dialed it. Whatever a node
+publishes (the worker bus's chat, presence, roster and direct messages)
+goes once over each link, never once per remote user: the node at the
+other end fans it out to its own clients.
+
+Peers may be linked in any shape, so messages are flooded, but only
+towards nodes that haven't been sent them yet. A message gets an id when
+it enters the federation, and a "covered" list: the nodes it has been
+sent to so far. Its origin sends it to every peer and lists them all as
+covered. A node relaying it sends it only to those of its peers not yet
+covered, and adds all of its peers to the list. In a full mesh every
+node gets one copy straight from the origin and relays nothing; in a
+chain each link carries it once. Two nodes can still send to the same
+uncovered node in parallel, so the id check stays: an id already seen
+is dropped (a window of the last SEEN_IDS ids is kept), and nothing
+travels more than MAX_HOPS links.
+
+Presence is merged from the rosters every node announces, so room counts
+cover the whole cluster. When a link comes up both ends flood "hello",
+which makes every node announce its rosters again. When a link goes down,
+the nodes whose messages were arriving over it are declared "down": each
+node that had been hearing them that way forgets their users and passes
+the news on, and the "hello" that follows brings back any node still
+reachable some other way.
+
+Every node is given the same secret, and a link carries nothing until
+both ends have proved they know it. Each end opens with a random nonce
+and answers the other's with an HMAC of that nonce and its own name, so
+the secret itself never crosses the wire. A link that sends anything
+else first, or a wrong proof, is dropped; so is one that sends a
+malformed message later on.
+
+The server uses a Federation exactly like a bus.BusLink: publish(),
+receive(), and .sock to wait on. That socket is one end of a socketpair;
+the other end is just one more link in the federation thread's loop.
+
+    sender -> peer   {"kind": "peer", "node": "<name>", "nonce": "<hex>"}   first, on every link
+    sender -> peer   {"kind": "auth", "proof": "<hmac of the peer's nonce and our name>"}
+    either way       {"kind": "ping"}                        keeps an idle link alive
+    either way       {"kind": "duplicate"}                   closing a second link to the same node
+    flooded          {"kind": ..., "id": "<instance>:<n>", "node": "<origin>", "hops": [...], "covered": [...], ...}
+"""
+
+import hashlib
+import hmac
+import itertools
+import secrets
+import selectors
+import socket
+import threading
+import time
+
+from bus import BusLink, decode_message, relay_frame
+from protocol import FRAME_RELAY, RECV_SIZE, FrameDecoder, ProtocolError
+
+
+MAX_HOPS = 8
+SEEN_IDS = 65536
+PEER_RETRY = 1.0        # first redial delay after a failed or lost link, doubled up to PEER_RETRY_MAX
+PEER_RETRY_MAX = 30.0
+PEER_PING_INTERVAL = 5.0
+PEER_TIMEOUT = 15.0     # a link silent this long (or not introduced by then) is dropped
+PEER_BUFFER_MAX = 16 * 1024 * 1024  # a peer this far behind is dropped; it resyncs when it links again
+
+
+def parse_peer(text):
+    """"host:port" -> (host, port)"""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class Federation(BusLink):
+    """This node's links to its peers, run on a thread of their own"""
+
+    def __init__(self, node, secret, listen=None, peers=(), report=print):
+        self.node = node
+        self.secret = secret.encode('utf-8')
+        self.report = report
+        # Ids are per run, so a node that restarts under the same name isn't taken for a repeat
+        self.instance = secrets.token_hex(4)
+        self.ids = itertools.count(1)
+        self.seen = {}    # recently seen message ids, oldest first
+        self.routes = {}  # origin node -> peer whose link its messages arrive over
+        self.relayed = 0
+        self.duplicates = 0
+
+        self.sock, local = socket.socketpair()
+        self.decoder = FrameDecoder()
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.local = self.add_link(local)
+        self.listener = None
+        if listen is not None:
+            self.listener = socket.create_server(listen)
+            self.listener.setblocking(False)
+            self.selector.register(self.listener, selectors.EVENT_READ)
+        self.peers = {address: {"link": None, "node": None, "retry_at": 0.0, "delay": PEER_RETRY}
+                      for address in peers}
+        self.links = {}  # peer node -> its link, once introduced
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stats(self):
+        return {"node": self.node, "peers": sorted(list(self.links)), "relayed": self.relayed,
+                "duplicates": self.duplicates, "nodes_reachable": len(self.routes)}
+
+    # -- links ---------------------------------------------------------------
+
+    def add_link(self, sock, address=None):
+        sock.setblocking(False)
+        now = time.monotonic()
+        link = {"sock": sock, "node": None, "address": address, "decoder": FrameDecoder(),
+                "outgoing": bytearray(), "connecting": address is not None, "heard": now, "pinged": now,
+                "nonce": None, "claimed": None}  # our challenge, and the name the other end gave
+        self.selector.register(sock, selectors.EVENT_WRITE if link["connecting"] else selectors.EVENT_READ, link)
+        return link
+
+    def queue(self, link, frame):
+        if link is not self.local and len(link["outgoing"]) > PEER_BUFFER_MAX:
+            self.drop(link, "too far behind")
+            return
+        if not link["outgoing"] and not link["connecting"]:
+            self.selector.modify(link["sock"], selectors.EVENT_READ | selectors.EVENT_WRITE, link)
+        link["outgoing"] += frame
+
+    def flush(self, link):
+        try:
+            sent = link["sock"].send(link["outgoing"])
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.drop(link, str(e))
+            return
+        del link["outgoing"][:sent]
+        if not link["outgoing"]:
+            self.selector.modify(link["sock"], selectors.EVENT_READ, link)
+
+    def drop(self, link, why, lost=True):
+        """Close a link; with lost, the nodes heard through it are declared down"""
+        try:
+            self.selector.unregister(link["sock"])
+        except (KeyError, ValueError):
+            return  # already dropped
+        link["sock"].close()
+        if link is self.local:
+            return  # the server side is gone: it stops, and so do we
+        peer = self.peers.get(link["address"])
+        if peer is not None:
+            peer["link"] = None
+            peer["retry_at"] = time.monotonic() + peer["delay"]
+            peer["delay"] = min(peer["delay"] * 2, PEER_RETRY_MAX)
+        node = link["node"]
+        if node is None or self.links.get(node) is not link:
+            return
+        del self.links[node]
+        self.report(f"lost {node} ({why}).")
+        if lost:
+            self.declare_down([origin for origin, via in self.routes.items() if via == node])
+            self.originate({"kind": "hello"})
+
+    def drop_duplicate(self, link):
+        """Close a second link to the same node, telling the other end it isn't a lost connection"""
+        try:
+            link["sock"].send(relay_frame({"kind": "duplicate"}))
+        except OSError:
+            pass
+        self.drop(link, "duplicate link", lost=False)
+
+    def dial(self, now):
+        for address, peer in self.peers.items():
+            if peer["link"] is not None or peer["node"] in self.links or now < peer["retry_at"]:
+                continue  # connected (whichever end dialed), or waiting to retry
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(address)
+            peer["link"] = self.add_link(sock, address)
+
+    def connected(self, link):
+        """A dial finished, one way or the other"""
+        error = link["sock"].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.drop(link, f"connect failed: {error}")
+            return
+        link["connecting"] = False
+        self.selector.modify(link["sock"], selectors.EVENT_READ, link)
+        self.introduce(link)
+
+    def introduce(self, link):
+        link["nonce"] = secrets.token_hex(16)
+        self.queue(link, relay_frame({"kind": "peer", "node": self.node, "nonce": link["nonce"]}))
+
+    def proof(self, nonce, node):
+        return hmac.new(self.secret, f"{nonce}:{node}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def challenged(self, link, message):
+        """The other end's introduction: note its name and prove we hold the secret"""
+        node, nonce = message.get("node"), message.get("nonce")
+        if not isinstance(node, str) or not isinstance(nonce, str) or link["claimed"] is not None:
+            self.drop(link, "bad introduction")
+            return
+        link["claimed"] = node
+        self.queue(link, relay_frame({"kind": "auth", "proof": self.proof(nonce, self.node)}))
+
+    def authenticated(self, link, message):
+        proof = message.get("proof")
+        if (link["claimed"] is None or link["node"] is not None or not isinstance(proof, str)
+                or not hmac.compare_digest(proof, self.proof(link["nonce"], link["claimed"]))):
+            self.report(f"refused a link claiming to be {link['claimed']!r}: wrong secret.")
+            self.drop(link, "failed authentication")
+            return
+        self.introduced(link, link["claimed"])
+
+    def introduced(self, link, node):
+        peer = self.peers.get(link["address"])
+        if peer is not None:
+            peer["node"] = node  # no need to dial it while it's linked either way
+        if node == self.node:
+            # Dialed ourselves (a --peer pointing back at this node): stop trying
+            self.drop(link, "that's us")
+            if peer is not None:
+                peer["retry_at"] = float("inf")
+            return
+        existing = self.links.get(node)
+        if existing is not None:
+            # Both ends dialed each other. Both keep the link the lower-named
+            # node dialed, so they agree on which one to close
+            def dialer(candidate):
+                return self.node if candidate["address"] is not None else node
+            if dialer(existing) != dialer(link) and dialer(existing) == min(self.node, node):
+                self.drop_duplicate(link)
+                return
+            self.drop_duplicate(existing)
+        link["node"] = node
+        self.links[node] = link
+        if peer is not None:
+            peer["delay"] = PEER_RETRY
+        self.report(f"linked with {node}.")
+        self.originate({"kind": "hello"})
+
+    # -- messages --------------------------------------------------------------
+
+    def remember(self, message_id):
+        self.seen[message_id] = None
+        if len(self.seen) > SEEN_IDS:
+            del self.seen[next(iter(self.seen))]
+
+    def originate(self, message):
+        """Send a message from this node out over every link"""
+        message.update(id=f"{self.instance}:{next(self.ids)}", node=self.node, hops=[self.node],
+                       covered=[self.node, *self.links])
+        self.remember(message["id"])
+        frame = relay_frame(message)
+        for link in list(self.links.values()):
+            self.queue(link, frame)
+
+    def deliver(self, message):
+        """Hand a message to this node's server"""
+        self.queue(self.local, relay_frame(message))
+
+    def declare_down(self, nodes):
+        """Forget nodes we can no longer hear from, and tell the server and the peers still linked"""
+        nodes = [node for node in nodes if self.routes.pop(node, None) is not None]
+        if nodes:
+            self.report(f"{', '.join(map(str, nodes))} unreachable.")
+            self.deliver({"kind": "down", "nodes": nodes})
+            self.originate({"kind": "down", "nodes": nodes})
+
+    def relay(self, link, message):
+        """A flooded message from a peer: deliver and pass it on unless we've had it already"""
+        message_id = message.get("id")
+        if message_id is None or message_id in self.seen:
+            self.duplicates += 1
+            return
+        self.remember(message_id)
+        origin = message.get("node")
+        if origin == self.node:
+            return
+        self.routes[origin] = link["node"]
+        if message.get("kind") == "down":
+            # Only nodes we were hearing through this peer are gone for us too
+            self.declare_down([node for node in message.get("nodes", ()) if self.routes.get(node) == link["node"]])
+            return
+
+        self.relayed += 1
+        self.deliver(message)
+        hops = message.get("hops", [])
+        covered = set(message.get("covered", hops))
+        targets = [other for node, other in list(self.links.items()) if node not in covered]
+        if targets and len(hops) < MAX_HOPS:
+            message["hops"] = hops + [self.node]
+            message["covered"] = sorted(covered | {self.node} | set(self.links))
+            frame = relay_frame(message)
+            for other in targets:
+                self.queue(other, frame)
+
+    def handle(self, link, message):
+        if link is self.local:
+            self.originate(message)
+        elif message.get("kind") == "peer":
+            self.challenged(link, message)
+        elif message.get("kind") == "auth":
+            self.authenticated(link, message)
+        elif message.get("kind") == "duplicate":
+            self.drop(link, "duplicate link", lost=False)
+        elif link["node"] is None:
+            self.drop(link, "didn't introduce itself")
+        elif message.get("kind") != "ping":
+            self.relay(link, message)
+
+    # -- loop --------------------------------------------------------------------
+
+    def read(self, link):
+        try:
+            data = link["sock"].recv(RECV_SIZE)
+            frames = link["decoder"].feed(data) if data else None
+        except BlockingIOError:
+            return
+        except (OSError, ProtocolError):
+            frames = None
+        if frames is None:
+            self.drop(link, "closed")
+            return
+        link["heard"] = time.monotonic()
+        for frame_type, stream, payload in frames:
+            if frame_type != FRAME_RELAY:
+                continue
+            message = decode_message(payload)
+            if message is None:
+                self.drop(link, "bad message")
+                return
+            try:
+                self.handle(link, message)
+            except (TypeError, ValueError, KeyError, AttributeError) as e:
+                # Well-formed JSON with the wrong shape, e.g. "hops" that isn't a list
+                self.drop(link, f"bad message ({type(e).__name__})")
+                return
+            if link["sock"].fileno() < 0:
+                return  # dropped while handling
+
+    def check_links(self, now):
+        for link in [info.data for info in list(self.selector.get_map().values())]:
+            if link is None or link is self.local:
+                continue
+            if now - link["heard"] > PEER_TIMEOUT:
+                self.drop(link, "timed out")
+            elif link["node"] is not None and now - link["pinged"] >= PEER_PING_INTERVAL:
+                link["pinged"] = now
+                self.queue(link, relay_frame({"kind": "ping"}))
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            self.dial(now)
+            self.check_links(now)
+            for key, events in self.selector.select(timeout=PEER_RETRY / 2):
+                if key.fileobj is self.listener:
+                    try:
+                        sock, address = self.listener.accept()
+                    except OSError:
+                        continue
+                    self.introduce(self.add_link(sock))
+                    continue
+                link = key.data
+                if link["sock"].fileno() < 0:
+                    continue  # dropped earlier in this pass
+                if link["connecting"]:
+                    self.connected(link)
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read(link)
+                if events & selectors.EVENT_WRITE and link["outgoing"] and link["sock"].fileno() >= 0:
+                    self.flush(link)
+            if self.local["sock"].fileno() < 0:
+                return
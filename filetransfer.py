@@ -0,0 +1,234 @@
+"""Client side of file transfers, shared by client.py and the GUI client.
+
+A file is offered to the sender's room on a stream id of its own, and once
+the server accepts it, sent as FRAME_FILE chunks that carry their byte
+offset. The server relays every chunk as it arrives and keeps nothing, so
+each receiver writes chunks straight into <download dir>/<file id>.part
+at their offsets and renames the file once the last byte is in.
+
+    sender -> server     FILE <stream> <file id> <size> <name>
+    server -> sender     FILE_ACCEPT <stream> <offset>     (send from offset)
+    server -> receivers  FILE <stream> <file id> <size> <offset> <sender> <name>
+    server -> sender     FILE_DONE <stream> <receivers>
+    either way           FILE_CANCEL <stream> [reason]      (sender side)
+    server -> receivers  FILE_ABORT <stream> <reason>
+
+If the sender's connection drops mid-file, the server remembers how far it
+got in the sender's session. After a RESUME the client offers the file
+again under the same id and the server tells it where to carry on from
+(or that it is done); receivers that still hold at least that much of the
+.part pick it up again.
+"""
+
+import itertools
+import os
+import secrets
+import threading
+
+from protocol import MAX_STREAM, control_frame, file_frame, split_file
+
+
+CHUNK_SIZE = 16 * 1024
+DOWNLOAD_DIR = "downloads"
+ACCEPT_TIMEOUT = 30.0
+
+
+def describe_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class Uploads:
+    """Files this client is sending.
+
+    send(frame) must write a whole frame to the current connection (taking
+    whatever lock the client uses, so chunks never interleave with other
+    frames) and raise OSError while disconnected. notify(text) shows a
+    status line; it is called from whichever thread noticed the change.
+
+    The client calls disconnected() when its connection drops and resume()
+    once it has a session again.
+    """
+
+    def __init__(self, send, notify):
+        self.send = send
+        self.notify = notify
+        self.streams = itertools.count(1)
+        self.active = {}  # stream -> upload
+        self.lock = threading.Lock()
+
+    def offer(self, path, file_id=None):
+        """Offer a file to the current room; the chunks follow once the server accepts"""
+        upload = {
+            "path": path,
+            "name": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "file_id": file_id or secrets.token_hex(8),
+            "stream": (next(self.streams) - 1) % MAX_STREAM + 1,
+            "offset": None,
+            "accepted": threading.Event(),
+            "stopped": False,  # the connection it was offered on is gone
+        }
+        with self.lock:
+            self.active[upload["stream"]] = upload
+        try:
+            self.send(control_frame(f"FILE {upload['stream']} {upload['file_id']} {upload['size']} {upload['name']}"))
+        except OSError:
+            self.notify(f"Not connected, {upload['name']} will be sent when we're back")
+            return
+        threading.Thread(target=self.run, args=(upload,), daemon=True).start()
+
+    def run(self, upload):
+        if not upload["accepted"].wait(ACCEPT_TIMEOUT):
+            with self.lock:
+                self.active.pop(upload["stream"], None)
+            self.notify(f"No answer from the server, {upload['name']} not sent")
+            return
+        if upload["offset"] is None or upload["stopped"]:
+            return  # refused, or the connection dropped first
+        offset = upload["offset"]
+        try:
+            with open(upload["path"], "rb") as file:
+                file.seek(offset)
+                while offset < upload["size"] and not upload["stopped"] and upload["stream"] in self.active:
+                    data = file.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.send(file_frame(upload["stream"], offset, data))
+                    offset += len(data)
+        except OSError:
+            pass  # dropped connection: resume() offers the file again
+
+    def accepted(self, argument):
+        stream, _, offset = argument.partition(" ")
+        upload = self.active.get(int(stream))
+        if upload is not None:
+            upload["offset"] = int(offset or 0)
+            if upload["offset"]:
+                self.notify(f"Sending {upload['name']} from {describe_size(upload['offset'])}...")
+            else:
+                self.notify(f"Sending {upload['name']} ({describe_size(upload['size'])})...")
+            upload["accepted"].set()
+
+    def finished(self, argument):
+        stream, _, receivers = argument.partition(" ")
+        with self.lock:
+            upload = self.active.pop(int(stream), None)
+        if upload is not None:
+            self.notify(f"Sent {upload['name']} to {receivers or 0} user(s)")
+
+    def cancelled(self, stream, reason):
+        with self.lock:
+            upload = self.active.pop(stream, None)
+        if upload is not None:
+            upload["accepted"].set()  # wakes a thread still waiting, which sees no offset and stops
+            self.notify(f"{upload['name']} not sent: {reason or 'cancelled'}")
+
+    def disconnected(self):
+        """Stop every upload, so none carries on over the next connection under its old stream"""
+        with self.lock:
+            for upload in self.active.values():
+                upload["stopped"] = True
+                upload["accepted"].set()
+
+    def resume(self):
+        """After a reconnect, offer every file without a FILE_DONE again under the same id.
+
+        Chunks written to the old socket may never have reached the server;
+        it answers with where to carry on from (or FILE_DONE if it had it all).
+        """
+        with self.lock:
+            interrupted = list(self.active.values())
+            self.active.clear()
+        for upload in interrupted:
+            self.offer(upload["path"], upload["file_id"])
+
+
+class Downloads:
+    """Files being received, written to disk chunk by chunk.
+
+    Every method returns a status line to show, or None.
+    """
+
+    def __init__(self, directory=DOWNLOAD_DIR):
+        self.directory = directory
+        self.active = {}  # stream -> download
+
+    def offered(self, argument):
+        parts = argument.split(" ", 5)
+        if len(parts) < 6:
+            return None
+        stream, file_id, size, offset, sender, name = parts
+        stream, size, offset = int(stream), int(size), int(offset)
+        name = os.path.basename(name.replace("\\", "/")) or "file"
+        if not file_id.isalnum():
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        part = os.path.join(self.directory, f"{file_id}.part")
+
+        if offset:
+            # A resumed transfer only helps if we have exactly what came before
+            if not os.path.exists(part) or os.path.getsize(part) < offset:
+                return None
+            file = open(part, "r+b")
+            file.truncate(offset)
+            message = f"{sender} is resuming {name} at {describe_size(offset)}"
+        else:
+            file = open(part, "wb")
+            message = f"{sender} is sending {name} ({describe_size(size)})"
+        self.close(stream)
+        self.active[stream] = {"file": file, "part": part, "name": name, "size": size, "received": offset}
+        if offset >= size:
+            return self.complete(stream)
+        return message
+
+    def chunk(self, stream, payload):
+        download = self.active.get(stream)
+        if download is None:
+            return None
+        offset, data = split_file(payload)
+        download["file"].seek(offset)
+        download["file"].write(data)
+        download["received"] = max(download["received"], offset + len(data))
+        if download["received"] >= download["size"]:
+            return self.complete(stream)
+        return None
+
+    def complete(self, stream):
+        download = self.active.pop(stream)
+        download["file"].close()
+        path = self.free_path(download["name"])
+        os.replace(download["part"], path)
+        return f"Saved {path}"
+
+    def aborted(self, stream, reason):
+        download = self.active.pop(stream, None)
+        if download is None:
+            return None
+        # The .part stays, so the rest can still arrive if the sender resumes
+        download["file"].close()
+        return f"{download['name']} interrupted: {reason or 'cancelled'}"
+
+    def close(self, stream=None):
+        """Close one download (or all of them after a dropped connection), keeping the .part files"""
+        streams = [stream] if stream is not None else list(self.active)
+        for stream in streams:
+            download = self.active.pop(stream, None)
+            if download is not None:
+                download["file"].close()
+
+    def free_path(self, name):
+        base, extension = os.path.splitext(name)
+        path = os.path.join(self.directory, name)
+        for copy in itertools.count(1):
+            if not os.path.exists(path):
+                return path
+            path = os.path.join(self.directory, f"{base} ({copy}){extension}")
+
+
+def split_cancel(argument):
+    """FILE_CANCEL / FILE_ABORT argument -> (stream, reason)"""
+    stream, _, reason = argument.partition(" ")
+    return int(stream), reason
@@ -0,0 +1,119 @@
+"""Hand a running server's sockets and state to the process replacing it.
+
+The running server listens on a Unix socket; the new process connects to
+it, and the old one sends it file descriptors (SCM_RIGHTS) followed by a
+JSON description of what they are. The descriptors are duplicates of the
+same open sockets, so the TCP connections never notice: clients keep
+their connection, and the new process simply carries on reading and
+writing it.
+
+The socket is SOCK_SEQPACKET, so every send is one message:
+
+    old -> new   b"F" + descriptors      as many as MAX_FDS per message
+    old -> new   b"S" + JSON chunk       the state, in order
+    old -> new   b"E"                    that's everything
+    new -> old   b"OK"                   the new process has it all
+
+Until "OK" arrives the old process still owns everything and carries on
+if the new one goes away. After it, the old process must exit without
+touching the sockets again. The new one waits until the old process is
+really gone, not just until the handoff socket closes (which can happen
+while other ports are still bound), before it starts serving. The state
+carries the old process's pid for that.
+"""
+
+import json
+import os
+import select
+import socket
+import time
+
+
+MAX_FDS = 200         # descriptors per message, under the kernel's limit of 253
+CHUNK = 32 * 1024     # state bytes per message, well under the socket buffer
+HANDOFF_TIMEOUT = 10.0
+
+
+def open_handoff(path):
+    """Listen for a process that wants to take over"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(path)
+    listener.listen(1)
+    return listener
+
+
+def send_handoff(conn, sockets, state, timeout=HANDOFF_TIMEOUT):
+    """Pass sockets and state (anything JSON can hold) over conn; returns once the new process confirms.
+
+    Raises OSError if it doesn't, in which case nothing has changed hands.
+    """
+    conn.settimeout(timeout)
+    state = dict(state, pid=os.getpid())
+    fds = [sock.fileno() for sock in sockets]
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(conn, [b"F"], fds[start:start + MAX_FDS])
+    data = json.dumps(state).encode('utf-8')
+    for start in range(0, len(data), CHUNK):
+        conn.sendall(b"S" + data[start:start + CHUNK])
+    conn.sendall(b"E")
+    if conn.recv(16) != b"OK":
+        raise ConnectionError("the new process didn't confirm the handoff")
+
+
+def receive_handoff(path, timeout=HANDOFF_TIMEOUT):
+    """Take over from the server listening at path; returns (sockets, state) once it has exited"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    conn.settimeout(timeout)
+    received, chunks = [], []
+    try:
+        conn.connect(path)
+        while True:
+            data, fds, flags, address = socket.recv_fds(conn, CHUNK + 1, MAX_FDS)
+            received.extend(socket.socket(fileno=fd) for fd in fds)
+            if not data:
+                raise ConnectionError("the old process hung up mid-handoff")
+            if data[:1] == b"S":
+                chunks.append(data[1:])
+            elif data[:1] == b"E":
+                break
+        state = json.loads(b"".join(chunks))
+        conn.sendall(b"OK")
+    except BaseException:
+        # Our copies only: the connections stay open in the old process
+        for sock in received:
+            sock.close()
+        conn.close()
+        raise
+
+    conn.close()
+    wait_for_exit(state.pop("pid"), timeout)
+    return received, state
+
+
+def wait_for_exit(pid, timeout=HANDOFF_TIMEOUT):
+    """Wait until a process has exited and released everything it held; False if it's still there"""
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # No pidfd (old kernel or Python): poll. A zombie counts as gone, its sockets are closed
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    if stat.read().rpartition(")")[2].split()[0] == "Z":
+                        return True
+            except OSError:
+                return True
+            time.sleep(0.01)
+        return False
+    try:
+        # Readable once the process has exited
+        return bool(select.select([pidfd], [], [], timeout)[0])
+    finally:
+        os.close(pidfd)
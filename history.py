@@ -0,0 +1,268 @@
+"""Durable chat history.
+
+Every broadcast message is appended to a log split into segment files and
+gets a sequence number that only ever goes up. Each segment has a
+memory-mapped index of fixed-size slots (slot n holds the file offset of
+the segment's n-th record) so any sequence number can be read back with
+one lookup. The most recent messages are also kept in an in-memory ring,
+which is what replay on join normally reads from.
+
+Every room also has an in-memory list of its sequence numbers (8 bytes
+a message, rebuilt from the segments on startup), so a page of a room's
+history costs one bisect and one read per message returned, however
+long ago the room was last active.
+
+On disk, in the history directory:
+
+    00000000000000000001.log   records: seq, time, room length, text length, room, text
+    00000000000000000001.idx   8-byte big-endian (offset + 1) per record, 0 = empty slot
+
+Old segments are deleted once the log is over its size budget or their
+newest record is older than the age limit.
+"""
+
+import array
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+RECORD_HEADER = struct.Struct("!QdHI")  # seq, unix time, room length, text length
+INDEX_ENTRY = struct.Struct("!Q")
+INDEX_SLOTS = 65536
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+MAX_BYTES = 512 * 1024 * 1024
+MAX_AGE = 7 * 24 * 3600
+RING_SIZE = 2048
+
+
+class Segment:
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.next_seq = first_seq
+        self.last_time = 0.0
+        name = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = name + ".log"
+        self.index_path = name + ".idx"
+        # Unbuffered: each record is one write(), so a crash never loses
+        # more than the message being written
+        self.log = open(self.log_path, "ab", buffering=0)
+        self.reader = open(self.log_path, "rb")
+        self.size = os.path.getsize(self.log_path)
+
+        with open(self.index_path, "a+b") as index_file:
+            if os.path.getsize(self.index_path) < INDEX_SLOTS * INDEX_ENTRY.size:
+                index_file.truncate(INDEX_SLOTS * INDEX_ENTRY.size)
+        self.index_file = open(self.index_path, "r+b")
+        self.index = mmap.mmap(self.index_file.fileno(), INDEX_SLOTS * INDEX_ENTRY.size)
+
+    @property
+    def full(self):
+        return self.next_seq - self.first_seq >= INDEX_SLOTS
+
+    def offset_of(self, seq):
+        (entry,) = INDEX_ENTRY.unpack_from(self.index, (seq - self.first_seq) * INDEX_ENTRY.size)
+        return entry - 1 if entry else None
+
+    def append(self, seq, timestamp, room, text):
+        header = RECORD_HEADER.pack(seq, timestamp, len(room), len(text))
+        self.log.write(header + room + text)
+        INDEX_ENTRY.pack_into(self.index, (seq - self.first_seq) * INDEX_ENTRY.size, self.size + 1)
+        self.size += len(header) + len(room) + len(text)
+        self.next_seq = seq + 1
+        self.last_time = timestamp
+
+    def read(self, seq):
+        offset = self.offset_of(seq)
+        if offset is None:
+            return None
+        self.reader.seek(offset)
+        return read_record(self.reader)
+
+    def scan(self):
+        """(seq, room) of every record, reading only the headers and room names"""
+        with open(self.log_path, "rb") as log:
+            while True:
+                header = log.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                seq, timestamp, room_length, text_length = RECORD_HEADER.unpack(header)
+                room = log.read(room_length)
+                if len(room) < room_length:
+                    return
+                log.seek(text_length, os.SEEK_CUR)
+                yield seq, room.decode('utf-8')
+
+    def recover(self):
+        """Rebuild the index from the log file and drop a torn last record"""
+        records = []
+        with open(self.log_path, "rb") as log:
+            offset = 0
+            while True:
+                record = read_record(log)
+                if record is None:
+                    break
+                seq = record[0]
+                INDEX_ENTRY.pack_into(self.index, (seq - self.first_seq) * INDEX_ENTRY.size, offset + 1)
+                offset = log.tell()
+                records.append(record)
+        if offset != self.size:
+            self.log.truncate(offset)
+            self.size = offset
+        if records:
+            self.next_seq = records[-1][0] + 1
+            self.last_time = records[-1][1]
+        return records
+
+    def close(self):
+        self.log.close()
+        self.reader.close()
+        self.index.close()
+        self.index_file.close()
+
+    def delete(self):
+        self.close()
+        os.unlink(self.log_path)
+        os.unlink(self.index_path)
+
+
+def read_record(log):
+    """Read one record at the current position; None at the end or on a torn write"""
+    header = log.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    seq, timestamp, room_length, text_length = RECORD_HEADER.unpack(header)
+    body = log.read(room_length + text_length)
+    if len(body) < room_length + text_length:
+        return None
+    return seq, timestamp, body[:room_length].decode('utf-8'), body[room_length:]
+
+
+class HistoryLog:
+    """Append-only, segmented history with a hot ring of recent messages"""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_BYTES,
+                 max_age=MAX_AGE, ring_size=RING_SIZE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.ring = collections.deque(maxlen=ring_size)  # (seq, time, room, text)
+        self.rooms = {}  # room -> array of its sequence numbers, ascending
+        self.appends_since_retention = 0
+
+        os.makedirs(directory, exist_ok=True)
+        first_seqs = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = [Segment(directory, first_seq) for first_seq in first_seqs]
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.next_seq = following.first_seq
+            segment.last_time = os.path.getmtime(segment.log_path)
+        if self.segments:
+            for segment in self.segments[:-1]:
+                for seq, room in segment.scan():
+                    self._index(seq, room)
+            records = self.segments[-1].recover()
+            for record in records:
+                self._index(record[0], record[2])
+            self.ring.extend(records)
+        else:
+            self.segments.append(Segment(directory, 1))
+
+    def _index(self, seq, room):
+        seqs = self.rooms.get(room)
+        if seqs is None:
+            seqs = self.rooms[room] = array.array("Q")
+        seqs.append(seq)
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].next_seq
+
+    def append(self, room, text):
+        """Log one message for a room; returns its sequence number"""
+        room_bytes = room.encode('utf-8')
+        timestamp = time.time()
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.full or segment.size >= self.segment_bytes:
+                segment = Segment(self.directory, segment.next_seq)
+                self.segments.append(segment)
+                self.enforce_retention()
+            seq = segment.next_seq
+            segment.append(seq, timestamp, room_bytes, text)
+            self.ring.append((seq, timestamp, room, text))
+            self._index(seq, room)
+
+            self.appends_since_retention += 1
+            if self.appends_since_retention >= 1000:
+                self.enforce_retention()
+        return seq
+
+    def enforce_retention(self):
+        """Delete the oldest segments while over the size or age limit (caller holds the lock)"""
+        self.appends_since_retention = 0
+        cutoff = time.time() - self.max_age
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= self.max_bytes and oldest.last_time >= cutoff:
+                break
+            total -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+        self._forget_before(self.segments[0].first_seq)
+
+    def _forget_before(self, first_seq):
+        """Drop index entries for deleted segments"""
+        for room, seqs in list(self.rooms.items()):
+            kept = bisect.bisect_left(seqs, first_seq)
+            if kept == len(seqs):
+                del self.rooms[room]
+            elif kept:
+                del seqs[:kept]
+
+    def before(self, room, seq, limit):
+        """Up to `limit` messages for a room with sequence numbers below seq, oldest first"""
+        with self.lock:
+            seqs = self.rooms.get(room, ())
+            end = bisect.bisect_left(seqs, seq)
+            return self._read(seqs[max(0, end - limit):end])
+
+    def recent(self, room, limit):
+        return self.before(room, self.next_seq, limit)
+
+    def after(self, room, seq, limit):
+        """Up to `limit` of the newest messages for a room with sequence numbers above seq, oldest first"""
+        with self.lock:
+            seqs = self.rooms.get(room, ())
+            start = max(bisect.bisect_right(seqs, seq), len(seqs) - limit)
+            return self._read(seqs[start:])
+
+    def _read(self, seqs):
+        """The records for these sequence numbers: from the ring while it covers them, then from disk"""
+        records = []
+        ring_start = self.ring[0][0] if self.ring else None
+        first_seqs = [segment.first_seq for segment in self.segments]
+        for seq in seqs:
+            if ring_start is not None and ring_start <= seq:
+                # The ring is consecutive sequence numbers, so the position follows from seq
+                position = seq - ring_start
+                if position < len(self.ring) and self.ring[position][0] == seq:
+                    records.append(self.ring[position])
+                    continue
+            segment = self.segments[bisect.bisect_right(first_seqs, seq) - 1]
+            record = segment.read(seq) if segment.first_seq <= seq < segment.next_seq else None
+            if record is not None:
+                records.append(record)
+        return records
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
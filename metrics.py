@@ -0,0 +1,132 @@
+"""Cheap in-process metrics and a local stats endpoint.
+
+Counters and histograms are updated inline on the hot path, so recording
+is kept to an integer add (plus a bisect for histograms) with no locks.
+Under the threaded engine two threads can race on the same add and lose
+an increment now and then; for capacity planning that is an acceptable
+trade for not taking a lock per message.
+
+serve_stats() exposes a JSON snapshot over HTTP on a local port:
+
+    curl http://127.0.0.1:9100/stats
+"""
+
+import bisect
+import collections
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class LabeledCounter:
+    """A counter per label, e.g. disconnects per reason"""
+
+    def __init__(self):
+        self.values = collections.defaultdict(int)
+
+    def inc(self, label, amount=1):
+        self.values[label] += amount
+
+    def snapshot(self):
+        return dict(self.values)
+
+
+# Bucket upper bounds in seconds: 10us .. ~42s, doubling each time
+DEFAULT_BUCKETS = tuple(0.00001 * 2 ** power for power in range(23))
+
+
+class Histogram:
+    """Fixed-bucket histogram; percentiles are reported as bucket upper bounds"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        return self.metrics.setdefault(name, Counter())
+
+    def labeled_counter(self, name):
+        return self.metrics.setdefault(name, LabeledCounter())
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(buckets))
+
+    def gauge(self, name, function):
+        """Register a value that is only computed when a snapshot is taken"""
+        self.gauges[name] = function
+
+    def snapshot(self):
+        result = {name: metric.snapshot() for name, metric in self.metrics.items()}
+        for name, function in self.gauges.items():
+            result[name] = function()
+        return result
+
+
+def serve_stats(registry, host, port):
+    """Serve registry snapshots as JSON from a daemon thread; returns the HTTP server"""
+
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/stats"):
+                self.send_error(404)
+                return
+            body = json.dumps(registry.snapshot(), indent=2, default=str).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep scrapes out of the server's output
+
+    httpd = ThreadingHTTPServer((host, port), StatsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
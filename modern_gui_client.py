@@ -1,14 +1,50 @@
 import customtkinter as ctk
 import tkinter as tk
-from tkinter import messagebox
+from tkinter import filedialog, messagebox
+import collections
+import itertools
+import json
+import os
+import queue
+import random
 import socket
 import threading
+import time
+
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_FILE, FRAME_LOGGED, FRAME_PRESENCE, RECV_SIZE, FrameDecoder,
+                      chat_frame, control_frame, split_command, split_logged)
+from filetransfer import Downloads, Uploads, split_cancel
 
 
 # Set appearance mode and color theme
 ctk.set_appearance_mode("dark")  # Modes: "System" (standard), "Dark", "Light"
 ctk.set_default_color_theme("blue")  # Themes: "blue" (standard), "green", "dark-blue"
 
+# Incoming frames are rendered on the Tk thread in batches: at most
+# MAX_BATCH_FRAMES per pass, every DRAIN_INTERVAL_MS (sooner while behind)
+DRAIN_INTERVAL_MS = 50
+MAX_BATCH_FRAMES = 500
+
+# The textbox only ever holds WINDOW_LINES lines. Everything else lives in
+# a ring of the last SCROLLBACK_LINES formatted lines, and scrolling past
+# either end of the textbox swaps PAGE_LINES in from the ring (or, past
+# the oldest line, from the server's history)
+SCROLLBACK_LINES = 10000
+WINDOW_LINES = 500
+PAGE_LINES = 100
+
+# After a dropped connection, retry with exponential backoff: attempt n
+# waits a random time up to min(RECONNECT_MAX, RECONNECT_BASE * 2**n).
+# Only a SESSION from the server resets n: a server too busy to take us
+# may hang up right after the handshake starts, and that isn't success
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+
+# Heartbeat: if the server has been quiet for HEARTBEAT_INTERVAL we PING it,
+# and after SERVER_TIMEOUT without hearing anything we treat it as a drop
+HEARTBEAT_INTERVAL = 15.0
+SERVER_TIMEOUT = 45.0
+
 
 class ModernChatClient:
     def __init__(self):
@@ -18,10 +54,49 @@ class ModernChatClient:
         
         # Chat variables
         self.client = None
+        self.decoder = None
         self.username = ""
+        self.room = None
+        self.host = None
+        self.port = None
         self.connected = False
+        self.session_token = None  # from the server's SESSION message; sent back in RESUME after a drop
+        self.last_seq = 0          # newest live message seen, so a resume only replays what we missed
+        self.stop_reconnect = threading.Event()
+        self.awaiting_session = False  # reconnected; interrupted uploads restart once the SESSION arrives
+        self.reconnect_attempt = 0     # failed reconnects since the last SESSION
+        self.roster = collections.Counter()  # usernames online in the current room
+        
+        # File transfers: chunks are sent from an upload thread and written to
+        # disk on the receive thread, never on the Tk thread; send_lock keeps
+        # frames from different threads from interleaving on the socket
+        self.send_lock = threading.Lock()
+        self.uploads = Uploads(self.send, self.notify)
+        self.downloads = Downloads()
+        
+        # Tk isn't thread-safe: the receive thread only queues what it reads
+        # (a list of frames per recv, or a method to call on the Tk thread
+        # when the connection drops or comes back) and the Tk main loop
+        # renders it, buffering lines until the end of each batch
+        self.incoming = queue.SimpleQueue()
+        
+        # Scrollback: lines holds (seq or None, text); line numbers are
+        # absolute and first_line is the number of lines[0], so the textbox
+        # window [window_start, window_end) survives the ring dropping lines
+        self.lines = collections.deque(maxlen=SCROLLBACK_LINES)
+        self.first_line = 0
+        self.window_start = 0
+        self.window_end = 0
+        self.history_requested = False  # a HISTORY page is on its way
+        self.history_exhausted = False  # the server has nothing older for this room
+        self.page_remaining = 0         # LOGGED frames still to come for the page
+        self.page = []
+        # The server never echoes our chat back, so our lines in a replay are
+        # new to a fresh transcript; after a resume they are already on screen
+        self.replaying_own = True
         
         self.setup_ui()
+        self.root.after(DRAIN_INTERVAL_MS, self.drain_incoming)
         self.setup_connection()
         
     def setup_ui(self):
@@ -30,9 +105,9 @@ class ModernChatClient:
         self.root.grid_rowconfigure(1, weight=1)
         
         # Title
-        title_label = ctk.CTkLabel(self.root, text="Chat Room", 
+        self.title_label = ctk.CTkLabel(self.root, text="Chat Room", 
                                   font=ctk.CTkFont(size=24, weight="bold"))
-        title_label.grid(row=0, column=0, padx=20, pady=(20, 10), sticky="ew")
+        self.title_label.grid(row=0, column=0, padx=20, pady=(20, 10), sticky="ew")
         
         # Chat display area with frame
         chat_frame = ctk.CTkFrame(self.root)
@@ -61,7 +136,11 @@ class ModernChatClient:
         self.send_button = ctk.CTkButton(input_frame, text="Send", command=self.send_message,
                                         font=ctk.CTkFont(size=14, weight="bold"), 
                                         height=40, width=100)
-        self.send_button.grid(row=0, column=1, padx=(0, 15), pady=15)
+        self.send_button.grid(row=0, column=1, padx=(0, 10), pady=15)
+        
+        self.file_button = ctk.CTkButton(input_frame, text="📎 File", command=self.choose_file,
+                                        font=ctk.CTkFont(size=14), height=40, width=80)
+        self.file_button.grid(row=0, column=2, padx=(0, 15), pady=15)
         
         # Reconnect button (initially hidden)
         self.reconnect_button = ctk.CTkButton(input_frame, text="🔄 Reconnect", command=self.manual_reconnect,
@@ -86,15 +165,15 @@ class ModernChatClient:
         # Disable input initially
         self.message_entry.configure(state="disabled")
         self.send_button.configure(state="disabled")
+        self.file_button.configure(state="disabled")
         
     def manual_reconnect(self):
-        """Manually trigger reconnection"""
+        """Give up on the automatic reconnect and pick a server again"""
         # Hide reconnect button and cancel auto-reconnect
         self.reconnect_button.grid_remove()
-        self.send_button.grid(row=0, column=1, padx=(0, 15), pady=15)
-        
-        # Clear any pending auto-reconnect
-        # (We can't easily cancel the after() call, but return_to_connection will handle being called multiple times)
+        self.send_button.grid(row=0, column=1, padx=(0, 10), pady=15)
+        self.stop_reconnect.set()
+        self.connected = False
         
         # Immediately return to connection
         self.return_to_connection()
@@ -117,24 +196,21 @@ class ModernChatClient:
             
     def connect_to_server(self, host, port):
         try:
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.connect((host, int(port)))
-            
-            # Handle initial USERNAME request immediately
-            initial_message = self.client.recv(1024).decode('utf-8')
-            if initial_message == "USERNAME":
-                self.client.send(self.username.encode('utf-8'))
-                print(f"[GUI CLIENT] Sent username: {self.username}")
+            self.host, self.port = host, int(port)
+            self.client, self.decoder, pending_frames = self.open_connection()
             
             self.connected = True
+            self.incoming.put(pending_frames)
             
             # Start receiving thread after handling initial exchange
-            receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
+            self.stop_reconnect = threading.Event()
+            receive_thread = threading.Thread(target=self.receive_messages, args=(self.stop_reconnect,), daemon=True)
             receive_thread.start()
             
             self.status_label.configure(text=f"🟢 Connected as {self.username}")
             self.message_entry.configure(state="normal")
             self.send_button.configure(state="normal")
+            self.file_button.configure(state="normal")
             self.message_entry.focus()
             
             self.add_message("🎉 Welcome to the chat room!", "system")
@@ -147,44 +223,302 @@ class ModernChatClient:
             print(f"[GUI CLIENT] Connection failed: {e}")
             return False  # Connection failed
             
-    def receive_messages(self):
-        while self.connected:
+    def open_connection(self):
+        """Connect and answer the server's USERNAME request; returns (socket, decoder, frames that followed).
+        
+        With a session from an earlier connection this sends RESUME instead,
+        so the server puts us back where we were and replays what we missed.
+        """
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        try:
+            decoder = FrameDecoder()
+            while True:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("Server closed the connection during the handshake")
+                frames = decoder.feed(data)
+                if any(self.is_username_request(frame) for frame in frames):
+                    if self.session_token:
+                        sock.sendall(control_frame(f"RESUME {self.session_token} {self.last_seq}"))
+                        print(f"[GUI CLIENT] Resuming session as {self.username}")
+                    else:
+                        sock.sendall(control_frame(f"USERNAME {self.username}"))
+                        print(f"[GUI CLIENT] Sent username: {self.username}")
+                    sock.settimeout(HEARTBEAT_INTERVAL)
+                    return sock, decoder, [frame for frame in frames if not self.is_username_request(frame)]
+        except:
+            sock.close()
+            raise
+            
+    def send(self, frame):
+        """Write one whole frame to the server (from any thread)"""
+        with self.send_lock:
+            if self.client is None:
+                raise OSError("not connected")
+            self.client.sendall(frame)
+            
+    def notify(self, text):
+        """Show a status line from any thread"""
+        self.incoming.put(lambda: self.add_message(text, "system"))
+            
+    def handle_transfer_frame(self, frame):
+        """Receive thread: deal with a file transfer frame; returns False for anything else"""
+        frame_type, stream, payload = frame
+        if frame_type == FRAME_FILE:
+            notice = self.downloads.chunk(stream, payload)
+        elif frame_type == FRAME_CONTROL:
+            command, argument = split_command(payload, 'replace')
+            notice = None
+            if command == "FILE":
+                notice = self.downloads.offered(argument)
+            elif command == "FILE_ACCEPT":
+                self.uploads.accepted(argument)
+            elif command == "FILE_DONE":
+                self.uploads.finished(argument)
+            elif command == "FILE_CANCEL":
+                self.uploads.cancelled(*split_cancel(argument))
+            elif command == "FILE_ABORT":
+                notice = self.downloads.aborted(*split_cancel(argument))
+            else:
+                return False
+        else:
+            return False
+        if notice:
+            self.notify(notice)
+        return True
+            
+    def choose_file(self):
+        path = filedialog.askopenfilename(parent=self.root, title="Send a file to the room")
+        if path:
+            self.send_file(path)
+            
+    def send_file(self, path):
+        if not os.path.isfile(path):
+            self.add_message(f"No such file: {path}", "system")
+            return
+        self.uploads.offer(path)
+            
+    @staticmethod
+    def is_username_request(frame):
+        frame_type, stream, payload = frame
+        return frame_type == FRAME_CONTROL and split_command(payload, 'replace')[0] == "USERNAME"
+            
+    @staticmethod
+    def is_ping(frame):
+        frame_type, stream, payload = frame
+        return frame_type == FRAME_CONTROL and split_command(payload, 'replace')[0] == "PING"
+            
+    @staticmethod
+    def is_name_taken(frame):
+        frame_type, stream, payload = frame
+        return frame_type == FRAME_CONTROL and split_command(payload, 'replace')[0] == "USERNAME_TAKEN"
+            
+    def handle_frame(self, frame_type, payload):
+        seq = None
+        if frame_type == FRAME_LOGGED:
+            # Chat from the server's history log, prefixed with its sequence number
+            seq, payload = split_logged(payload)
+            if self.page_remaining:
+                text = str(payload, 'utf-8', 'replace')
+                self.page.append((seq, self.format_message(text, "sent" if self.is_own(text) else "received")))
+                self.page_remaining -= 1
+                if not self.page_remaining:
+                    self.prepend_page()
+                return
+            self.last_seq = max(self.last_seq, seq)
+            message = str(payload, 'utf-8', 'replace')
+            if not self.is_own(message):
+                self.add_message(message, "received", seq)
+            elif self.replaying_own:
+                self.add_message(message, "sent", seq)
+            return
+        message = str(payload, 'utf-8', 'replace')
+        if frame_type == FRAME_CONTROL:
+            command, argument = split_command(payload, 'replace')
+            if command == "USERNAME":
+                # Asked again after a RESUME: the session expired, so join afresh
+                # (the room's history is replayed on join)
+                self.session_token = None
+                self.send(control_frame(f"USERNAME {self.username}"))
+                print(f"[GUI CLIENT] Re-sent username: {self.username}")
+                self.reset_scrollback()
+                self.room = None
+                self.add_message("Session expired, rejoined the chat", "system")
+            elif command == "SESSION":
+                self.session_token = argument
+                self.reconnect_attempt = 0
+                if self.awaiting_session:
+                    self.awaiting_session = False
+                    self.uploads.resume()
+            elif command == "ROOM":
+                if argument == self.room:
+                    self.replaying_own = False
+                    return  # resumed where we were
+                self.replaying_own = True
+                self.title_label.configure(text=f"Chat Room #{argument}")
+                # Each room starts a fresh transcript (its history is replayed on join)
+                if self.room is not None:
+                    self.reset_scrollback()
+                self.room = argument
+                self.add_message(f"You are now in #{argument}", "system")
+            elif command == "USERNAME_TAKEN":
+                # The receive thread has already stopped reconnecting; pick another name
+                self.connected = False
+                messagebox.showerror("Username Taken",
+                                     f"Someone is already using the name {argument}.\n\nPlease choose another username.")
+                self.return_to_connection()
+            elif command == "MSG":
+                sender, _, text = argument.partition(" ")
+                self.add_message(f"[{sender} → you]: {text}", "received")
+            elif command == "ERROR":
+                self.add_message(argument, "system")
+                if self.history_requested and not self.page_remaining:
+                    # Most likely our HISTORY request was refused (rate limited, or history is off):
+                    # let the next scroll to the top ask again, unless there's no point
+                    self.history_requested = False
+                    if argument.startswith("History is disabled"):
+                        self.history_exhausted = True
+            elif command == "HISTORY":
+                # An older page follows as this many LOGGED frames
+                self.page_remaining = int(argument)
+                self.page = []
+                if not self.page_remaining:
+                    self.history_exhausted = True
+                    self.history_requested = False
+        elif frame_type == FRAME_PRESENCE:
+            self.handle_presence(json.loads(message))
+        elif frame_type == FRAME_CHAT:
+            # Don't display your own messages again (avoid duplicates)
+            if not message.startswith(f"[{self.username}]:"):
+                self.add_message(message, "received", seq)
+            
+    def handle_presence(self, update):
+        """Apply a roster snapshot or a joined/left delta and refresh the users label"""
+        if "roster" in update:
+            self.roster = collections.Counter(update["roster"])
+        else:
+            self.roster.update(update["joined"])
+            self.roster.subtract(update["left"])
+            self.roster += collections.Counter()  # drop users whose count reached zero
+            others_joined = [name for name in update["joined"] if name != self.username]
+            if others_joined:
+                self.add_message(f"{', '.join(others_joined)} joined", "system")
+            if update["left"]:
+                self.add_message(f"{', '.join(update['left'])} left", "system")
+
+        names = sorted(self.roster)
+        shown = ", ".join(names[:5]) + (f" +{len(names) - 5}" if len(names) > 5 else "")
+        self.users_label.configure(text=f"👥 Users: {update['count']}  ({shown})")
+            
+    def receive_messages(self, stop):
+        """Background thread: read frames and hand them to the Tk main loop, reconnecting after a drop"""
+        while True:
+            last_heard = time.monotonic()
+            while self.connected:
+                try:
+                    data = self.client.recv(RECV_SIZE)
+                    if not data:
+                        print("[GUI CLIENT] Empty message received, connection closed")
+                        break
+                    last_heard = time.monotonic()
+                    frames = self.decoder.feed(data)
+                    # Answered here rather than on the Tk thread, so a busy UI can't make us look dead
+                    if any(self.is_ping(frame) for frame in frames):
+                        self.send(control_frame("PONG"))
+                    if any(self.is_name_taken(frame) for frame in frames):
+                        stop.set()  # the server hangs up next; reconnecting as the same name won't help
+                    frames = [frame for frame in frames if not self.handle_transfer_frame(frame)]
+                    if frames:
+                        self.incoming.put(frames)
+                except socket.timeout:
+                    if time.monotonic() - last_heard >= SERVER_TIMEOUT:
+                        print("[GUI CLIENT] Server stopped responding")
+                        break
+                    try:
+                        self.send(control_frame("PING"))
+                    except OSError:
+                        break
+                except Exception as e:
+                    print(f"[GUI CLIENT] Receive error: {e}")
+                    break
+                    
+            self.connected = False
+            self.uploads.disconnected()
+            self.downloads.close()
+            if stop.is_set():
+                return
+            self.incoming.put(self.on_disconnected)
+            if not self.reconnect(stop):
+                return
+            
+    def reconnect(self, stop):
+        """Background thread: retry until connected again or stopped, with jittered exponential backoff"""
+        while True:
+            # Full jitter, so clients dropped at the same moment don't all come back at once
+            delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** self.reconnect_attempt))
+            if stop.wait(delay):
+                return False
+            self.reconnect_attempt += 1
             try:
-                message = self.client.recv(1024).decode('utf-8')
-                if message == "USERNAME":
-                    # This shouldn't happen after initial connection, but handle it just in case
-                    self.client.send(self.username.encode('utf-8'))
-                    print(f"[GUI CLIENT] Re-sent username: {self.username}")
-                elif message.startswith("USER_COUNT:"):
-                    # Handle user count update
-                    user_count = message.split(":")[1].strip()
-                    self.users_label.configure(text=f"👥 Users: {user_count}")
-                    print(f"[GUI CLIENT] User count updated: {user_count}")
-                elif message:
-                    print(f"[GUI CLIENT] Received: {message}")
-                    # Don't display your own messages again (avoid duplicates)
-                    if not message.startswith(f"[{self.username}]:"):
-                        self.add_message(message, "received")
-                else:
-                    print("[GUI CLIENT] Empty message received, connection closed")
+                sock, decoder, frames = self.open_connection()
+            except OSError as e:
+                print(f"[GUI CLIENT] Reconnect attempt {self.reconnect_attempt} failed: {e}")
+                continue
+            if stop.is_set():
+                sock.close()
+                return False
+            with self.send_lock:
+                self.client, self.decoder = sock, decoder
+            self.connected = True
+            self.awaiting_session = True
+            self.incoming.put(self.on_reconnected)
+            if frames:
+                self.incoming.put(frames)
+            return True
+        
+    def drain_incoming(self):
+        """Render a batch of queued frames, then reschedule itself on the Tk main loop"""
+        handled = 0
+        try:
+            while handled < MAX_BATCH_FRAMES:
+                try:
+                    frames = self.incoming.get_nowait()
+                except queue.Empty:
                     break
-            except Exception as e:
-                print(f"[GUI CLIENT] Receive error: {e}")
-                break
-                
-        self.connected = False
-        self.add_message("❌ Disconnected from server", "system")
-        self.add_message("🔄 Returning to connection screen in 2 seconds...", "system")
-        self.add_message("💡 Or click the Reconnect button to reconnect immediately", "system")
-        self.status_label.configure(text="🔴 Disconnected")
+                if callable(frames):
+                    frames()  # connection dropped or came back
+                    continue
+                for frame_type, stream, payload in frames:
+                    try:
+                        self.handle_frame(frame_type, payload)
+                    except Exception as e:
+                        # One bad frame (say, a presence update that isn't JSON) mustn't lose the rest
+                        print(f"[GUI CLIENT] Skipped a frame that couldn't be shown: {type(e).__name__}: {e}")
+                handled += len(frames)
+            self.flush_messages()
+            self.check_scroll()
+        finally:
+            # Always come back, or one exception would stop rendering for good
+            self.root.after(1 if handled >= MAX_BATCH_FRAMES else DRAIN_INTERVAL_MS, self.drain_incoming)
+        
+    def on_disconnected(self):
+        self.add_message("❌ Connection lost, reconnecting...", "system")
+        self.add_message("💡 Or click the Reconnect button to pick a server again", "system")
+        self.status_label.configure(text="🟡 Reconnecting...")
         self.message_entry.configure(state="disabled")
+        self.file_button.configure(state="disabled")
         self.send_button.grid_remove()  # Hide send button
-        self.reconnect_button.grid(row=0, column=1, padx=(0, 15), pady=15)  # Show reconnect button
-        self.users_label.configure(text="👥 Users: 0")
-        print("[GUI CLIENT] Disconnected from chat server")
+        self.reconnect_button.grid(row=0, column=1, padx=(0, 10), pady=15)  # Show reconnect button
+        print("[GUI CLIENT] Disconnected from chat server, reconnecting")
         
-        # Return to connection screen after a brief delay
-        self.root.after(2000, self.return_to_connection)  # 2 second delay
+    def on_reconnected(self):
+        self.add_message("✅ Reconnected", "system")
+        self.status_label.configure(text=f"🟢 Connected as {self.username}")
+        self.reconnect_button.grid_remove()
+        self.send_button.grid(row=0, column=1, padx=(0, 10), pady=15)
+        self.message_entry.configure(state="normal")
+        self.file_button.configure(state="normal")
+        print("[GUI CLIENT] Reconnected to chat server")
         
     def return_to_connection(self):
         """Return to the connection dialog after disconnect"""
@@ -193,19 +527,30 @@ class ModernChatClient:
             return
             
         # Clear the chat
-        self.chat_text.configure(state="normal")
-        self.chat_text.delete("1.0", "end")
-        self.chat_text.configure(state="disabled")
+        self.reset_scrollback()
         
         # Reset UI to initial state
         self.reconnect_button.grid_remove()  # Hide reconnect button
-        self.send_button.grid(row=0, column=1, padx=(0, 15), pady=15)  # Show send button
+        self.send_button.grid(row=0, column=1, padx=(0, 10), pady=15)  # Show send button
         self.send_button.configure(state="disabled")  # But keep it disabled
+        self.file_button.configure(state="disabled")
         
         # Reset connection state
         self.connected = False
+        if self.client is not None:
+            self.client.close()
         self.client = None
         self.username = ""
+        self.room = None
+        self.session_token = None
+        self.reconnect_attempt = 0
+        self.last_seq = 0
+        self.awaiting_session = False
+        # A new server (or user) starts with no transfers; stop any still running
+        self.uploads.disconnected()
+        self.uploads = Uploads(self.send, self.notify)
+        self.downloads.close()
+        self.users_label.configure(text="👥 Users: 0")
         
         # Show connection dialog again
         self.setup_connection()
@@ -218,38 +563,168 @@ class ModernChatClient:
                     self.on_closing()
                     return
                 
+                if message.startswith('/send '):
+                    self.send_file(os.path.expanduser(message[6:].strip()))
+                    self.message_entry.delete(0, tk.END)
+                    return
+                
+                if message.startswith('/msg '):
+                    # Shown here, as the server doesn't echo direct messages back
+                    recipient, _, text = message[5:].strip().partition(" ")
+                    if recipient and text:
+                        self.add_message(f"[you → {recipient}]: {text}", "received")
+                
+                # Other slash commands (/join <room>, /leave, /msg <user> <text>) go to the server as control frames
+                if message.startswith('/'):
+                    self.send(control_frame(message[1:]))
+                    self.message_entry.delete(0, tk.END)
+                    return
+                
                 # Display your own message immediately
                 self.add_message(f"[{self.username}]: {message}", "sent")
                 
                 full_message = f"[{self.username}]: {message}"
-                self.client.send(full_message.encode('utf-8'))
+                self.send(chat_frame(full_message))
                 self.message_entry.delete(0, tk.END)
             except:
                 messagebox.showerror("Error", "Failed to send message")
                 
-    def add_message(self, message, msg_type):
-        # Temporarily enable editing to add message
-        self.chat_text.configure(state="normal")
-        
-        current_text = self.chat_text.get("1.0", tk.END)
+    def is_own(self, message):
+        return message.startswith(f"[{self.username}]:")
         
+    def format_message(self, message, msg_type):
         if msg_type == "system":
-            formatted_message = f"--- {message} ---\n"
-        elif msg_type == "sent":
+            return f"--- {message} ---\n"
+        if msg_type == "sent":
             # Style your own messages differently
-            formatted_message = f"You: {message.replace(f'[{self.username}]: ', '')}\n"
-        else:
-            formatted_message = f"{message}\n"
-            
-        self.chat_text.insert(tk.END, formatted_message)
-        self.chat_text.see(tk.END)
-        
+            return f"You: {message.replace(f'[{self.username}]: ', '', 1)}\n"
+        return f"{message}\n"
+        
+    def add_message(self, message, msg_type, seq=None):
+        """Add a line to the scrollback; it is drawn by the next flush_messages()"""
+        if len(self.lines) == self.lines.maxlen:
+            self.first_line += 1  # the ring is about to drop its oldest line
+        self.lines.append((seq, self.format_message(message, msg_type)))
+        
+    def lines_between(self, start, end):
+        """Text of the scrollback lines numbered start to end-1 that are still in the ring"""
+        start, end = max(start, self.first_line) - self.first_line, max(end, self.first_line) - self.first_line
+        return "".join(text for seq, text in itertools.islice(self.lines, start, end))
+        
+    def edit_chat(self, edit):
+        # Temporarily enable editing to change the textbox
+        self.chat_text.configure(state="normal")
+        edit()
         # Disable editing again to make it read-only
         self.chat_text.configure(state="disabled")
         
+    def flush_messages(self):
+        """Draw the lines added since the last batch with a single insert and scroll"""
+        end = self.first_line + len(self.lines)
+        if self.window_end == end:
+            return
+        following = self.chat_text.yview()[1] >= 1.0
+        if self.window_end < self.first_line:
+            # The window scrolled out of the ring while the user was reading; jump back to live
+            self.render_window(max(self.first_line, end - WINDOW_LINES), end)
+            return
+        if not following and self.window_end - self.window_start >= WINDOW_LINES:
+            return  # the user is reading older lines; new ones wait in the ring
+        
+        def append():
+            self.chat_text.insert(tk.END, self.lines_between(self.window_end, end))
+            self.window_end = end
+            if following:
+                self.trim_top(self.window_end - self.window_start - WINDOW_LINES)
+                self.chat_text.see(tk.END)
+        self.edit_chat(append)
+        
+    def render_window(self, start, end):
+        def render():
+            self.chat_text.delete("1.0", tk.END)
+            self.chat_text.insert(tk.END, self.lines_between(start, end))
+            self.chat_text.see(tk.END)
+        self.window_start, self.window_end = start, end
+        self.edit_chat(render)
+        
+    def trim_top(self, count):
+        if count > 0:
+            self.chat_text.delete("1.0", f"{count + 1}.0")
+            self.window_start += count
+        
+    def trim_bottom(self, count):
+        if count > 0:
+            self.chat_text.delete(f"{self.window_end - self.window_start - count + 1}.0", "end-1c")
+            self.window_end -= count
+        
+    def check_scroll(self):
+        """Page lines in when the user has scrolled to either end of the textbox"""
+        top, bottom = self.chat_text.yview()
+        if top <= 0.0 and bottom < 1.0:
+            self.load_older()
+        elif top > 0.0 and bottom >= 1.0 and self.window_end < self.first_line + len(self.lines):
+            self.load_newer()
+            
+    def load_older(self):
+        if self.window_start > self.first_line:
+            start = max(self.first_line, self.window_start - PAGE_LINES)
+            
+            def prepend():
+                self.chat_text.insert("1.0", self.lines_between(start, self.window_start))
+                added = self.window_start - start
+                self.window_start = start
+                self.trim_bottom(self.window_end - self.window_start - WINDOW_LINES)
+                # Keep the line that was at the top in view instead of jumping to the new top
+                self.chat_text.yview("moveto", added / (self.window_end - self.window_start))
+            self.edit_chat(prepend)
+            return
+        
+        # The ring has nothing older; ask the server for the page before our oldest message
+        oldest_seq = next((seq for seq, text in self.lines if seq is not None), None)
+        if (oldest_seq is None or self.history_requested or self.history_exhausted
+                or len(self.lines) >= SCROLLBACK_LINES or not self.connected):
+            return
+        self.history_requested = True
+        try:
+            self.send(control_frame(f"HISTORY {oldest_seq} {PAGE_LINES}"))
+        except OSError:
+            self.history_requested = False
+            
+    def load_newer(self):
+        end = min(self.first_line + len(self.lines), self.window_end + PAGE_LINES)
+        
+        def append():
+            self.chat_text.insert(tk.END, self.lines_between(self.window_end, end))
+            self.window_end = end
+            self.trim_top(self.window_end - self.window_start - WINDOW_LINES)
+        self.edit_chat(append)
+        
+    def prepend_page(self):
+        """Put a page of server history in front of the ring and show it"""
+        # A request repeated after an unrelated ERROR can bring the same page twice
+        oldest_seq = next((seq for seq, text in self.lines if seq is not None), None)
+        page = [line for line in self.page if oldest_seq is None or line[0] < oldest_seq]
+        page = page[-(SCROLLBACK_LINES - len(self.lines)):] if len(self.lines) < SCROLLBACK_LINES else []
+        self.lines.extendleft(reversed(page))
+        self.first_line -= len(page)
+        self.page = []
+        self.history_requested = False
+        self.load_older()
+        
+    def reset_scrollback(self):
+        self.lines.clear()
+        self.first_line = self.window_start = self.window_end = 0
+        self.history_requested = self.history_exhausted = False
+        self.page_remaining = 0
+        self.page = []
+        self.edit_chat(lambda: self.chat_text.delete("1.0", tk.END))
+        
     def on_closing(self):
+        self.stop_reconnect.set()
         if self.connected:
             try:
+                # Leaving on purpose: tell the server not to hold our session
+                self.send(control_frame("QUIT"))
                 self.client.close()
             except:
                 pass
@@ -349,6 +824,10 @@ class ModernConnectionDialog:
         if len(username) > 20:
             messagebox.showerror("Error", "Username must be 20 characters or less")
             return
+
+        if not username.isprintable() or any(char.isspace() for char in username):
+            messagebox.showerror("Error", "Username can't contain spaces")
+            return
             
         self.result = (host, port, username)
         self.dialog.destroy()
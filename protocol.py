@@ -0,0 +1,141 @@
+"""Wire protocol shared by the server and both clients.
+
+Every message travels as a frame: a fixed header followed by the payload.
+
+    version (1 byte) | frame type (1 byte) | stream id (2 bytes) | payload length (4 bytes)
+
+All header fields are big-endian. Payloads are UTF-8 text unless a frame
+type says otherwise. TCP is a byte stream, so a single recv() may hold
+several frames or only part of one; FrameDecoder takes care of both.
+"""
+
+import struct
+
+
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct("!BBHI")
+HEADER_SIZE = HEADER.size
+
+# Frame types
+FRAME_CHAT = 1      # chat text, e.g. "[alice]: hello"
+FRAME_PRESENCE = 2  # presence updates, e.g. "USER_COUNT:3"
+FRAME_CONTROL = 3   # commands: "USERNAME" request, "USERNAME alice" reply, ...
+FRAME_RELAY = 4     # server-to-server traffic (worker bus), JSON payload; never sent to clients
+FRAME_LOGGED = 5    # chat from the server's history log: 8-byte sequence number, then the chat text
+FRAME_FILE = 6      # a chunk of a file transfer, on the transfer's stream id: 8-byte offset, then the bytes
+
+FRAME_TYPES = (FRAME_CHAT, FRAME_PRESENCE, FRAME_CONTROL, FRAME_RELAY, FRAME_LOGGED, FRAME_FILE)
+
+SEQUENCE = struct.Struct("!Q")
+OFFSET = SEQUENCE
+
+# Largest stream id the header can carry; stream 0 is the chat stream
+MAX_STREAM = 0xFFFF
+
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Large reads let one syscall pick up many frames at once
+RECV_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that are not a valid frame"""
+
+
+def encode_frame(frame_type, payload, stream=0):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, stream, len(payload)) + payload
+
+
+def chat_frame(text):
+    return encode_frame(FRAME_CHAT, text)
+
+
+def presence_frame(text):
+    return encode_frame(FRAME_PRESENCE, text)
+
+
+def control_frame(text):
+    return encode_frame(FRAME_CONTROL, text)
+
+
+def logged_frame(seq, text):
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return encode_frame(FRAME_LOGGED, SEQUENCE.pack(seq) + text)
+
+
+def split_logged(payload):
+    """Split a FRAME_LOGGED payload into (sequence number, chat text view)"""
+    if len(payload) < SEQUENCE.size:
+        raise ProtocolError("logged chat frame is missing its sequence number")
+    return SEQUENCE.unpack_from(payload)[0], payload[SEQUENCE.size:]
+
+
+def file_frame(stream, offset, data):
+    return encode_frame(FRAME_FILE, OFFSET.pack(offset) + data, stream)
+
+
+def split_file(payload):
+    """Split a FRAME_FILE payload into (offset, chunk view)"""
+    if len(payload) < OFFSET.size:
+        raise ProtocolError("file chunk is missing its offset")
+    return OFFSET.unpack_from(payload)[0], payload[OFFSET.size:]
+
+
+def decode_text(payload, errors='strict'):
+    """A text payload as str; ProtocolError if it isn't UTF-8 (unless errors='replace')"""
+    try:
+        return str(payload, 'utf-8', errors)
+    except UnicodeDecodeError:
+        raise ProtocolError("text payload is not valid UTF-8") from None
+
+
+def split_command(payload, errors='strict'):
+    """Split a control payload into (COMMAND, argument string)"""
+    text = decode_text(payload, errors).strip()
+    command, _, argument = text.partition(" ")
+    return command.upper(), argument.strip()
+
+
+class FrameDecoder:
+    """Incremental decoder that turns a byte stream into frames.
+
+    feed() takes whatever recv() returned and gives back every complete
+    frame as (frame_type, stream, payload). Payloads are memoryview slices
+    over the received bytes rather than copies; when no partial frame is
+    buffered (the common case) the chunk handed to feed() is parsed in
+    place. Only the unfinished tail of a chunk is kept for the next call.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = b""
+
+    def feed(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        end = len(data)
+
+        while end - offset >= HEADER_SIZE:
+            version, frame_type, stream, length = HEADER.unpack_from(data, offset)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"unsupported protocol version {version}")
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"unknown frame type {frame_type}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                break
+            frames.append((frame_type, stream, view[start:start + length]))
+            offset = start + length
+
+        self.buffer = bytes(view[offset:]) if offset < end else b""
+        return frames
@@ -0,0 +1,77 @@
+"""Token-bucket rate limits for what clients send.
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per
+second; sending costs one token per message (or one per byte). A
+RateLimiter pairs a message bucket with a byte bucket, and a message only
+goes through when both have room for it. The server keeps one limiter per
+connection and one per room, so a single flooding script can neither
+monopolise fanout on its own nor by splitting itself across connections.
+
+What happens to a message over the limit is up to the caller:
+
+    DELAY       hold it (and stop reading the socket) until it fits
+    DROP        discard it
+    DISCONNECT  drop the connection
+
+Like the metrics, buckets are updated without a lock: under the threaded
+engine two threads sharing a room limiter can now and then both spend the
+same token, which only lets the odd message through early.
+"""
+
+
+DELAY = "delay"
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+RATE_LIMIT_ACTIONS = (DELAY, DROP, DISCONNECT)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount, now):
+        """Seconds until amount tokens are available (0 if they are now)"""
+        self.refill(now)
+        # Anything bigger than the bucket is allowed through once it is full
+        missing = min(amount, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """Messages/sec and bytes/sec buckets for one connection or room; a rate of 0 means no limit"""
+
+    def __init__(self, messages_per_sec, message_burst, bytes_per_sec, byte_burst, now):
+        self.messages = TokenBucket(messages_per_sec, message_burst, now) if messages_per_sec > 0 else None
+        self.bytes = TokenBucket(bytes_per_sec, byte_burst, now) if bytes_per_sec > 0 else None
+        self.allowed = 0
+        self.limited = 0
+        self.last_notice = 0.0  # when the sender was last told it is being limited
+
+    def wait(self, size, now):
+        """Seconds until a message of size bytes fits in both buckets"""
+        wait = 0.0
+        if self.messages is not None:
+            wait = self.messages.wait(1, now)
+        if self.bytes is not None:
+            wait = max(wait, self.bytes.wait(size, now))
+        return wait
+
+    def take(self, size):
+        if self.messages is not None:
+            self.messages.take(1)
+        if self.bytes is not None:
+            self.bytes.take(size)
+        self.allowed += 1
@@ -0,0 +1,165 @@
+"""Bounded per-client outbound queues.
+
+broadcast() only appends to these queues; each client's queue is drained
+by its own writer (a thread in the threaded engine, the selectors loop in
+the event-loop engine), so one slow socket never holds up delivery to the
+others. What happens when a queue is full is decided by the overflow
+policy.
+
+Writers hand everything queued for a client to send_frames(), which
+writes the frames with scatter/gather sendmsg() calls straight from the
+shared frame buffers instead of joining them into one bytes object.
+
+File chunks go in a separate, smaller bulk lane. It is only drained when
+nothing else is queued, and then one chunk at a time, so chat queued
+behind a file transfer waits for at most one chunk. A full bulk lane is
+the caller's problem (put_bulk() just says no) rather than a reason to
+apply the overflow policy.
+"""
+
+import collections
+import itertools
+import os
+import threading
+import time
+
+
+DROP_OLDEST = "drop-oldest"  # discard the oldest queued frame to make room
+DISCONNECT = "disconnect"    # give up on the client
+BLOCK = "block"              # wait up to block_timeout for room, then disconnect
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# Most buffers a single sendmsg() call accepts
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class SendQueue:
+    """Bounded FIFO of encoded frames waiting to be written to one client.
+
+    With blocking=False (event-loop engine) the BLOCK policy can't stall the
+    caller, so it lets the queue run past maxsize for up to block_timeout
+    seconds and only then reports the client as too slow.
+    """
+
+    def __init__(self, maxsize=1024, policy=DROP_OLDEST, block_timeout=2.0, blocking=True, bulk_maxsize=64):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self.frames = collections.deque()
+        self.bulk = collections.deque()
+        self.maxsize = maxsize
+        self.bulk_maxsize = bulk_maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.blocking = blocking
+        self.dropped = 0
+        self.closed = False
+        self.full_since = None
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.frames) + len(self.bulk)
+
+    def put(self, frame):
+        """Queue a frame; returns False if the client should be disconnected"""
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.maxsize and not self._make_room():
+                self.dropped += 1
+                return False
+            self.frames.append(frame)
+            self.condition.notify()
+            return True
+
+    def put_bulk(self, frame, force=False):
+        """Queue a low-priority frame; returns False if the bulk lane is full.
+
+        force=True queues it regardless, for the odd control frame that has
+        to stay in order with the chunks ahead of it.
+        """
+        with self.condition:
+            if self.closed or (len(self.bulk) >= self.bulk_maxsize and not force):
+                return False
+            self.bulk.append(frame)
+            self.condition.notify()
+            return True
+
+    def bulk_full(self):
+        return len(self.bulk) >= self.bulk_maxsize
+
+    def _make_room(self):
+        if self.policy == DROP_OLDEST:
+            self.frames.popleft()
+            self.dropped += 1
+            return True
+        if self.policy == DISCONNECT:
+            return False
+
+        if self.blocking:
+            return self.condition.wait_for(
+                lambda: self.closed or len(self.frames) < self.maxsize, self.block_timeout
+            ) and not self.closed
+
+        now = time.monotonic()
+        if self.full_since is None:
+            self.full_since = now
+        return now - self.full_since < self.block_timeout
+
+    def take(self, block=True):
+        """Remove and return every queued frame, or failing that one bulk frame.
+
+        With block=True this waits until there is at least one frame or the
+        queue is closed; an empty list then means the writer should stop.
+        """
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: self.frames or self.bulk or self.closed)
+            if not self.frames and self.bulk:
+                return [self.bulk.popleft()]
+            frames = list(self.frames)
+            self.frames.clear()
+            self.full_since = None
+            self.condition.notify_all()
+            return frames
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.bulk.clear()
+            self.condition.notify_all()
+
+
+
+def send_frames(sock, frames):
+    """Write a deque of frames until it is empty or the socket takes less than offered.
+
+    Fully written frames are popped; a partly written one is replaced by a
+    memoryview of its unsent tail, so the next call resumes mid-frame
+    without copying. Returns (frames completed, bytes sent). A frame only
+    counts as completed once its last byte is written. BlockingIOError is
+    raised only if nothing at all could be written.
+    """
+    completed = sent = 0
+    while frames:
+        batch = list(itertools.islice(frames, IOV_MAX))
+        try:
+            written = sock.sendmsg(batch)
+        except BlockingIOError:
+            if sent:
+                break
+            raise
+        sent += written
+        for frame in batch:
+            if written < len(frame):
+                if written:
+                    frames[0] = memoryview(frame)[written:]
+                return completed, sent
+            written -= len(frame)
+            frames.popleft()
+            completed += 1
+    return completed, sent
@@ -1,73 +1,1006 @@
+import argparse
+import base64
+import collections
+import errno
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import signal
 import socket
+import sys
 import threading
+import time
 
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_FILE, MAX_STREAM, OFFSET, RECV_SIZE, FrameDecoder,
+                      ProtocolError, chat_frame, control_frame, decode_text, encode_frame, logged_frame,
+                      presence_frame, split_command, split_file)
+from bus import BusLink, open_hub, run_hub
+from federation import Federation, parse_peer
+from handoff import open_handoff, receive_handoff, send_handoff
+from asynclog import LEVELS, AsyncLogger
+from history import HistoryLog
+from metrics import Registry, serve_stats
+from ratelimit import DELAY, DISCONNECT, RATE_LIMIT_ACTIONS, RateLimiter
+from sendqueue import DROP_OLDEST, OVERFLOW_POLICIES, SendQueue, send_frames
+from sessions import SessionRegistry
+from timerwheel import TimerWheel
 
-HOST = '0.0.0.0'  
-PORT = 12345      
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind((HOST, PORT))
-server.listen()
+HOST = '0.0.0.0'
+PORT = 12345
 
-clients = []   
-usernames = {} 
+# Log records are handed to a background writer (see asynclog.py) so
+# formatting and stdout/file I/O stay off the fanout path
+log = None
 
+# Which engine serves the connections: "threaded" (one thread per client)
+# or "eventloop" (every connection multiplexed on one selectors loop)
+ENGINE = "threaded"
 
+server = None
 
-def broadcast(message, sender_socket=None):
-    print(message.decode('utf-8'))
-    for client in clients:
+# Multi-process mode: several workers share PORT through SO_REUSEPORT and
+# relay chat and presence to each other over a local bus
+WORKERS = 1
+BUS_PATH = None
+WORKER_ID = 0
+bus = None
+remote_rosters = {}  # node (worker id or peer server) -> {room: Counter of usernames connected there}
+remote_names = {}    # casefolded username -> Counter of how remote_rosters spell it, for /msg
+
+# Federation: separate servers ("nodes") peer over TCP and relay the same
+# messages as the worker bus, so they act as one chat (see federation.py)
+NODE_ID = None
+PEER_HOST = "127.0.0.1"  # peers on other machines need a routable address here
+PEER_PORT = 0
+PEERS = []
+PEER_SECRET = None       # every node must hold the same one (see federation.py)
+
+# Restarting in place: a server run with --handoff gives its listening
+# socket, connections and sessions to a new process started with
+# --take-over, so nobody has to reconnect (see handoff.py)
+HANDOFF = False
+HANDOFF_PATH = None
+handoff_listener = None
+handed_over = None  # --take-over: (sockets, state) received, until adopt_connections() serves them
+
+# Rooms: every client is in exactly one room and fanout only walks that
+# room's members. Empty rooms are dropped from the index.
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 32
+rooms = {}         # room name -> set of member sockets
+client_rooms = {}  # socket -> room name
+rooms_lock = threading.RLock()
+
+# Presence: joins and leaves are collected per room and sent as one delta
+# update per PRESENCE_INTERVAL instead of a message per event. Clients that
+# joined since the last tick get one roster snapshot per room instead, built
+# once for all of them, so a join storm doesn't sort the roster per joiner
+PRESENCE_INTERVAL = 0.25
+pending_presence = {}  # room -> {"joined": [...], "left": [...]} not yet sent to clients
+pending_rosters = {}   # room -> sockets that joined it and are owed a roster snapshot
+pending_bus_presence = {}  # room -> same, for local changes not yet published to the bus
+presence_lock = threading.Lock()
+
+# Every broadcast is appended to the history log; joining a room replays
+# its last HISTORY_REPLAY messages, and older pages (HISTORY <before_seq>
+# <count>) are served up to HISTORY_PAGE_MAX messages at a time
+HISTORY_DIR = "chat-history"
+HISTORY_REPLAY = 50
+HISTORY_PAGE_MAX = 200
+history = None
+
+# Every connection gets a bounded outbound queue drained by its own writer,
+# so broadcast() never waits on a slow socket
+QUEUE_SIZE = 1024
+OVERFLOW_POLICY = DROP_OLDEST
+BLOCK_TIMEOUT = 2.0
+send_queues = {}  # socket -> SendQueue
+
+# Every user gets a session (see sessions.py) and its token at handshake;
+# usernames are unique across the sessions. When a connection drops the
+# session is parked for SESSION_GRACE seconds: the user stays on the room's
+# roster, and a client that comes back with RESUME <token> <last_seq> takes
+# its place again and is sent only the messages it missed
+SESSION_GRACE = 30.0
+RESUME_REPLAY_MAX = 500
+FINAL_DISCONNECTS = ("quit", "protocol_error", "rate_limited")  # reasons that end a session straight away
+sessions = SessionRegistry()
+parked = {}           # room -> Counter of usernames whose sessions are parked
+parked_expiry = collections.deque()  # (expires, token), oldest first
+
+# Handshakes run off the accept loop; each gets a deadline and only so many
+# may be in flight at once. When accept() fails for want of descriptors or
+# memory the server stops accepting for ACCEPT_BACKOFF and carries on
+LISTEN_BACKLOG = 1024
+ACCEPT_BACKOFF = 0.1
+ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+ACCEPT_ERRORS = ACCEPT_RESOURCE_ERRORS + (errno.ECONNABORTED, errno.EPROTO, errno.EPERM)
+accept_paused_until = 0.0  # event-loop engine: when to start accepting again
+HANDSHAKE_TIMEOUT = 5.0
+MAX_PENDING_HANDSHAKES = 512
+handshake_slots = None  # threaded engine: BoundedSemaphore of MAX_PENDING_HANDSHAKES
+last_handshake_report = [time.monotonic(), 0]  # time of the last report, completed count at that time
+pending_usernames = {}  # socket -> (started, address) for sockets that haven't sent a USERNAME yet
+
+# Heartbeats: a connection that has been quiet for PING_INTERVAL is sent a
+# PING, and one that stays silent for IDLE_TIMEOUT is reaped (its session is
+# parked, so the client can still resume). Handshake and idle deadlines all
+# live in one hashed timer wheel, advanced every TIMER_TICK
+PING_INTERVAL = 20.0
+IDLE_TIMEOUT = 60.0
+TIMER_TICK = 0.5
+timers = TimerWheel(TIMER_TICK, now=time.monotonic())
+last_seen = {}  # socket -> time.monotonic() of the last data received from it
+
+# Flood control: token buckets for messages/sec and bytes/sec per connection
+# and per room (see ratelimit.py), each holding RATE_BURST seconds' worth.
+# Chat counts against both, anything else a client sends only against its
+# connection. RATE_LIMIT_ACTION decides what happens to a message over the
+# limit; messages longer than MAX_MESSAGE_BYTES are always refused, and so
+# are usernames longer than MAX_USERNAME characters at the handshake. A rate
+# of 0 turns that limit off. Each worker or node limits rooms on its own.
+# HISTORY requests read up to HISTORY_PAGE_MAX messages, possibly from
+# disk, so they also count against a much tighter HISTORY_RATE per connection
+MAX_MESSAGE_BYTES = 4096
+MAX_USERNAME = 20
+CLIENT_MESSAGE_RATE = 10.0
+CLIENT_BYTE_RATE = 32 * 1024
+ROOM_MESSAGE_RATE = 1000.0
+ROOM_BYTE_RATE = 4 * 1024 * 1024
+RATE_BURST = 3.0
+HISTORY_RATE = 1.0
+RATE_LIMIT_ACTION = DELAY
+RATE_LIMIT_NOTICE_INTERVAL = 5.0  # tell a limited client at most this often
+client_limits = {}  # socket -> RateLimiter
+room_limits = {}    # room name -> RateLimiter
+history_limits = {}  # socket -> RateLimiter for its HISTORY requests
+
+# File transfers: a client offers a file to its room with FILE and then
+# streams it as FRAME_FILE chunks (filetransfer.py has the whole exchange).
+# Each chunk is relayed as soon as it arrives through every receiver's bulk
+# lane, behind its chat, so the server holds at most BULK_QUEUE_SIZE chunks
+# per receiver and never a whole file. While a receiver's lane is full the
+# sender's chunks are held back like rate-limited ones (so the sender is
+# paced by its receivers), and a receiver that stays full for
+# RECEIVER_STALL_TIMEOUT is dropped from the transfer. Chunks have their own
+# FILE_BYTE_RATE budget and are never dropped. With --workers or peers,
+# files only reach users on the sender's own worker or node
+MAX_FILE_BYTES = 100 * 1024 * 1024
+FILE_CHUNK_MAX = 64 * 1024
+FILE_BYTE_RATE = 2 * 1024 * 1024
+BULK_QUEUE_SIZE = 64
+BULK_RETRY = 0.05
+RECEIVER_STALL_TIMEOUT = 10.0
+uploads = {}     # (sender socket, stream) -> {"id", "file_id", "name", "size", "offset", "receivers"}
+transfer_ids = itertools.count()  # stream ids for relayed transfers, shared by every receiver
+file_limits = {}  # socket -> RateLimiter for its file chunks
+
+# Metrics are always collected (plain integer adds); --stats-port serves
+# them as JSON on a local HTTP endpoint
+STATS_HOST = "127.0.0.1"
+STATS_PORT = 0
+STATS_RETRY = 1.0  # seconds between attempts while the stats port is taken
+registry = Registry()
+messages_in = registry.counter("messages_in")
+bytes_in = registry.counter("bytes_in")
+messages_out = registry.counter("messages_out")
+bytes_out = registry.counter("bytes_out")
+fanout_seconds = registry.histogram("fanout_seconds")
+handshake_seconds = registry.histogram("handshake_seconds")
+connections_accepted = registry.counter("connections_accepted")
+handshakes = registry.labeled_counter("handshakes")
+disconnects = registry.labeled_counter("disconnects")
+sessions_closed = registry.labeled_counter("sessions")  # resumed / expired / replaced
+reaped = registry.labeled_counter("reaped")  # idle / handshake
+rate_limited = registry.labeled_counter("rate_limited")  # <client|room>_<action>, file_delay, oversized
+files = registry.labeled_counter("files")  # offered / completed / cancelled / interrupted / receiver_dropped
+file_bytes = registry.counter("file_bytes_relayed")
+
+# Event-loop engine state
+selector = None
+outgoing = {}              # socket -> deque of frames taken from the send queue but not yet fully written
+writing = set()            # sockets currently registered for EVENT_WRITE
+flush_pending = set()      # sockets that had frames queued during this pass of the loop
+decoders = {}              # socket -> FrameDecoder holding any partially received frame
+throttled = {}             # socket -> frames held back by the delay action; the socket isn't read meanwhile
+throttle_timers = TimerWheel(TIMER_TICK / 5, now=time.monotonic())  # socket -> when to try its held frames again
+
+
+
+def open_send_queue(client):
+    queue = SendQueue(QUEUE_SIZE, OVERFLOW_POLICY, BLOCK_TIMEOUT, blocking=(ENGINE == "threaded"),
+                      bulk_maxsize=BULK_QUEUE_SIZE)
+    send_queues[client] = queue
+    if ENGINE == "threaded":
+        writer = threading.Thread(target=client_writer, args=(client, queue), daemon=True)
+        writer.start()
+    return queue
+
+
+
+def send_to_client(client, message):
+    queue = send_queues.get(client)
+    if queue is None:
+        raise OSError("client has no send queue")
+    if not queue.put(message):
+        log.warning("SLOW CLIENT", f"{sessions.username(client)} can't keep up "
+              f"({queue.dropped} frames dropped), disconnecting.")
+        raise OSError("send queue overflow")
+
+    # Event loop: everything queued for a client during one pass of the
+    # loop goes out together in flush_writes()
+    if ENGINE == "eventloop":
+        flush_pending.add(client)
+
+
+
+def send_bulk(client, frame, force=False):
+    """Queue a file chunk behind the client's chat; returns False if its bulk lane is full"""
+    queue = send_queues.get(client)
+    if queue is None or not queue.put_bulk(frame, force):
+        return False
+    if ENGINE == "eventloop":
+        flush_pending.add(client)
+    return True
+
+
+
+def client_writer(client, queue):
+    """Threaded engine: drain one client's send queue until it is closed"""
+    pending = collections.deque()
+    while True:
+        frames = queue.take()
+        if not frames:
+            return
+        pending.extend(frames)
+        try:
+            while pending:
+                completed, sent = send_frames(client, pending)
+                messages_out.inc(completed)
+                bytes_out.inc(sent)
+        except OSError:
+            remove_client(client, "write_error")
+            return
+
+
+
+def publish_to_bus(message):
+    try:
+        bus.publish(message)
+    except OSError as e:
+        log.error("BUS ERROR", f"Could not publish to the bus: {e}")
+
+
+
+def broadcast(message, sender_socket=None, room=DEFAULT_ROOM, relay=True):
+    log.info("CHAT", ("#", room, " ", message))
+    if relay and bus is not None:
+        publish_to_bus({"kind": "chat", "room": room, "text": message.decode('utf-8')})
+    if history is not None:
+        frame = logged_frame(history.append(room, message), message)
+    else:
+        frame = chat_frame(message)
+    # Encoded once; every recipient's queue holds a view of the same buffer
+    frame = memoryview(frame)
+    started = time.perf_counter()
+    for client in list(rooms.get(room, ())):
         if client != sender_socket:
             try:
-                client.send(message)
+                send_to_client(client, frame)
+            except:
+                remove_client(client, "slow_consumer")
+    fanout_seconds.observe(time.perf_counter() - started)
+
+
+
+def room_user_count(room):
+    return (len(rooms.get(room, ())) + sum(parked.get(room, {}).values())
+            + sum(sum(roster.get(room, {}).values()) for roster in remote_rosters.values()))
+
+
+
+def local_roster(room):
+    """Usernames in a room on this server, counting parked sessions"""
+    names = [sessions.username(client) for client in list(rooms.get(room, ()))]
+    names.extend(parked.get(room, collections.Counter()).elements())
+    return names
+
+
+
+def room_roster(room):
+    names = local_roster(room)
+    for roster in remote_rosters.values():
+        names.extend(roster.get(room, collections.Counter()).elements())
+    return sorted(names)
+
+
+
+def queue_presence(room, joined=(), left=(), relay=True):
+    """Record joins/leaves for a room; they go out with the next presence tick"""
+    if not joined and not left:
+        return  # e.g. a roster re-announced on link-up that holds no news
+    with presence_lock:
+        targets = [pending_presence]
+        if relay and bus is not None:
+            targets.append(pending_bus_presence)
+        for pending in targets:
+            change = pending.setdefault(room, {"joined": [], "left": []})
+            change["joined"].extend(joined)
+            change["left"].extend(left)
+
+
+
+def flush_presence():
+    """Send every room with pending changes one delta update: count plus who joined and left.
+
+    Clients that have just joined get the room's roster instead, which
+    already includes this tick's changes.
+    """
+    with presence_lock:
+        changes = dict(pending_presence)
+        bus_changes = dict(pending_bus_presence)
+        joiners = dict(pending_rosters)
+        pending_presence.clear()
+        pending_bus_presence.clear()
+        pending_rosters.clear()
+
+    for room, change in bus_changes.items():
+        publish_to_bus({"kind": "presence", "room": room, **change})
+
+    for room, waiting in joiners.items():
+        waiting = [client for client in waiting if client_rooms.get(client) == room]
+        if not waiting:
+            continue
+        snapshot = memoryview(roster_frame(room))
+        for client in waiting:
+            try:
+                send_to_client(client, snapshot)
+            except:
+                remove_client(client, "slow_consumer")
+
+    for room, change in changes.items():
+        update = memoryview(presence_frame(json.dumps({"room": room, "count": room_user_count(room), **change})))
+        waiting = joiners.get(room, ())
+        for client in list(rooms.get(room, ())):
+            if client in waiting:
+                continue
+            try:
+                send_to_client(client, update)
             except:
-                remove_client(client, broadcast_departure=False)
+                remove_client(client, "slow_consumer")
+
+
+
+def presence_ticker():
+    """Threaded engine: flush coalesced presence every PRESENCE_INTERVAL"""
+    while True:
+        time.sleep(PRESENCE_INTERVAL)
+        expire_sessions()
+        flush_presence()
+
+
+
+def roster_frame(room):
+    roster = room_roster(room)
+    return presence_frame(json.dumps({"room": room, "count": len(roster), "roster": roster}))
+
+
+
+def send_roster(client, room):
+    """Send one client the full roster of a room"""
+    send_to_client(client, roster_frame(room))
+
+
+
+# What each kind of bus message has to carry. Anything else (a peer
+# running other code, or one sending junk) is dropped before it's applied
+BUS_MESSAGE_FIELDS = {
+    "chat": {"room": str, "text": str},
+    "presence": {"room": str, "joined": list, "left": list},
+    "roster": {"room": str, "users": list},
+    "direct": {"to": str, "from": str, "text": str},
+    "hello": {},
+    "down": {"nodes": list},
+}
 
 
 
-def broadcast_user_count():
-    user_count_message = f"USER_COUNT:{len(clients)}\n".encode('utf-8')
-    for client in clients:
+def valid_bus_message(message):
+    kind = message.get("kind")
+    fields = BUS_MESSAGE_FIELDS.get(kind)
+    if fields is None:
+        return False
+    # "down" comes from the hub or our own federation thread, which don't sign it with a node
+    if kind != "down" and not isinstance(message.get("node"), (str, int)):
+        return False
+    for name, expected in fields.items():
+        value = message.get(name)
+        if not isinstance(value, expected):
+            return False
+        if name == "room" and not valid_room_name(value):
+            return False
+        # Names in lists are usernames, except "down", whose nodes may be worker ids
+        if expected is list and not all(isinstance(item, (str, int) if name == "nodes" else str) for item in value):
+            return False
+    return True
+
+
+
+def apply_bus_messages(messages):
+    for message in messages:
+        if not valid_bus_message(message):
+            log.warning("BUS", f"Dropped a malformed {message.get('kind')!r} message from {message.get('node')!r}.")
+            continue
         try:
-            client.send(user_count_message)
-        except:
-            remove_client(client, broadcast_departure=False)
+            handle_bus_message(message)
+        except Exception as e:
+            log.error("BUS ERROR", f"Couldn't apply a {message['kind']} message: {type(e).__name__}: {e}")
+
+
+
+def handle_bus_message(message):
+    """Apply chat, presence or a direct message published by another worker or node"""
+    kind = message.get("kind")
+    node = message.get("node")
+    if kind == "chat":
+        broadcast(message["text"].encode('utf-8'), room=message["room"], relay=False)
+    elif kind == "presence":
+        roster = remote_rosters.setdefault(node, {}).setdefault(message["room"], collections.Counter())
+        roster.update(message["joined"])
+        index_remote_names(message["joined"])
+        gone = []
+        for name in message["left"]:
+            if roster[name] > 0:
+                roster[name] -= 1
+                if not roster[name]:
+                    del roster[name]
+                gone.append(name)
+        index_remote_names(gone, -1)
+        queue_presence(message["room"], message["joined"], message["left"], relay=False)
+    elif kind == "roster":
+        # Announced again whenever a node or link comes up; only the difference is news
+        rosters = remote_rosters.setdefault(node, {})
+        old = rosters.get(message["room"], collections.Counter())
+        new = rosters[message["room"]] = collections.Counter(message["users"])
+        joined, left = list((new - old).elements()), list((old - new).elements())
+        index_remote_names(joined)
+        index_remote_names(left, -1)
+        queue_presence(message["room"], joined, left, relay=False)
+    elif kind == "direct":
+        target = sessions.find(message["to"])
+        if target is not None:
+            deliver_direct(target, message["from"], message["text"])
+    elif kind == "hello":
+        # A worker or node just came up (or lost track of us): send our full roster for every room
+        for room in set(rooms) | set(parked):
+            publish_to_bus({"kind": "roster", "room": room, "users": local_roster(room)})
+    elif kind == "down":
+        for gone in message["nodes"]:
+            for room, roster in remote_rosters.pop(gone, {}).items():
+                index_remote_names(roster.elements(), -1)
+                queue_presence(room, left=list(roster.elements()), relay=False)
+
+
+
+def index_remote_names(names, change=1):
+    """Count names in or out of remote_names as remote rosters gain or lose them"""
+    for name in names:
+        key = name.casefold()
+        spellings = remote_names.setdefault(key, collections.Counter())
+        spellings[name] += change
+        if spellings[name] <= 0:
+            del spellings[name]
+            if not spellings:
+                del remote_names[key]
+
+
 
+def lost_bus(error):
+    # A worker cut off from the others would report wrong counts and
+    # silently split the chat, so it stops instead
+    log.error("BUS ERROR", f"Lost the bus ({error}), stopping worker {WORKER_ID}.")
+    log.close()
+    os._exit(1)
 
 
-def handle_client(client):
+
+def bus_reader():
+    """Threaded engine: apply messages from the bus as they arrive"""
     while True:
         try:
-            message = client.recv(1024)
-            if not message:
+            messages = bus.receive()
+        except (OSError, ProtocolError) as e:
+            lost_bus(e)
+        apply_bus_messages(messages)
+
+
+
+def valid_room_name(room):
+    return 0 < len(room) <= MAX_ROOM_NAME and room.isprintable() and " " not in room
+
+
+
+def join_room(client, room, resume_after=None):
+    """Add a registered client to a room's member set and tell it where it is.
+
+    Its roster arrives with the next presence tick. A resumed session is
+    already on the roster, so it is not announced and only gets the
+    messages after resume_after instead of the usual replay.
+    """
+    with rooms_lock:
+        rooms.setdefault(room, set()).add(client)
+        client_rooms[client] = room
+    send_to_client(client, control_frame(f"ROOM {room}"))
+    with presence_lock:
+        pending_rosters.setdefault(room, set()).add(client)
+    if resume_after is None:
+        replay_history(client, room)
+        queue_presence(room, joined=[sessions.username(client)])
+    else:
+        replay_missed(client, room, resume_after)
+
+
+
+def replay_history(client, room):
+    """Send a room's recent messages to one client as a single batched write"""
+    if history is None or HISTORY_REPLAY <= 0:
+        return
+    records = history.recent(room, HISTORY_REPLAY)
+    if records:
+        send_to_client(client, b"".join(logged_frame(seq, text) for seq, timestamp, room, text in records))
+
+
+
+def replay_missed(client, room, seq):
+    """Send a resumed client the room's messages after seq (at most RESUME_REPLAY_MAX, the newest)"""
+    if history is None:
+        return
+    records = history.after(room, seq, RESUME_REPLAY_MAX)
+    if records:
+        send_to_client(client, b"".join(logged_frame(seq, text) for seq, timestamp, room, text in records))
+
+
+
+def send_history_page(client, argument):
+    """Answer HISTORY <before_seq> [count] with `HISTORY <n>` followed by n older messages.
+
+    Both go out as one write so live chat can't land in the middle of the
+    page; n is 0 once there is nothing older.
+    """
+    if history is None:
+        send_to_client(client, control_frame("ERROR History is disabled on this server"))
+        return
+    try:
+        before_seq, _, count = argument.partition(" ")
+        before_seq = int(before_seq)
+        count = min(int(count or HISTORY_PAGE_MAX), HISTORY_PAGE_MAX)
+    except ValueError:
+        send_to_client(client, control_frame("ERROR Usage: /history <before_seq> [count]"))
+        return
+    records = history.before(client_rooms.get(client, DEFAULT_ROOM), before_seq, count) if count > 0 else []
+    send_to_client(client, control_frame(f"HISTORY {len(records)}") +
+                   b"".join(logged_frame(seq, text) for seq, timestamp, room, text in records))
+
+
+
+def send_direct(client, argument):
+    """MSG <user> <text>: deliver to that one user's connection, found by name, instead of the room"""
+    username, _, text = argument.partition(" ")
+    if not username or not text.strip():
+        send_to_client(client, control_frame("ERROR Usage: /msg <user> <message>"))
+        return
+    sender = sessions.username(client)
+    target = sessions.find(username)
+    if target is None:
+        name = remote_user(username)
+        if name is None:
+            send_to_client(client, control_frame(f"ERROR There is nobody called {username} here"))
+        else:
+            publish_to_bus({"kind": "direct", "to": name, "from": sender, "text": text})
+        return
+    if not deliver_direct(target, sender, text):
+        send_to_client(client, control_frame(f"ERROR {target.username} is reconnecting, try again in a moment"))
+
+
+
+def deliver_direct(target, sender, text):
+    """Queue a direct message for a session; returns False if it has no connection right now"""
+    recipient = target.client
+    if recipient is None:
+        return False
+    log.info("DIRECT", f"{sender} -> {target.username}")
+    try:
+        send_to_client(recipient, control_frame(f"MSG {sender} {text}"))
+    except OSError:
+        remove_client(recipient, "slow_consumer")
+    return True
+
+
+
+def start_upload(client, argument):
+    """Answer FILE <stream> <file_id> <size> <name>: offer the file to the room and accept it, or refuse it"""
+    parts = argument.split(" ", 3)
+    if len(parts) < 4 or not parts[0].isdigit() or not parts[1].isalnum() or not parts[2].isdigit():
+        send_to_client(client, control_frame("ERROR Usage: FILE <stream> <file_id> <size> <name>"))
+        return
+    stream, file_id, size, name = int(parts[0]), parts[1], int(parts[2]), parts[3]
+    room = client_rooms.get(client, DEFAULT_ROOM)
+    with rooms_lock:
+        receivers = set(rooms.get(room, ()))
+    receivers.discard(client)
+
+    refusal = None
+    if not MAX_FILE_BYTES:
+        refusal = "File transfer is disabled on this server"
+    elif not 0 < stream <= MAX_STREAM or (client, stream) in uploads:
+        refusal = "Bad stream id"
+    elif not 0 < size <= MAX_FILE_BYTES:
+        refusal = f"Files must be 1 to {MAX_FILE_BYTES} bytes"
+    elif not receivers:
+        refusal = f"Nobody else is in #{room}"
+    if refusal:
+        send_to_client(client, control_frame(f"FILE_CANCEL {stream} {refusal}"))
+        return
+
+    # Carry on where an interrupted upload of the same file left off
+    session = sessions.of(client)
+    offset = session.uploads.get(file_id, 0) if session is not None else 0
+    if offset >= size:
+        # Finished before the sender's connection dropped; only FILE_DONE went missing
+        send_to_client(client, control_frame(f"FILE_DONE {stream} 0"))
+        return
+    transfer = {"id": next(transfer_ids) % MAX_STREAM + 1, "file_id": file_id, "name": name, "size": size,
+                "offset": offset, "receivers": receivers, "stalled_since": None}
+    uploads[(client, stream)] = transfer
+    files.inc("offered")
+    sender = sessions.username(client)
+    log.info("FILE", f"{sender} is sending {name} ({size} bytes) to #{room}, from byte {transfer['offset']}.")
+
+    offer = memoryview(control_frame(f"FILE {transfer['id']} {file_id} {size} {transfer['offset']} {sender} {name}"))
+    for receiver in list(receivers):
+        try:
+            send_to_client(receiver, offer)
+        except OSError:
+            receivers.discard(receiver)
+    send_to_client(client, control_frame(f"FILE_ACCEPT {stream} {transfer['offset']}"))
+
+
+
+def relay_chunk(client, stream, payload):
+    """Pass one chunk straight on to every receiver of the upload it belongs to"""
+    transfer = uploads.get((client, stream))
+    if transfer is None:
+        return  # refused, cancelled, or a late chunk from before a reconnect
+    offset, data = split_file(payload)
+    if offset != transfer["offset"] or offset + len(data) > transfer["size"]:
+        end_upload(client, stream, "cancelled", "Chunk out of order")
+        send_to_client(client, control_frame(f"FILE_CANCEL {stream} Chunk out of order"))
+        return
+
+    # Re-encoded once for the relay stream id; every receiver gets a view of the same buffer
+    frame = memoryview(encode_frame(FRAME_FILE, payload, transfer["id"]))
+    for receiver in list(transfer["receivers"]):
+        if not send_bulk(receiver, frame):
+            drop_receiver(transfer, receiver)
+    transfer["offset"] += len(data)
+    file_bytes.inc(len(data))
+    if transfer["offset"] == transfer["size"]:
+        session = sessions.of(client)
+        if session is not None:
+            session.uploads[transfer["file_id"]] = transfer["size"]
+        end_upload(client, stream, "completed")
+
+
+
+def drop_receiver(transfer, receiver):
+    transfer["receivers"].discard(receiver)
+    files.inc("receiver_dropped")
+    send_bulk(receiver, control_frame(f"FILE_ABORT {transfer['id']} Too slow to keep up"), force=True)
+
+
+
+def end_upload(client, stream, outcome, reason=None):
+    """Finish or abandon an upload.
+
+    Receivers are told through the bulk lane, so the notice arrives after
+    every chunk already queued for them.
+    """
+    transfer = uploads.pop((client, stream), None)
+    if transfer is None:
+        return
+    files.inc(outcome)
+    if outcome == "completed":
+        log.info("FILE", f"{sessions.username(client)} sent {transfer['name']} "
+                 f"to {len(transfer['receivers'])} user(s).")
+        send_to_client(client, control_frame(f"FILE_DONE {stream} {len(transfer['receivers'])}"))
+        return
+    notice = memoryview(control_frame(f"FILE_ABORT {transfer['id']} {reason}"))
+    for receiver in list(transfer["receivers"]):
+        send_bulk(receiver, notice, force=True)
+
+
+
+def drop_transfers(client, session):
+    """A connection went away: abandon its uploads, keeping their progress in the session for a resume"""
+    for (sender, stream), transfer in list(uploads.items()):
+        if sender is client:
+            session.uploads[transfer["file_id"]] = transfer["offset"]
+            end_upload(client, stream, "interrupted", "The sender disconnected")
+        else:
+            transfer["receivers"].discard(client)
+
+
+
+def leave_room(client, announce_as=None):
+    """Take a client out of its room, announcing announce_as as having left; returns the room it was in"""
+    with rooms_lock:
+        room = client_rooms.pop(client, None)
+        members = rooms.get(room)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del rooms[room]
+                room_limits.pop(room, None)
+    if room is not None and announce_as is not None:
+        queue_presence(room, left=[announce_as])
+    return room
+
+
+
+def move_to_room(client, room):
+    username = sessions.username(client)
+    old_room = client_rooms.get(client)
+    if room == old_room:
+        return
+    leave_room(client, announce_as=username)
+    join_room(client, room)
+    log.info("ROOM", f"{username} moved from #{old_room} to #{room}.")
+
+
+
+def handle_control(client, command, argument):
+    if command == "JOIN":
+        if valid_room_name(argument):
+            move_to_room(client, argument)
+        else:
+            send_to_client(client, control_frame(f"ERROR Room names are 1-{MAX_ROOM_NAME} characters without spaces"))
+    elif command == "LEAVE":
+        move_to_room(client, DEFAULT_ROOM)
+    elif command == "ROSTER":
+        send_roster(client, client_rooms.get(client, DEFAULT_ROOM))
+    elif command == "HISTORY":
+        send_history_page(client, argument)
+    elif command == "MSG":
+        send_direct(client, argument)
+    elif command == "FILE":
+        start_upload(client, argument)
+    elif command == "FILE_CANCEL":
+        stream = argument.partition(" ")[0]
+        if stream.isdigit():
+            end_upload(client, int(stream), "cancelled", "Cancelled by the sender")
+    elif command == "PING":
+        send_to_client(client, control_frame("PONG"))
+    elif command == "QUIT":
+        # Leaving on purpose: end the session now rather than after the grace period
+        remove_client(client, "quit")
+    # PONG needs no reply: receiving it already counts as activity
+
+
+
+def handle_frame(client, frame_type, payload, stream=0):
+    if frame_type == FRAME_CHAT:
+        message = bytes(payload)
+        decode_text(message)  # relayed as is, so it has to be text every client can show
+        broadcast(message, sender_socket=client, room=client_rooms.get(client, DEFAULT_ROOM))
+    elif frame_type == FRAME_CONTROL:
+        command, argument = split_command(payload)
+        handle_control(client, command, argument)
+    elif frame_type == FRAME_FILE:
+        relay_chunk(client, stream, payload)
+
+
+
+def new_limiter(message_rate, byte_rate, now):
+    # The byte bucket always has room for one message of the maximum size
+    return RateLimiter(message_rate, max(message_rate * RATE_BURST, 1),
+                       byte_rate, max(byte_rate * RATE_BURST, MAX_MESSAGE_BYTES), now)
+
+
+
+def admit(client, frame_type, payload, stream=0):
+    """Check a frame against the rate limits; returns 0 to handle it now, seconds to hold it for, or None to discard it"""
+    size = len(payload)
+    if frame_type == FRAME_FILE:
+        return admit_chunk(client, stream, size)
+    if size > MAX_MESSAGE_BYTES:
+        rate_limited.inc("oversized")
+        send_to_client(client, control_frame(f"ERROR Message too long (the limit is {MAX_MESSAGE_BYTES} bytes)"))
+        return None
+
+    now = time.monotonic()
+    limiter = client_limits.get(client)
+    if limiter is None:
+        limiter = client_limits[client] = new_limiter(CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE, now)
+    limiters = [("client", limiter)]
+    if frame_type == FRAME_CHAT:
+        room = client_rooms.get(client, DEFAULT_ROOM)
+        room_limiter = room_limits.get(room)
+        if room_limiter is None:
+            room_limiter = room_limits[room] = new_limiter(ROOM_MESSAGE_RATE, ROOM_BYTE_RATE, now)
+        limiters.append(("room", room_limiter))
+    elif frame_type == FRAME_CONTROL and bytes(payload).upper().split(None, 1)[:1] == [b"HISTORY"]:
+        history_limiter = history_limits.get(client)
+        if history_limiter is None:
+            history_limiter = history_limits[client] = new_limiter(HISTORY_RATE, 0, now)
+        limiters.append(("history", history_limiter))
+
+    wait, scope, tripped = 0.0, None, None
+    for name, candidate in limiters:
+        candidate_wait = candidate.wait(size, now)
+        if candidate_wait > wait:
+            wait, scope, tripped = candidate_wait, name, candidate
+    if not wait:
+        for name, candidate in limiters:
+            candidate.take(size)
+        return 0.0
+
+    tripped.limited += 1
+    rate_limited.inc(f"{scope}_{RATE_LIMIT_ACTION}")
+    username = sessions.username(client)
+    if RATE_LIMIT_ACTION == DISCONNECT:
+        log.warning("RATE LIMIT", f"{username} went over the {scope} rate limit, disconnecting.")
+        remove_client(client, "rate_limited")
+        return None
+    if now - limiter.last_notice >= RATE_LIMIT_NOTICE_INTERVAL:
+        limiter.last_notice = now
+        log.info("RATE LIMIT", f"{username} is over the {scope} rate limit.")
+        action = "held back" if RATE_LIMIT_ACTION == DELAY else "dropped"
+        send_to_client(client, control_frame(f"ERROR You are sending too fast, messages are being {action}"))
+    return wait if RATE_LIMIT_ACTION == DELAY else None
+
+
+
+def admit_chunk(client, stream, size):
+    """admit() for file chunks: they are only ever delayed, as a gap would spoil the file.
+
+    Chunks wait for the sender's file byte budget, and for any receiver
+    whose bulk lane is full to drain, up to RECEIVER_STALL_TIMEOUT.
+    """
+    if size > FILE_CHUNK_MAX + OFFSET.size:
+        rate_limited.inc("oversized")
+        send_to_client(client, control_frame(f"ERROR File chunks are limited to {FILE_CHUNK_MAX} bytes"))
+        return None
+    now = time.monotonic()
+    transfer = uploads.get((client, stream))
+    if transfer is not None:
+        full = [receiver for receiver in list(transfer["receivers"])
+                if receiver in send_queues and send_queues[receiver].bulk_full()]
+        if full:
+            if transfer["stalled_since"] is None:
+                transfer["stalled_since"] = now
+            if now - transfer["stalled_since"] < RECEIVER_STALL_TIMEOUT:
+                return BULK_RETRY
+            for receiver in full:
+                drop_receiver(transfer, receiver)
+        transfer["stalled_since"] = None
+
+    limiter = file_limits.get(client)
+    if limiter is None:
+        limiter = file_limits[client] = new_limiter(0, FILE_BYTE_RATE, now)
+    wait = limiter.wait(size, now)
+    if wait:
+        limiter.limited += 1
+        rate_limited.inc("file_delay")
+        return wait
+    limiter.take(size)
+    return 0.0
+
+
+
+def handle_client(client, decoder, frames=()):
+    reason = "closed"
+    while True:
+        try:
+            for frame_type, stream, payload in frames:
+                if client not in send_queues:
+                    return  # removed while handling an earlier frame
+                wait = admit(client, frame_type, payload, stream)
+                while wait:
+                    # Delay action: not reading meanwhile pushes back on the sender through TCP
+                    time.sleep(wait)
+                    if client not in send_queues:
+                        return
+                    last_seen[client] = time.monotonic()  # held back, not idle
+                    wait = admit(client, frame_type, payload, stream)
+                if wait is not None:
+                    handle_frame(client, frame_type, payload, stream)
+            data = client.recv(RECV_SIZE)
+            if not data:
                 break
-            broadcast(message, sender_socket=client)
+            last_seen[client] = time.monotonic()
+            bytes_in.inc(len(data))
+            frames = decoder.feed(data)
+            messages_in.inc(len(frames))
+        except ProtocolError as e:
+            log.warning("PROTOCOL ERROR", f"{sessions.username(client)}: {e}")
+            reason = "protocol_error"
+            break
         except:
+            reason = "read_error"
             break
-    remove_client(client)
+    remove_client(client, reason)
+
 
 
+def hello_from_frames(frames):
+    """Find the client's USERNAME or RESUME reply; returns ((command, argument), frames that came after it)"""
+    for index, (frame_type, stream, payload) in enumerate(frames):
+        if frame_type == FRAME_CONTROL:
+            command, argument = split_command(payload)
+            # An empty USERNAME is still an answer, and gets refused as a name
+            if command == "USERNAME" or (command == "RESUME" and argument):
+                return (command, argument), frames[index + 1:]
+    return None, []
 
-def remove_client(client, broadcast_departure=True):
+
+
+def receive_hello(client, decoder):
+    while True:
+        data = client.recv(RECV_SIZE)
+        if not data:
+            return None, []
+        hello, frames = hello_from_frames(decoder.feed(data))
+        if hello:
+            return hello, frames
+
+
+
+def remove_client(client, reason="closed"):
     try:
-        if client in clients:
-            username = usernames.get(client, "Unknown")
-            print(f"[DISCONNECT] {username} left the chat.")
-            if broadcast_departure:
-                broadcast(f"{username} has left the chat.\n".encode('utf-8'))
-            clients.remove(client)
-            usernames.pop(client, None)
+        if ENGINE == "eventloop":
+            forget_socket(client)
+        timers.cancel(client)
+        last_seen.pop(client, None)
+        client_limits.pop(client, None)
+        history_limits.pop(client, None)
+        file_limits.pop(client, None)
+        queue = send_queues.pop(client, None)
+        if queue is not None:
+            queue.close()
 
-            broadcast_user_count()
-        
+        # Only the first removal of a registered connection finds its session
+        session = sessions.detach(client)
+        if session is not None:
+            username = session.username
+            dropped = f" ({queue.dropped} frames dropped)" if queue is not None and queue.dropped else ""
+            disconnects.inc(reason)
+            drop_transfers(client, session)
+            if SESSION_GRACE > 0 and reason not in FINAL_DISCONNECTS:
+                park_session(client, session)
+                log.info("DISCONNECT", f"{username} dropped, holding the session for {SESSION_GRACE:g}s.{dropped}")
+            else:
+                sessions.close(session)
+                log.info("DISCONNECT", f"{username} left the chat.{dropped}")
+                # The room's next presence update tells everyone who left
+                leave_room(client, announce_as=username)
 
+
+        try:
+            # shutdown() first: close() alone doesn't wake a thread blocked in recv() on this socket
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         try:
             client.close()
         except:
-            pass  
+            pass
     except Exception as e:
 
-        print(f"[ERROR] Error removing client: {e}")
+        log.error("ERROR", f"Error removing client: {e}")
 
         try:
             client.close()
@@ -76,26 +1009,1129 @@ def remove_client(client, broadcast_departure=True):
 
 
 
-def start():
-    print(f"[STARTING] Server running on {HOST}:{PORT}")
+def register_username(client, username):
+    """Open a session for a new user; returns None, or why it was refused after hanging up"""
+    if len(username) > MAX_USERNAME:
+        log.info("USERNAME REFUSED", f"Refused a username of {len(username)} characters.")
+        refuse_username(client, f"ERROR Usernames are limited to {MAX_USERNAME} characters")
+        return "bad_name"
+    if not valid_username(username):
+        log.info("USERNAME REFUSED", f"Refused the username {username!r}.")
+        refuse_username(client, "ERROR Usernames can't be empty or contain spaces or control characters")
+        return "bad_name"
+    session = None if remote_user(username) else sessions.open(username, client)
+    if session is None:
+        log.info("USERNAME TAKEN", f"Refused a second {username}.")
+        refuse_username(client, f"USERNAME_TAKEN {username}")
+        return "name_taken"
+    send_to_client(client, control_frame(f"SESSION {session.token}"))
+    join_room(client, DEFAULT_ROOM)
+
+    log.info("USERNAME SET", f"{username} joined the chat.")
+    return None
+
+
+
+def valid_username(username):
+    # One word, so it can be addressed with /msg and sits in MSG and FILE lines as a single field
+    return bool(username) and username.isprintable() and not any(char.isspace() for char in username)
+
+
+
+def refuse_username(client, reply):
+    try:
+        # Straight to the socket: the connection is closed right after
+        client.send(control_frame(reply))
+    except OSError:
+        pass
+    remove_client(client)
+
+
+
+def remote_user(username):
+    """The name as another worker's roster has it (compared casefolded), or None"""
+    spellings = list(remote_names.get(username.casefold(), ()))
+    return spellings[0] if spellings else None
+
+
+
+def park_session(client, session):
+    """Keep a dropped client's session (and its place on the roster) for SESSION_GRACE seconds"""
+    room = leave_room(client)
+    expires = time.monotonic() + SESSION_GRACE
+    with sessions.lock:
+        if session.client is not None:
+            return  # resumed on a new connection in the meantime
+        session.room = room
+        session.expires = expires
+        session.seq = history.next_seq - 1 if history is not None else 0
+        parked.setdefault(room, collections.Counter())[session.username] += 1
+        parked_expiry.append((expires, session.token))
+
+
+
+def unpark(session):
+    """Take a parked session off its room's roster (caller holds sessions.lock)"""
+    names = parked.get(session.room)
+    if names is not None:
+        names[session.username] -= 1
+        names += collections.Counter()  # drop names that reached zero
+        if names:
+            parked[session.room] = names
+        else:
+            del parked[session.room]
+
+
+
+def resume_session(client, argument):
+    """RESUME <token> [last_seq]: put a returning client back into its session.
+
+    Returns False if the token is unknown or has expired, so the caller can
+    fall back to a fresh USERNAME handshake. A session whose old connection
+    the server still thinks is alive takes over from that connection.
+    """
+    token, _, last_seq = argument.partition(" ")
+    with sessions.lock:
+        session = sessions.get(token)
+        if session is None:
+            return False
+        if session.client is None:
+            unpark(session)
+        else:
+            session.room = client_rooms.get(session.client, DEFAULT_ROOM)
+        old_client = sessions.attach(session, client)
+    if old_client is not None:
+        # The old connection is no longer the session's, so removing it
+        # leaves the session alone; its uploads' progress is kept first
+        disconnects.inc("replaced")
+        drop_transfers(old_client, session)
+        leave_room(old_client)
+        remove_client(old_client, "replaced")
+        log.info("DISCONNECT", f"{session.username}'s old connection was replaced.")
+        sessions_closed.inc("replaced")
+    else:
+        sessions_closed.inc("resumed")
+
+    try:
+        resume_after = int(last_seq)
+    except ValueError:
+        resume_after = 0
+    send_to_client(client, control_frame(f"SESSION {token}"))
+    # Without a sequence number of its own the client gets what it missed since the drop
+    join_room(client, session.room or DEFAULT_ROOM, resume_after or session.seq)
+    log.info("RESUMED", f"{session.username} is back.")
+    return True
+
+
+
+def expire_sessions():
+    """End parked sessions whose grace period is over; returns seconds until the next one expires"""
+    now = time.monotonic()
+    expired = []
+    with sessions.lock:
+        while parked_expiry:
+            expires, token = parked_expiry[0]
+            if expires > now:
+                break
+            parked_expiry.popleft()
+            session = sessions.get(token)
+            if session is None or session.client is not None or session.expires != expires:
+                continue  # resumed (and maybe parked again) since
+            sessions.close(session)
+            unpark(session)
+            expired.append(session)
+        next_expiry = parked_expiry[0][0] - now if parked_expiry else None
+
+    for session in expired:
+        sessions_closed.inc("expired")
+        log.info("DISCONNECT", f"{session.username} left the chat (session expired).")
+        queue_presence(session.room, left=[session.username])
+    return next_expiry
+
+
+
+def watch_connection(client):
+    """Start the heartbeat for a client that has finished its handshake"""
+    now = time.monotonic()
+    last_seen[client] = now
+    intervals = [interval for interval in (PING_INTERVAL, IDLE_TIMEOUT) if interval > 0]
+    if intervals:
+        timers.schedule(client, now + min(intervals))
+
+
+
+def run_timers():
+    """Fire due handshake and idle deadlines; returns seconds until the next timer tick"""
+    now = time.monotonic()
+    for client, deadline in timers.advance(now):
+        pending = pending_usernames.pop(client, None)
+        if pending is not None:
+            started, address = pending
+            log.warning("HANDSHAKE TIMEOUT", f"{address} never sent a username.")
+            note_handshake("timed_out", started)
+            reaped.inc("handshake")
+            if ENGINE == "eventloop":
+                remove_client(client)
+            else:
+                # Wakes the handshake thread, which closes the socket itself
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            continue
+
+        seen = last_seen.get(client)
+        if seen is None:
+            continue  # already removed, or still between handshake and watch_connection()
+        idle = now - seen
+        if IDLE_TIMEOUT > 0 and idle >= IDLE_TIMEOUT:
+            log.info("IDLE", f"{sessions.username(client)} silent for {idle:.0f}s, disconnecting.")
+            reaped.inc("idle")
+            remove_client(client, "idle")
+            continue
+
+        if PING_INTERVAL > 0 and idle >= PING_INTERVAL:
+            try:
+                send_to_client(client, control_frame("PING"))
+            except OSError:
+                remove_client(client, "slow_consumer")
+                continue
+            wake = now + PING_INTERVAL
+        else:
+            wake = seen + (PING_INTERVAL if PING_INTERVAL > 0 else IDLE_TIMEOUT)
+        if IDLE_TIMEOUT > 0:
+            wake = min(wake, seen + IDLE_TIMEOUT)
+        timers.schedule(client, wake)
+    return timers.next_timeout(now)
+
+
+
+def note_handshake(outcome, started=None):
+    handshakes.inc(outcome)
+    if started is not None:
+        handshake_seconds.observe(time.monotonic() - started)
+
+    # Report the join rate at most once a second
+    now = time.monotonic()
+    elapsed = now - last_handshake_report[0]
+    if elapsed >= 1.0:
+        counts = handshakes.values
+        joins = counts["completed"] - last_handshake_report[1]
+        log.info("HANDSHAKES", f"{joins / elapsed:.0f} joins/s, {counts['timed_out']} timed out, "
+              f"{counts['rejected']} rejected, {len(sessions)} online")
+        last_handshake_report[:] = [now, counts["completed"]]
+
+
+
+def handshake(client, address, decoder=None, greeting=None):
+    """Threaded engine: run the USERNAME exchange off the accept loop, then serve the client.
+
+    A connection handed over mid-handshake brings its decoder, and as
+    greeting whatever of the USERNAME prompt hadn't been written yet.
+    """
+    if decoder is None:
+        decoder, greeting = FrameDecoder(), control_frame("USERNAME")
+    hello, frames = None, []
+    started = time.monotonic()
+    # If the deadline passes first, run_timers() shuts the socket down under us
+    pending_usernames[client] = (started, address)
+    timers.schedule(client, started + HANDSHAKE_TIMEOUT)
+    try:
+        if greeting:
+            client.sendall(greeting)
+        while True:
+            hello, frames = receive_hello(client, decoder)
+            if hello is None or hello[0] == "USERNAME" or sessions.get(hello[1].partition(" ")[0]) is not None:
+                break
+            # Unknown or expired session: ask for a username and start over
+            client.sendall(control_frame("USERNAME"))
+    except (OSError, ProtocolError):
+        hello = None
+    finally:
+        handshake_slots.release()
+
+    if pending_usernames.pop(client, None) is None:
+        # Timed out: run_timers() has already counted and logged it
+        client.close()
+        return
+    if not hello:
+        timers.cancel(client)
+        note_handshake("failed", started)
+        client.close()
+        return
+
+    open_send_queue(client)
+    command, argument = hello
+    if command == "USERNAME":
+        refused = register_username(client, argument)
+        if refused:
+            note_handshake(refused, started)
+            return
+    elif not resume_session(client, argument):
+        # The session expired since we checked; the client reconnects and starts over
+        note_handshake("failed", started)
+        remove_client(client)
+        return
+    note_handshake("completed", started)
+    watch_connection(client)
+    handle_client(client, decoder, frames)
+
+
+
+def timer_ticker():
+    """Threaded engine: fire handshake and idle deadlines every TIMER_TICK"""
     while True:
-        client, address = server.accept()
-        print(f"[NEW CONNECTION] {address} connected.")
+        time.sleep(TIMER_TICK)
+        run_timers()
 
 
-        client.send("USERNAME".encode('utf-8'))
-        username = client.recv(1024).decode('utf-8')
-        usernames[client] = username
-        clients.append(client)
 
-        print(f"[USERNAME SET] {username} joined the chat.")
-        broadcast(f"{username} has joined the chat!\n".encode('utf-8'),sender_socket=client)
-        
+def start():
+    global handshake_slots
+    log.info("STARTING", f"Server running on {HOST}:{PORT}")
+    handshake_slots = threading.BoundedSemaphore(MAX_PENDING_HANDSHAKES)
+    if bus is not None:
+        threading.Thread(target=bus_reader, daemon=True).start()
+    threading.Thread(target=presence_ticker, daemon=True).start()
+    threading.Thread(target=timer_ticker, daemon=True).start()
+    adopt_connections()
+    while True:
+        try:
+            client, address = server.accept()
+        except OSError as e:
+            if not accept_failed(e):
+                raise
+            if e.errno in ACCEPT_RESOURCE_ERRORS:
+                time.sleep(ACCEPT_BACKOFF)
+            continue
+        log.info("NEW CONNECTION", f"{address} connected.")
+        connections_accepted.inc()
 
-        broadcast_user_count()
+        if not handshake_slots.acquire(blocking=False):
+            note_handshake("rejected")
+            client.close()
+            continue
 
-        thread = threading.Thread(target=handle_client, args=(client,))
+        thread = threading.Thread(target=handshake, args=(client, address), daemon=True)
         thread.start()
 
 
-start()
+
+# ---------------------------------------------------------------------------
+# Event-loop engine
+# ---------------------------------------------------------------------------
+
+def forget_socket(client):
+    """Drop every piece of event-loop state kept for a socket"""
+    pending_usernames.pop(client, None)
+    outgoing.pop(client, None)
+    throttled.pop(client, None)
+    throttle_timers.cancel(client)
+    writing.discard(client)
+    flush_pending.discard(client)
+    decoders.pop(client, None)
+    try:
+        selector.unregister(client)
+    except (KeyError, ValueError):
+        pass
+
+
+
+def guarded(handler, client, *args):
+    """Run a handler for one connection; if it fails unexpectedly only that connection is dropped, not the loop"""
+    try:
+        handler(client, *args)
+    except Exception as e:
+        log.error("ERROR", f"Dropping {sessions.username(client)} after {type(e).__name__}: {e}")
+        remove_client(client, "error")
+
+
+
+def accept_failed(error):
+    """Count a failed accept(); False for errors that aren't about one connection or a shortage"""
+    if error.errno not in ACCEPT_ERRORS:
+        return False
+    note_handshake("rejected")
+    log.warning("ACCEPT", f"Could not accept a connection: {error}")
+    return True
+
+
+
+def accept_connections():
+    global accept_paused_until
+    # Drain the whole accept queue so a burst of joins is handled in one wakeup
+    while True:
+        try:
+            client, address = server.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if not accept_failed(e):
+                raise
+            if e.errno in ACCEPT_RESOURCE_ERRORS:
+                # The backlog stays readable, so stop watching it until descriptors may have been freed
+                selector.unregister(server)
+                accept_paused_until = time.monotonic() + ACCEPT_BACKOFF
+                return
+            continue
+        log.info("NEW CONNECTION", f"{address} connected.")
+        connections_accepted.inc()
+
+        if len(pending_usernames) >= MAX_PENDING_HANDSHAKES:
+            note_handshake("rejected")
+            client.close()
+            continue
+
+        client.setblocking(False)
+        outgoing[client] = collections.deque()
+        decoders[client] = FrameDecoder()
+        open_send_queue(client)
+        selector.register(client, selectors.EVENT_READ)
+        started = time.monotonic()
+        pending_usernames[client] = (started, address)
+        timers.schedule(client, started + HANDSHAKE_TIMEOUT)
+        send_to_client(client, control_frame("USERNAME"))
+
+
+
+def read_from_client(client):
+    try:
+        data = client.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        data = b""
+
+    if not data:
+        remove_client(client)
+        return
+    last_seen[client] = time.monotonic()
+    bytes_in.inc(len(data))
+
+    try:
+        frames = decoders[client].feed(data)
+    except ProtocolError as e:
+        log.warning("PROTOCOL ERROR", f"{sessions.username(client)}: {e}")
+        remove_client(client, "protocol_error")
+        return
+
+    if client in pending_usernames:
+        try:
+            hello, frames = hello_from_frames(frames)
+        except ProtocolError as e:
+            log.warning("PROTOCOL ERROR", f"{pending_usernames[client][1]}: {e}")
+            remove_client(client, "protocol_error")
+            return
+        if not hello:
+            return
+        command, argument = hello
+        started, address = pending_usernames[client]
+        if command == "USERNAME":
+            refused = register_username(client, argument)
+            if refused:
+                note_handshake(refused, started)
+                return
+        elif not resume_session(client, argument):
+            # Unknown or expired session: ask for a username and start over
+            send_to_client(client, control_frame("USERNAME"))
+            return
+        del pending_usernames[client]
+        note_handshake("completed", started)
+        watch_connection(client)
+
+    messages_in.inc(len(frames))
+    handle_frames(client, frames)
+
+
+
+def handle_frames(client, frames):
+    """Handle a client's frames in order; any the delay action holds back wait in throttled"""
+    for index, (frame_type, stream, payload) in enumerate(frames):
+        if client not in decoders:
+            return  # removed while handling an earlier frame
+        try:
+            wait = admit(client, frame_type, payload, stream)
+            if wait:
+                # Stop reading the socket until the held frames are through
+                throttled[client] = frames[index:]
+                throttle_timers.schedule(client, time.monotonic() + wait)
+                update_events(client)
+                return
+            if wait is not None:
+                handle_frame(client, frame_type, payload, stream)
+        except ProtocolError as e:
+            log.warning("PROTOCOL ERROR", f"{sessions.username(client)}: {e}")
+            remove_client(client, "protocol_error")
+            return
+        except OSError:
+            remove_client(client, "slow_consumer")
+
+
+
+def release_throttled():
+    """Retry frames held back by the delay action; returns seconds until the next retry"""
+    now = time.monotonic()
+    for client, deadline in throttle_timers.advance(now):
+        frames = throttled.pop(client, None)
+        if frames is not None:
+            last_seen[client] = now  # held back, not idle
+            update_events(client)
+            guarded(handle_frames, client, frames)
+    return throttle_timers.next_timeout(now)
+
+
+
+def update_events(client):
+    """Register a socket for what it is waiting on: reading unless throttled, writing while full"""
+    events = 0 if client in throttled else selectors.EVENT_READ
+    if client in writing:
+        events |= selectors.EVENT_WRITE
+    registered = client in selector.get_map()
+    if not events:
+        if registered:
+            selector.unregister(client)
+    elif registered:
+        selector.modify(client, events)
+    else:
+        selector.register(client, events)
+
+
+
+def write_to_client(client):
+    """Write what is queued for a client; only wait for EVENT_WRITE if the socket fills up"""
+    pending = outgoing.get(client)
+    queue = send_queues.get(client)
+    if pending is None or queue is None:
+        return
+    # Only take more once the last batch is out, so a stuck socket leaves
+    # frames in the bounded queue where the overflow policy can see them
+    if not pending:
+        pending.extend(queue.take(block=False))
+    try:
+        completed, sent = send_frames(client, pending)
+    except BlockingIOError:
+        completed = sent = 0
+    except OSError:
+        remove_client(client, "write_error")
+        return
+    messages_out.inc(completed)
+    bytes_out.inc(sent)
+
+    if (pending or queue) and client not in writing:
+        writing.add(client)
+        update_events(client)
+    elif not pending and not queue and client in writing:
+        writing.discard(client)
+        update_events(client)
+
+
+
+def flush_writes():
+    """Write out every client that had frames queued since the last pass of the loop"""
+    while flush_pending:
+        client = flush_pending.pop()
+        # Sockets already waiting for EVENT_WRITE are full; the loop gets to them when they drain
+        if client not in writing:
+            guarded(write_to_client, client)
+
+
+
+def read_from_bus():
+    try:
+        messages = bus.receive()
+    except (OSError, ProtocolError) as e:
+        lost_bus(e)
+    apply_bus_messages(messages)
+
+
+
+def run_event_loop():
+    global selector, accept_paused_until
+    log.info("STARTING", f"Server running on {HOST}:{PORT} (event loop)")
+    selector = selectors.DefaultSelector()
+    server.setblocking(False)
+    selector.register(server, selectors.EVENT_READ)
+    if bus is not None:
+        selector.register(bus.sock, selectors.EVENT_READ)
+    adopt_connections()
+    if HANDOFF:
+        open_handoff_listener()
+
+    next_presence_flush = time.monotonic() + PRESENCE_INTERVAL
+    while True:
+        timeout = run_timers()
+        for wait in (expire_sessions(), release_throttled()):
+            if wait is not None:
+                timeout = wait if timeout is None else min(timeout, wait)
+
+        now = time.monotonic()
+        if now >= next_presence_flush:
+            flush_presence()
+            next_presence_flush = now + PRESENCE_INTERVAL
+        if pending_presence or pending_rosters:
+            presence_wait = next_presence_flush - now
+            timeout = presence_wait if timeout is None else min(timeout, presence_wait)
+        if accept_paused_until:
+            if now >= accept_paused_until:
+                accept_paused_until = 0.0
+                selector.register(server, selectors.EVENT_READ)
+            else:
+                accept_wait = accept_paused_until - now
+                timeout = accept_wait if timeout is None else min(timeout, accept_wait)
+
+        flush_writes()
+        for key, events in selector.select(timeout=timeout):
+            sock = key.fileobj
+            if sock is server:
+                accept_connections()
+                continue
+            if bus is not None and sock is bus.sock:
+                read_from_bus()
+                continue
+            if sock is handoff_listener:
+                accept_handoff()
+                continue
+            if events & selectors.EVENT_READ:
+                guarded(read_from_client, sock)
+            if events & selectors.EVENT_WRITE and sock in outgoing:
+                guarded(write_to_client, sock)
+
+
+
+# ---------------------------------------------------------------------------
+# Handoff (restarting in place)
+# ---------------------------------------------------------------------------
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+
+def open_handoff_listener():
+    global handoff_listener
+    handoff_listener = open_handoff(HANDOFF_PATH)
+    handoff_listener.setblocking(False)
+    selector.register(handoff_listener, selectors.EVENT_READ)
+    log.info("HANDOFF", f"A new process can take over through {HANDOFF_PATH}")
+
+
+
+def accept_handoff():
+    """Event loop: a process started with --take-over is asking for our connections"""
+    global handoff_listener
+    try:
+        conn, address = handoff_listener.accept()
+    except BlockingIOError:
+        return
+    # One takeover at a time; the path is free for the new process once it's done
+    selector.unregister(handoff_listener)
+    handoff_listener.close()
+    handoff_listener = None
+    os.unlink(HANDOFF_PATH)
+    with conn:
+        try:
+            hand_off(conn)
+        except (OSError, ValueError) as e:
+            log.error("HANDOFF", f"Takeover failed, carrying on: {e}")
+    open_handoff_listener()
+
+
+
+def hand_off(conn):
+    """Give the listening socket, every connection and every session to the process on conn, then exit.
+
+    The loop stops here, so nothing more is read: data that arrives now
+    waits in the kernel for the new process. What was read but not handled
+    (a partial frame, frames held back by the delay action) and what was
+    queued but not written go along with each socket. History is on disk;
+    the new process opens the same log once we have closed it.
+    """
+    flush_presence()
+    flush_writes()
+
+    sockets = [server]
+    index = {}  # socket -> its position in sockets
+    connections = []
+    for client in list(send_queues):
+        queue = send_queues[client]
+        pending = pending_usernames.get(client)
+        if pending is None and sessions.of(client) is None:
+            continue
+        held = b"".join(encode_frame(frame_type, payload, stream)
+                        for frame_type, stream, payload in throttled.get(client, ()))
+        index[client] = len(sockets)
+        sockets.append(client)
+        connections.append({
+            "socket": index[client],
+            "handshaking": pending[1] if pending is not None else None,  # its address, until it sends a username
+            "unread": encode_bytes(held + decoders[client].buffer),
+            "unsent": encode_bytes(b"".join(bytes(frame) for frame in itertools.chain(outgoing[client], queue.frames))),
+            "bulk": encode_bytes(b"".join(bytes(frame) for frame in queue.bulk)),
+        })
+
+    now = time.monotonic()
+    handed_sessions = []
+    with sessions.lock:
+        for session in list(sessions.by_token.values()):
+            if session.client is not None and session.client not in index:
+                continue
+            handed_sessions.append({
+                "token": session.token,
+                "username": session.username,
+                "socket": index.get(session.client),  # None while parked
+                "room": client_rooms.get(session.client) if session.client is not None else session.room,
+                "expires_in": session.expires - now if session.expires is not None else None,
+                "seq": session.seq,
+                "uploads": session.uploads,
+            })
+    transfers = [{"sender": index[sender], "stream": stream,
+                  "receivers": [index[receiver] for receiver in transfer["receivers"] if receiver in index],
+                  **{key: transfer[key] for key in ("id", "file_id", "name", "size", "offset")}}
+                 for (sender, stream), transfer in list(uploads.items()) if sender in index]
+
+    log.info("HANDOFF", f"Handing {len(connections)} connections and {len(handed_sessions)} sessions "
+             f"to the new process...")
+    send_handoff(conn, sockets, {
+        "connections": connections,
+        "sessions": handed_sessions,
+        "uploads": transfers,
+        "next_transfer_id": next(transfer_ids),
+    })
+    # The sockets are the new process's now: leave without closing or shutting down any of them
+    log.info("HANDOFF", "Done, exiting.")
+    if history is not None:
+        history.close()
+    log.close()
+    os._exit(0)
+
+
+
+def take_over():
+    """--take-over: receive the listening socket, connections and sessions of the server we replace"""
+    global server, handed_over
+    try:
+        sockets, state = receive_handoff(HANDOFF_PATH)
+    except (OSError, ValueError) as e:
+        log.error("HANDOFF", f"Nothing to take over at {HANDOFF_PATH}: {e}")
+        sys.exit(1)
+    for sock in sockets:
+        sock.setblocking(ENGINE == "threaded")
+    server = sockets[0]
+    handed_over = (sockets, state)
+
+
+
+def adopt_connections():
+    """--take-over: carry on serving the connections and sessions handed over, as if they had always been ours"""
+    global handed_over, transfer_ids
+    if handed_over is None:
+        return
+    sockets, state = handed_over
+    handed_over = None
+    now = time.monotonic()
+
+    unread = {}  # socket -> decoder holding what the old process had read but not handled
+    handshaking = []
+    for connection in state["connections"]:
+        client = sockets[connection["socket"]]
+        decoder = FrameDecoder()
+        decoder.buffer = decode_bytes(connection["unread"])
+        unread[client] = decoder
+        unsent = decode_bytes(connection["unsent"])
+        if ENGINE == "eventloop":
+            outgoing[client] = collections.deque()
+            decoders[client] = decoder
+            selector.register(client, selectors.EVENT_READ)
+        if connection["handshaking"] is not None:
+            handshaking.append((client, tuple(connection["handshaking"]), decoder, unsent))
+            continue
+        open_send_queue(client)
+        if unsent:
+            send_to_client(client, unsent)
+        bulk = decode_bytes(connection["bulk"])
+        if bulk:
+            send_bulk(client, bulk, force=True)
+
+    restored = []
+    expiring = []
+    with sessions.lock:
+        for handed in state["sessions"]:
+            session = sessions.add(handed["token"], handed["username"])
+            session.seq = handed["seq"]
+            session.uploads = handed["uploads"]
+            room = handed["room"] or DEFAULT_ROOM
+            if handed["socket"] is None:
+                session.room = room
+                session.expires = now + handed["expires_in"]
+                parked.setdefault(room, collections.Counter())[session.username] += 1
+                expiring.append((session.expires, session.token))
+                continue
+            client = sockets[handed["socket"]]
+            sessions.attach(session, client)
+            with rooms_lock:
+                rooms.setdefault(room, set()).add(client)
+                client_rooms[client] = room
+            restored.append(client)
+        parked_expiry.extend(sorted(expiring))
+
+    for transfer in state["uploads"]:
+        uploads[(sockets[transfer["sender"]], transfer["stream"])] = {
+            "id": transfer["id"], "file_id": transfer["file_id"], "name": transfer["name"],
+            "size": transfer["size"], "offset": transfer["offset"],
+            "receivers": {sockets[receiver] for receiver in transfer["receivers"]}, "stalled_since": None}
+    transfer_ids = itertools.count(state["next_transfer_id"])
+
+    log.info("HANDOFF", f"Took over {len(restored)} connections, {len(handshaking)} handshakes "
+             f"and {len(expiring)} parked sessions.")
+
+    # Everything is in place; pick up where the old process stopped reading
+    for client, address, decoder, greeting in handshaking:
+        if ENGINE == "eventloop":
+            open_send_queue(client)
+            if greeting:
+                send_to_client(client, greeting)
+            pending_usernames[client] = (now, address)
+            timers.schedule(client, now + HANDSHAKE_TIMEOUT)
+        elif handshake_slots.acquire(blocking=False):
+            threading.Thread(target=handshake, args=(client, address, decoder, greeting), daemon=True).start()
+        else:
+            client.close()
+    for client in restored:
+        watch_connection(client)
+        decoder = unread[client]
+        if ENGINE == "eventloop":
+            handle_frames(client, decoder.feed(b""))
+        else:
+            threading.Thread(target=handle_client, args=(client, decoder, decoder.feed(b"")), daemon=True).start()
+
+
+
+# ---------------------------------------------------------------------------
+# Startup
+# ---------------------------------------------------------------------------
+
+def create_server_socket(reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+
+def raise_file_limit():
+    """Every connection is a descriptor: allow as many as the hard limit does"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            log.warning("STARTING", f"Could not raise the open file limit from {soft}: {e}")
+            return
+        log.info("STARTING", f"Raised the open file limit from {soft} to {hard}")
+
+
+
+def open_log(args, suffix=""):
+    global log
+    path = args.log_file + suffix if args.log_file else None
+    log = AsyncLogger(path, level=LEVELS[args.log_level], fmt=args.log_format,
+                      sample={"CHAT": args.log_sample_chat},
+                      max_bytes=int(args.log_max_mb * 1024 * 1024), backups=args.log_backups)
+
+
+
+def open_history(directory, args):
+    global history
+    if args.no_history:
+        return
+    history = HistoryLog(directory,
+                         segment_bytes=int(args.history_segment_mb * 1024 * 1024),
+                         max_bytes=int(args.history_max_mb * 1024 * 1024),
+                         max_age=args.history_max_age_hours * 3600)
+    log.info("HISTORY", f"Logging to {directory}, next sequence number {history.next_seq}")
+
+
+
+def send_queue_stats():
+    """Queue depth across clients, with the deepest queues named so slow clients stand out"""
+    queues = [(len(queue), queue.dropped, sessions.username(client))
+              for client, queue in list(send_queues.items())]
+    queues.sort(reverse=True)
+    return {
+        "total_frames": sum(depth for depth, dropped, username in queues),
+        "dropped_frames": sum(dropped for depth, dropped, username in queues),
+        "deepest": [{"user": username, "depth": depth, "dropped": dropped}
+                    for depth, dropped, username in queues[:10]],
+    }
+
+
+
+def start_stats_endpoint(port):
+    registry.gauge("active_connections", lambda: len(sessions))
+    registry.gauge("pending_handshakes", lambda: connections_accepted.value - sum(handshakes.values.values()))
+    registry.gauge("rooms", lambda: len(rooms))
+    registry.gauge("timers", lambda: len(timers))
+    registry.gauge("throttled", lambda: len(throttle_timers))
+    registry.gauge("uploads", lambda: len(uploads))
+    registry.gauge("rate_limited_rooms", lambda: {room: limiter.limited for room, limiter in list(room_limits.items())
+                                                  if limiter.limited})
+    registry.gauge("parked_sessions", lambda: sum(sum(names.values()) for names in list(parked.values())))
+    registry.gauge("send_queues", send_queue_stats)
+    registry.gauge("worker", lambda: WORKER_ID)
+    if isinstance(bus, Federation):
+        registry.gauge("federation", bus.stats)
+    threading.Thread(target=bind_stats, args=(port,), daemon=True).start()
+
+
+
+def bind_stats(port):
+    """Serve the stats, retrying while the port is busy: losing metrics isn't worth losing the server over"""
+    for attempt in itertools.count():
+        try:
+            serve_stats(registry, STATS_HOST, port)
+            break
+        except OSError as e:
+            if not attempt:
+                log.warning("STATS", f"Can't serve metrics on port {port} ({e}), retrying every {STATS_RETRY:g}s.")
+            time.sleep(STATS_RETRY)
+    log.info("STATS", f"Serving metrics on http://{STATS_HOST}:{port}/stats")
+
+
+
+def serve():
+    if STATS_PORT:
+        start_stats_endpoint(STATS_PORT + WORKER_ID)
+    if ENGINE == "eventloop":
+        run_event_loop()
+    else:
+        start()
+
+
+
+def run_worker(worker_id, bus_path, args):
+    global WORKER_ID, bus, server
+    WORKER_ID = worker_id
+    # The parent's log writer thread doesn't survive the fork; start our own
+    open_log(args, f".worker-{worker_id}")
+    server = create_server_socket(reuse_port=True)
+    bus = BusLink(bus_path, worker_id)
+    # Relayed messages are logged too, so every worker keeps the full history
+    open_history(os.path.join(HISTORY_DIR, f"worker-{worker_id}"), args)
+    log.info("WORKER", f"{worker_id} started (pid {multiprocessing.current_process().pid})")
+    try:
+        serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Forked workers leave through os._exit, which skips atexit
+        log.close()
+
+
+
+def run_workers(args):
+    """Start WORKERS processes on the shared port and relay between them until interrupted"""
+    bus_path = BUS_PATH or f"/tmp/chat-server-{PORT}.bus"
+    hub = open_hub(bus_path)
+    stop = threading.Event()
+    threading.Thread(target=run_hub, args=(hub, stop, lambda text: log.info("BUS", text)), daemon=True).start()
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(worker_id, bus_path, args), daemon=True)
+               for worker_id in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    log.info("STARTING", f"{WORKERS} workers sharing {HOST}:{PORT}, bus at {bus_path}")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        log.info("SHUTDOWN", "Stopping workers...")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        stop.set()
+
+
+
+def main():
+    global ENGINE, HOST, PORT, QUEUE_SIZE, OVERFLOW_POLICY, BLOCK_TIMEOUT, server
+    global LISTEN_BACKLOG, HANDSHAKE_TIMEOUT, MAX_PENDING_HANDSHAKES, WORKERS, BUS_PATH
+    global HISTORY_DIR, HISTORY_REPLAY, PRESENCE_INTERVAL, STATS_HOST, STATS_PORT, SESSION_GRACE
+    global PING_INTERVAL, IDLE_TIMEOUT, MAX_MESSAGE_BYTES, CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE
+    global ROOM_MESSAGE_RATE, ROOM_BYTE_RATE, RATE_BURST, HISTORY_RATE, RATE_LIMIT_ACTION, MAX_FILE_BYTES, FILE_BYTE_RATE
+    global NODE_ID, PEER_HOST, PEER_PORT, PEERS, PEER_SECRET, HANDOFF, HANDOFF_PATH, bus
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--host", default=HOST, help="interface to bind (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--engine", choices=["threaded", "eventloop"], default=ENGINE,
+                        help="threaded: one thread per client, eventloop: all clients on one selectors loop")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="frames buffered per client before the overflow policy applies (default: %(default)s)")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help="what to do when a client's send queue is full (default: %(default)s)")
+    parser.add_argument("--block-timeout", type=float, default=BLOCK_TIMEOUT,
+                        help="seconds the 'block' policy waits for room before disconnecting (default: %(default)s)")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG,
+                        help="listen() backlog for connections waiting to be accepted (default: %(default)s)")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="seconds a new connection has to send its username (default: %(default)s)")
+    parser.add_argument("--max-pending-handshakes", type=int, default=MAX_PENDING_HANDSHAKES,
+                        help="connections beyond this many unfinished handshakes are refused (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="worker processes sharing the port via SO_REUSEPORT (Linux; default: %(default)s)")
+    parser.add_argument("--bus-path", default=BUS_PATH,
+                        help="Unix socket the workers relay through (default: /tmp/chat-server-<port>.bus)")
+    parser.add_argument("--node-id", help="this server's name among its peers (default: <hostname>:<port>)")
+    parser.add_argument("--peer-port", type=int, default=PEER_PORT,
+                        help="listen for other server nodes on this port (default: off)")
+    parser.add_argument("--peer-host", default=PEER_HOST,
+                        help="interface for --peer-port; other machines need a routable one (default: %(default)s)")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="another node's --peer-port to relay with; repeat for several")
+    parser.add_argument("--peer-secret", default=os.environ.get("CHAT_PEER_SECRET"),
+                        help="secret shared by every node, required to federate (default: $CHAT_PEER_SECRET)")
+    parser.add_argument("--handoff", action="store_true",
+                        help="let a new server process take over this one's connections (eventloop engine only)")
+    parser.add_argument("--take-over", action="store_true",
+                        help="start by taking over the connections of a server running with --handoff")
+    parser.add_argument("--handoff-path",
+                        help="Unix socket for --handoff and --take-over (default: /tmp/chat-server-<port>.handoff)")
+    parser.add_argument("--session-grace", type=float, default=SESSION_GRACE,
+                        help="seconds a dropped user's session is kept for RESUME, 0 to disable (default: %(default)s)")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+                        help="seconds of silence before a connection is sent a PING, 0 to disable (default: %(default)s)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence before a connection is dropped, 0 to disable (default: %(default)s)")
+    parser.add_argument("--max-message-bytes", type=int, default=MAX_MESSAGE_BYTES,
+                        help="longest message a client may send (default: %(default)s)")
+    parser.add_argument("--rate-messages", type=float, default=CLIENT_MESSAGE_RATE,
+                        help="messages/sec each connection may send, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--rate-bytes", type=float, default=CLIENT_BYTE_RATE,
+                        help="bytes/sec each connection may send, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--room-rate-messages", type=float, default=ROOM_MESSAGE_RATE,
+                        help="chat messages/sec per room, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--room-rate-bytes", type=float, default=ROOM_BYTE_RATE,
+                        help="chat bytes/sec per room, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--rate-burst", type=float, default=RATE_BURST,
+                        help="seconds' worth of sending allowed in one burst (default: %(default)s)")
+    parser.add_argument("--history-rate", type=float, default=HISTORY_RATE,
+                        help="HISTORY requests/sec each connection may make, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--rate-limit-action", choices=RATE_LIMIT_ACTIONS, default=RATE_LIMIT_ACTION,
+                        help="what to do with messages over a rate limit (default: %(default)s)")
+    parser.add_argument("--max-file-mb", type=float, default=MAX_FILE_BYTES / (1024 * 1024),
+                        help="largest file users may send, 0 to disable file transfer (default: %(default)s)")
+    parser.add_argument("--file-rate-bytes", type=float, default=FILE_BYTE_RATE,
+                        help="file bytes/sec each connection may upload, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--presence-interval", type=float, default=PRESENCE_INTERVAL,
+                        help="seconds over which joins and leaves are merged into one presence update (default: %(default)s)")
+    parser.add_argument("--stats-port", type=int, default=STATS_PORT,
+                        help="serve metrics as JSON on this local HTTP port; worker N uses port + N (default: off)")
+    parser.add_argument("--stats-host", default=STATS_HOST, help="interface for the stats endpoint (default: %(default)s)")
+    parser.add_argument("--history-dir", default=HISTORY_DIR,
+                        help="directory for the message history log (default: %(default)s)")
+    parser.add_argument("--no-history", action="store_true", help="don't log or replay message history")
+    parser.add_argument("--history-replay", type=int, default=HISTORY_REPLAY,
+                        help="messages replayed to a client joining a room (default: %(default)s)")
+    parser.add_argument("--history-segment-mb", type=float, default=16,
+                        help="size at which the log starts a new segment file (default: %(default)s)")
+    parser.add_argument("--history-max-mb", type=float, default=512,
+                        help="oldest segments are deleted beyond this total size (default: %(default)s)")
+    parser.add_argument("--history-max-age-hours", type=float, default=7 * 24,
+                        help="segments older than this are deleted (default: %(default)s)")
+    parser.add_argument("--log-file", help="write the log here instead of stdout (workers add .worker-N)")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info", help="(default: %(default)s)")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text", help="(default: %(default)s)")
+    parser.add_argument("--log-sample-chat", type=float, default=1.0,
+                        help="fraction of chat messages written to the log, 0 to 1 (default: %(default)s)")
+    parser.add_argument("--log-max-mb", type=float, default=64,
+                        help="rotate the log file at this size (default: %(default)s)")
+    parser.add_argument("--log-backups", type=int, default=3,
+                        help="rotated log files to keep (default: %(default)s)")
+    args = parser.parse_args()
+
+    ENGINE = args.engine
+    HOST = args.host
+    PORT = args.port
+    QUEUE_SIZE = args.queue_size
+    OVERFLOW_POLICY = args.overflow
+    BLOCK_TIMEOUT = args.block_timeout
+    LISTEN_BACKLOG = args.backlog
+    HANDSHAKE_TIMEOUT = args.handshake_timeout
+    MAX_PENDING_HANDSHAKES = args.max_pending_handshakes
+    WORKERS = args.workers
+    BUS_PATH = args.bus_path
+    NODE_ID = args.node_id or f"{socket.gethostname()}:{args.port}"
+    PEER_HOST = args.peer_host
+    PEER_PORT = args.peer_port
+    PEER_SECRET = args.peer_secret
+    try:
+        PEERS = [parse_peer(peer) for peer in args.peer]
+    except ValueError:
+        parser.error("--peer takes HOST:PORT")
+    if WORKERS > 1 and (PEER_PORT or PEERS):
+        parser.error("--peer and --peer-port run a single process per node; drop --workers")
+    if (PEER_PORT or PEERS) and not PEER_SECRET:
+        parser.error("--peer and --peer-port need --peer-secret (or CHAT_PEER_SECRET), the same on every node")
+    HANDOFF = args.handoff
+    HANDOFF_PATH = args.handoff_path or f"/tmp/chat-server-{PORT}.handoff"
+    if WORKERS > 1 and (HANDOFF or args.take_over):
+        parser.error("--handoff and --take-over hand over a single process; drop --workers")
+    if HANDOFF and (PEER_PORT or PEERS):
+        parser.error("--handoff can't carry peer links over, so every handoff would flap the cluster; "
+                     "drop --peer/--peer-port")
+    if HANDOFF and ENGINE != "eventloop":
+        parser.error("--handoff needs --engine eventloop: reader threads can't be stopped without closing their sockets")
+    HISTORY_DIR = args.history_dir
+    HISTORY_REPLAY = args.history_replay
+    PRESENCE_INTERVAL = args.presence_interval
+    SESSION_GRACE = args.session_grace
+    PING_INTERVAL = args.ping_interval
+    IDLE_TIMEOUT = args.idle_timeout
+    MAX_MESSAGE_BYTES = args.max_message_bytes
+    CLIENT_MESSAGE_RATE = args.rate_messages
+    CLIENT_BYTE_RATE = args.rate_bytes
+    ROOM_MESSAGE_RATE = args.room_rate_messages
+    ROOM_BYTE_RATE = args.room_rate_bytes
+    RATE_BURST = args.rate_burst
+    HISTORY_RATE = args.history_rate
+    RATE_LIMIT_ACTION = args.rate_limit_action
+    MAX_FILE_BYTES = int(args.max_file_mb * 1024 * 1024)
+    FILE_BYTE_RATE = args.file_rate_bytes
+    STATS_HOST = args.stats_host
+    STATS_PORT = args.stats_port
+
+    # Exit through SystemExit on `kill` so the log is flushed and, in
+    # multi-process mode, the workers are stopped instead of left on the port
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    open_log(args)
+    raise_file_limit()
+
+    if WORKERS > 1:
+        run_workers(args)
+        return
+
+    if args.take_over:
+        # Before anything else binds: the old process's ports and history are ours once it has exited
+        take_over()
+    else:
+        server = create_server_socket()
+    if PEER_PORT or PEERS:
+        bus = Federation(NODE_ID, PEER_SECRET, (PEER_HOST, PEER_PORT) if PEER_PORT else None, PEERS,
+                         report=lambda text: log.info("FEDERATION", text))
+        log.info("FEDERATION", f"Node {NODE_ID}, peers on {f'{PEER_HOST}:{PEER_PORT}' if PEER_PORT else '-'}, "
+                 f"dialing {', '.join(f'{host}:{port}' for host, port in PEERS) or 'nobody'}")
+    open_history(HISTORY_DIR, args)
+    serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Registry of the users on this server.
+
+Every user has one Session from the handshake until it ends for good. A
+session is connected (client is its socket) or parked (client is None,
+waiting out the grace period for a RESUME), and the registry indexes it
+every way the server needs to find one, so each lookup is a dict hit:
+
+    by_token   RESUME <token>, session expiry
+    by_client  everything that starts from a connection
+    by_name    /msg <user>, and keeping usernames unique
+
+Names are compared casefolded, so "Ben" and "ben" can't both be on at
+once. A parked session keeps its name: nobody else can take it while its
+owner may still come back.
+
+Changes go through the registry's lock; lookups are plain dict reads.
+"""
+
+import secrets
+import threading
+
+
+class Session:
+    __slots__ = ("token", "username", "client", "room", "expires", "seq", "uploads")
+
+    def __init__(self, token, username):
+        self.token = token
+        self.username = username
+        self.client = None
+        self.room = None     # while parked: the room it is held in
+        self.expires = None  # while parked: when the grace period ends
+        self.seq = 0         # while parked: the last history seq before the drop
+        self.uploads = {}    # file id -> bytes of it relayed so far
+
+    def __repr__(self):
+        state = "connected" if self.client is not None else "parked"
+        return f"<Session {self.username} ({state})>"
+
+
+class SessionRegistry:
+    def __init__(self):
+        self.by_token = {}
+        self.by_client = {}
+        self.by_name = {}  # casefolded username -> Session
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        """Connected sessions (parked ones aren't counted)"""
+        return len(self.by_client)
+
+    def get(self, token):
+        return self.by_token.get(token)
+
+    def of(self, client):
+        return self.by_client.get(client)
+
+    def find(self, username):
+        return self.by_name.get(username.casefold())
+
+    def username(self, client, default="Unknown"):
+        session = self.by_client.get(client)
+        return session.username if session is not None else default
+
+    def open(self, username, client):
+        """Start a session for a new user on client; returns None if the name is taken"""
+        with self.lock:
+            if username.casefold() in self.by_name:
+                return None
+            session = self.add(secrets.token_urlsafe(16), username)
+            self.attach(session, client)
+        return session
+
+    def add(self, token, username):
+        """Register a session, not yet on any connection, under a token it already has (a handed-over one)"""
+        with self.lock:
+            session = Session(token, username)
+            self.by_token[token] = session
+            self.by_name[username.casefold()] = session
+        return session
+
+    def attach(self, session, client):
+        """Put a session on a (new) connection; returns the connection it was on before, if any"""
+        with self.lock:
+            old_client = session.client
+            if old_client is not None:
+                self.detach(old_client)
+            session.client = client
+            session.expires = None
+            self.by_client[client] = session
+        return old_client
+
+    def detach(self, client):
+        """Take a connection off its session, which stays registered; returns the session, or None"""
+        with self.lock:
+            session = self.by_client.pop(client, None)
+            if session is None:
+                return None
+            session.client = None
+        return session
+
+    def close(self, session):
+        """End a session for good, freeing its token and its name"""
+        with self.lock:
+            if session.client is not None:
+                self.detach(session.client)
+            if self.by_token.get(session.token) is session:
+                del self.by_token[session.token]
+            key = session.username.casefold()
+            if self.by_name.get(key) is session:
+                del self.by_name[key]
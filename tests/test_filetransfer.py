@@ -0,0 +1,184 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import filetransfer
+from filetransfer import Downloads, Uploads, describe_size, split_cancel
+from protocol import FRAME_CONTROL, FRAME_FILE, FrameDecoder, file_frame, split_file
+
+
+def payload(stream, offset, data):
+    """The FRAME_FILE payload a receiver gets for this chunk"""
+    (frame_type, stream, payload), = FrameDecoder().feed(file_frame(stream, offset, data))
+    return payload
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+class HelpersTest(unittest.TestCase):
+    def test_describe_size(self):
+        self.assertEqual(describe_size(512), "512 bytes")
+        self.assertEqual(describe_size(1536), "1.5 KB")
+        self.assertEqual(describe_size(3 * 1024 * 1024), "3.0 MB")
+        self.assertEqual(describe_size(5000 * 1024 * 1024), "5000.0 MB")
+
+    def test_split_cancel(self):
+        self.assertEqual(split_cancel("3 too big"), (3, "too big"))
+        self.assertEqual(split_cancel("7"), (7, ""))
+
+
+class DownloadsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        self.downloads = Downloads(self.directory)
+
+    def tearDown(self):
+        self.downloads.close()
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as file:
+            return file.read()
+
+    def test_chunks_are_written_and_renamed(self):
+        self.assertEqual(self.downloads.offered("1 abc123 10 0 alice notes.txt"), "alice is sending notes.txt (10 bytes)")
+        self.assertIsNone(self.downloads.chunk(1, payload(1, 0, b"abcde")))
+        self.assertEqual(self.downloads.chunk(1, payload(1, 5, b"fghij")),
+                         f"Saved {os.path.join(self.directory, 'notes.txt')}")
+        self.assertEqual(self.read("notes.txt"), b"abcdefghij")
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "abc123.part")))
+        self.assertEqual(self.downloads.active, {})
+
+    def test_names_never_overwrite(self):
+        for stream in (1, 2):
+            self.downloads.offered(f"{stream} id{stream} 1 0 bob report.pdf")
+            self.downloads.chunk(stream, payload(stream, 0, b"x"))
+        self.assertEqual(sorted(os.listdir(self.directory)), ["report (1).pdf", "report.pdf"])
+
+    def test_empty_file_is_saved_at_once(self):
+        self.assertEqual(self.downloads.offered("1 empty 0 0 bob nothing"),
+                         f"Saved {os.path.join(self.directory, 'nothing')}")
+        self.assertEqual(self.read("nothing"), b"")
+
+    def test_names_and_ids_cannot_escape_the_directory(self):
+        self.downloads.offered("1 abc 1 0 eve ../../etc/passwd")
+        self.assertEqual(self.downloads.active[1]["name"], "passwd")
+        self.downloads.offered("2 abc 1 0 eve ..\\..\\boot.ini")
+        self.assertEqual(self.downloads.active[2]["name"], "boot.ini")
+        self.assertIsNone(self.downloads.offered("3 ../x 1 0 eve name"))
+        self.assertIsNone(self.downloads.offered("4 short"))
+
+    def test_chunk_for_an_unknown_stream_is_ignored(self):
+        self.assertIsNone(self.downloads.chunk(9, payload(9, 0, b"x")))
+
+    def test_abort_keeps_the_part_for_a_resume(self):
+        self.downloads.offered("1 abc 8 0 alice data.bin")
+        self.downloads.chunk(1, payload(1, 0, b"1234567"))
+        self.assertEqual(self.downloads.aborted(1, "sender left"), "data.bin interrupted: sender left")
+        self.assertIsNone(self.downloads.aborted(1, ""))
+        self.assertEqual(self.read("abc.part"), b"1234567")
+
+        # The sender's server had only 5 bytes: the rest of the .part is dropped and rewritten
+        self.assertEqual(self.downloads.offered("4 abc 8 5 alice data.bin"), "alice is resuming data.bin at 5 bytes")
+        self.downloads.chunk(4, payload(4, 5, b"XYZ"))
+        self.assertEqual(self.read("data.bin"), b"12345XYZ")
+
+    def test_resume_needs_the_earlier_bytes(self):
+        self.assertIsNone(self.downloads.offered("1 missing 8 4 alice data.bin"))
+        self.downloads.offered("1 abc 8 0 alice data.bin")
+        self.downloads.chunk(1, payload(1, 0, b"12"))
+        self.downloads.close()
+        self.assertIsNone(self.downloads.offered("2 abc 8 4 alice data.bin"))
+
+
+class UploadsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "photo.jpg")
+        self.data = bytes(range(256)) * 40
+        with open(self.path, "wb") as file:
+            file.write(self.data)
+        self.decoder = FrameDecoder()
+        self.commands = []
+        self.chunks = []
+        self.notes = []
+        self.connected = True
+        self.uploads = Uploads(self.send, self.notes.append)
+        patcher = mock.patch.object(filetransfer, "CHUNK_SIZE", 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.uploads.disconnected()
+        self.tmp.cleanup()
+
+    def send(self, frame):
+        if not self.connected:
+            raise OSError("not connected")
+        for frame_type, stream, payload in self.decoder.feed(frame):
+            if frame_type == FRAME_CONTROL:
+                self.commands.append(bytes(payload).decode('utf-8'))
+            elif frame_type == FRAME_FILE:
+                offset, data = split_file(payload)
+                self.chunks.append((stream, offset, bytes(data)))
+
+    def received(self):
+        return b"".join(data for stream, offset, data in sorted(self.chunks, key=lambda chunk: chunk[1]))
+
+    def test_offer_accept_and_finish(self):
+        self.uploads.offer(self.path, "f1")
+        self.assertEqual(self.commands, [f"FILE 1 f1 {len(self.data)} photo.jpg"])
+        self.uploads.accepted("1 0")
+        wait_for(lambda: len(self.received()) == len(self.data))
+        self.assertEqual(self.received(), self.data)
+        self.assertTrue(all(len(data) <= 1000 for stream, offset, data in self.chunks))
+        self.uploads.finished("1 3")
+        self.assertEqual(self.notes[-1], "Sent photo.jpg to 3 user(s)")
+        self.assertEqual(self.uploads.active, {})
+
+    def test_accept_from_an_offset(self):
+        self.uploads.offer(self.path, "f1")
+        self.uploads.accepted("1 6000")
+        wait_for(lambda: len(self.received()) == len(self.data) - 6000)
+        self.assertEqual(self.chunks[0][1], 6000)
+        self.assertEqual(self.received(), self.data[6000:])
+
+    def test_cancel_before_accept_sends_nothing(self):
+        self.uploads.offer(self.path, "f1")
+        self.uploads.cancelled(1, "too big")
+        self.assertEqual(self.notes, ["photo.jpg not sent: too big"])
+        time.sleep(0.05)
+        self.assertEqual(self.chunks, [])
+
+    def test_offer_while_disconnected_waits_for_resume(self):
+        self.connected = False
+        self.uploads.offer(self.path, "f1")
+        self.assertEqual(self.notes, ["Not connected, photo.jpg will be sent when we're back"])
+        self.connected = True
+        self.uploads.resume()
+        self.assertEqual(self.commands, [f"FILE 2 f1 {len(self.data)} photo.jpg"])
+
+    def test_drop_and_resume_keeps_the_file_id(self):
+        self.uploads.offer(self.path, "f1")
+        self.uploads.disconnected()
+        self.uploads.accepted("1 0")
+        time.sleep(0.05)
+        self.assertEqual(self.chunks, [])
+        self.uploads.resume()
+        self.assertEqual(self.commands[-1], f"FILE 2 f1 {len(self.data)} photo.jpg")
+        self.uploads.accepted("2 2000")
+        wait_for(lambda: len(self.received()) == len(self.data) - 2000)
+        self.assertEqual({stream for stream, offset, data in self.chunks}, {2})
+
+
+if __name__ == "__main__":
+    unittest.main()
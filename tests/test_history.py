@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+
+from history import RECORD_HEADER, HistoryLog
+
+
+def texts(records):
+    return [text for seq, timestamp, room, text in records]
+
+
+class HistoryLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.close()
+        self.tmp.cleanup()
+
+    def open(self, **options):
+        log = HistoryLog(self.directory, **options)
+        self.logs.append(log)
+        return log
+
+    def reopen(self, log, **options):
+        log.close()
+        self.logs.remove(log)
+        return self.open(**options)
+
+    def fill(self, log, count, rooms=("lobby", "dev")):
+        """Append count messages, taking turns between rooms; returns {room: [(seq, text)]}"""
+        sent = {room: [] for room in rooms}
+        for n in range(count):
+            room = rooms[n % len(rooms)]
+            text = f"[{room}] message {n}".encode('utf-8')
+            sent[room].append((log.append(room, text), text))
+        return sent
+
+    def test_rooms_are_kept_apart(self):
+        log = self.open()
+        sent = self.fill(log, 20)
+        self.assertEqual(texts(log.recent("dev", 3)), [text for seq, text in sent["dev"][-3:]])
+        self.assertEqual(texts(log.recent("lobby", 100)), [text for seq, text in sent["lobby"]])
+        self.assertEqual(log.recent("quiet", 10), [])
+
+    def test_before_and_after(self):
+        log = self.open()
+        sent = self.fill(log, 40)["lobby"]
+        seqs = [seq for seq, text in sent]
+        self.assertEqual([record[0] for record in log.before("lobby", seqs[10], 4)], seqs[6:10])
+        self.assertEqual([record[0] for record in log.before("lobby", seqs[2], 50)], seqs[:2])
+        self.assertEqual(log.before("lobby", seqs[0], 5), [])
+        # after() keeps the newest `limit` of what was missed
+        self.assertEqual([record[0] for record in log.after("lobby", seqs[10], 3)], seqs[-3:])
+        self.assertEqual([record[0] for record in log.after("lobby", seqs[-4], 50)], seqs[-3:])
+        self.assertEqual(log.after("lobby", seqs[-1], 5), [])
+
+    def test_reads_past_the_ring_come_from_disk(self):
+        log = self.open(ring_size=8, segment_bytes=2000)
+        sent = self.fill(log, 200)
+        self.assertGreater(len(log.segments), 2)
+        self.assertEqual(texts(log.before("dev", sent["dev"][5][0], 5)), [text for seq, text in sent["dev"][:5]])
+        self.assertEqual(texts(log.recent("dev", 100)), [text for seq, text in sent["dev"]])
+
+    def test_recovery_after_reopen(self):
+        log = self.open(segment_bytes=2000)
+        sent = self.fill(log, 200)
+        next_seq = log.next_seq
+        log = self.reopen(log, segment_bytes=2000)
+        self.assertEqual(log.next_seq, next_seq)
+        self.assertEqual(texts(log.recent("lobby", 1000)), [text for seq, text in sent["lobby"]])
+        self.assertEqual(log.append("dev", b"after"), next_seq)
+        self.assertEqual(texts(log.recent("dev", 1)), [b"after"])
+
+    def test_torn_last_record_is_dropped(self):
+        log = self.open()
+        sent = self.fill(log, 10)
+        path = log.segments[-1].log_path
+        size = os.path.getsize(path)
+        log.close()
+        self.logs.remove(log)
+        with open(path, "ab") as torn:
+            torn.write(RECORD_HEADER.pack(11, 0.0, 5, 100) + b"lobby" + b"only part of the")
+
+        log = self.open()
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(log.next_seq, 11)
+        self.assertEqual(texts(log.recent("lobby", 100)), [text for seq, text in sent["lobby"]])
+        self.assertEqual(log.append("lobby", b"next"), 11)
+
+    def test_size_retention(self):
+        log = self.open(segment_bytes=2000, max_bytes=6000)
+        sent = self.fill(log, 500)
+        total = sum(segment.size for segment in log.segments)
+        self.assertLessEqual(total - log.segments[-1].size, 6000)
+        first = log.segments[0].first_seq
+        self.assertGreater(first, 1)
+        kept = [(seq, text) for seq, text in sent["lobby"] if seq >= first]
+        self.assertEqual([(record[0], record[3]) for record in log.recent("lobby", 1000)], kept)
+        self.assertEqual(log.before("lobby", first, 10), [])
+        self.assertEqual(len(os.listdir(self.directory)), 2 * len(log.segments))
+
+        # The index the reopened log rebuilds matches the one that was trimmed
+        log = self.reopen(log, segment_bytes=2000, max_bytes=6000)
+        self.assertEqual([(record[0], record[3]) for record in log.recent("lobby", 1000)], kept)
+
+    def test_age_retention(self):
+        log = self.open(segment_bytes=2000, max_age=0)
+        self.fill(log, 100)
+        # Everything is older than a zero age limit, except the segment being written
+        self.assertEqual(len(log.segments), 1)
+        self.assertEqual(log.before("dev", log.segments[0].first_seq, 10), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_FILE, FRAME_LOGGED, HEADER, FrameDecoder,
+                      ProtocolError, chat_frame, control_frame, encode_frame, file_frame, logged_frame,
+                      split_command, split_file, split_logged)
+
+
+def decoded(frames):
+    """FrameDecoder output with the payload views turned into bytes"""
+    return [(frame_type, stream, bytes(payload)) for frame_type, stream, payload in frames]
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.frames = [chat_frame("[alice]: hi"), control_frame("JOIN dev"), encode_frame(FRAME_CHAT, b""),
+                       file_frame(7, 4096, b"\x00" * 300), logged_frame(42, "[bob]: héllo")]
+        self.expected = [(FRAME_CHAT, 0, b"[alice]: hi"), (FRAME_CONTROL, 0, b"JOIN dev"), (FRAME_CHAT, 0, b""),
+                         (FRAME_FILE, 7, (4096).to_bytes(8, "big") + b"\x00" * 300),
+                         (FRAME_LOGGED, 0, (42).to_bytes(8, "big") + "[bob]: héllo".encode('utf-8'))]
+
+    def test_merged_reads(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoded(decoder.feed(b"".join(self.frames))), self.expected)
+        self.assertEqual(decoder.buffer, b"")
+
+    def test_one_byte_at_a_time(self):
+        decoder = FrameDecoder()
+        frames = []
+        for byte in b"".join(self.frames):
+            frames.extend(decoded(decoder.feed(bytes([byte]))))
+        self.assertEqual(frames, self.expected)
+        self.assertEqual(decoder.buffer, b"")
+
+    def test_every_split_point(self):
+        data = b"".join(self.frames)
+        for split in range(len(data) + 1):
+            decoder = FrameDecoder()
+            frames = decoded(decoder.feed(data[:split])) + decoded(decoder.feed(data[split:]))
+            self.assertEqual(frames, self.expected, f"split at {split}")
+
+    def test_partial_frame_is_kept(self):
+        decoder = FrameDecoder()
+        data = chat_frame("first") + chat_frame("second")
+        self.assertEqual(decoded(decoder.feed(data[:-3])), [(FRAME_CHAT, 0, b"first")])
+        self.assertEqual(decoder.buffer, data[len(chat_frame("first")):-3])
+        self.assertEqual(decoded(decoder.feed(data[-3:])), [(FRAME_CHAT, 0, b"second")])
+
+    def test_payloads_survive_the_next_feed(self):
+        decoder = FrameDecoder()
+        data = chat_frame("kept") + chat_frame("next")
+        (first,) = decoder.feed(data[:-2])
+        decoder.feed(data[-2:])
+        self.assertEqual(bytes(first[2]), b"kept")
+
+    def test_bad_version(self):
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(HEADER.pack(2, FRAME_CHAT, 0, 0))
+
+    def test_unknown_frame_type(self):
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(HEADER.pack(1, 99, 0, 0))
+
+    def test_oversized_frame_is_refused_from_the_header(self):
+        decoder = FrameDecoder(max_frame_size=100)
+        with self.assertRaises(ProtocolError):
+            decoder.feed(HEADER.pack(1, FRAME_CHAT, 0, 101))
+
+
+class PayloadTest(unittest.TestCase):
+    def test_split_command(self):
+        self.assertEqual(split_command(b"  join   dev  "), ("JOIN", "dev"))
+        self.assertEqual(split_command(b"QUIT"), ("QUIT", ""))
+
+    def test_split_command_rejects_bad_utf8(self):
+        with self.assertRaises(ProtocolError):
+            split_command(b"\xff\xfe")
+        self.assertEqual(split_command(b"ERROR caf\xe9", 'replace'), ("ERROR", "caf�"))
+
+    def test_split_logged(self):
+        (frame_type, stream, payload), = FrameDecoder().feed(logged_frame(9, "[a]: x"))
+        seq, text = split_logged(payload)
+        self.assertEqual((seq, bytes(text)), (9, b"[a]: x"))
+        with self.assertRaises(ProtocolError):
+            split_logged(b"short")
+
+    def test_split_file(self):
+        (frame_type, stream, payload), = FrameDecoder().feed(file_frame(3, 65536, b"data"))
+        offset, chunk = split_file(payload)
+        self.assertEqual((stream, offset, bytes(chunk)), (3, 65536, b"data"))
+        with self.assertRaises(ProtocolError):
+            split_file(b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from ratelimit import RateLimiter, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+        for _ in range(3):
+            self.assertEqual(bucket.wait(1, 0.0), 0.0)
+            bucket.take(1)
+        self.assertAlmostEqual(bucket.wait(1, 0.0), 0.5)
+        self.assertAlmostEqual(bucket.wait(1, 0.25), 0.25)
+        self.assertEqual(bucket.wait(1, 0.5), 0.0)
+
+    def test_refill_is_capped_at_the_burst(self):
+        bucket = TokenBucket(rate=10.0, burst=5, now=0.0)
+        bucket.take(5)
+        bucket.refill(100.0)
+        self.assertEqual(bucket.tokens, 5)
+
+    def test_more_than_the_burst_goes_through_once_full(self):
+        bucket = TokenBucket(rate=100.0, burst=1000, now=0.0)
+        self.assertEqual(bucket.wait(5000, 0.0), 0.0)
+        bucket.take(5000)
+        # The debt has to be paid back before the next one
+        self.assertAlmostEqual(bucket.wait(1000, 0.0), 50.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_waits_for_the_fuller_bucket(self):
+        limiter = RateLimiter(10.0, 10, 100.0, 100, now=0.0)
+        self.assertEqual(limiter.wait(100, 0.0), 0.0)
+        limiter.take(100)
+        self.assertAlmostEqual(limiter.wait(50, 0.0), 0.5)   # bytes are the limit
+        self.assertAlmostEqual(limiter.wait(1, 0.0), 0.01)
+        self.assertEqual(limiter.allowed, 1)
+
+    def test_zero_rate_means_no_limit(self):
+        limiter = RateLimiter(0, 0, 0, 0, now=0.0)
+        for _ in range(1000):
+            self.assertEqual(limiter.wait(1 << 20, 0.0), 0.0)
+            limiter.take(1 << 20)
+
+    def test_message_limit_only(self):
+        limiter = RateLimiter(1.0, 3, 0, 0, now=0.0)
+        for _ in range(3):
+            self.assertEqual(limiter.wait(10, 0.0), 0.0)
+            limiter.take(10)
+        self.assertAlmostEqual(limiter.wait(10, 0.0), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
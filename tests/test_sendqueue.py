@@ -0,0 +1,136 @@
+import collections
+import threading
+import unittest
+from unittest import mock
+
+from sendqueue import BLOCK, DISCONNECT, DROP_OLDEST, SendQueue, send_frames
+
+
+class ShortSocket:
+    """Takes at most `budget` bytes per sendmsg() call, as a full kernel buffer would"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.received = bytearray()
+
+    def sendmsg(self, buffers):
+        if not self.budget:
+            raise BlockingIOError
+        data = b"".join(bytes(buffer) for buffer in buffers)[:self.budget]
+        self.received += data
+        return len(data)
+
+
+class SendFramesTest(unittest.TestCase):
+    def test_everything_fits(self):
+        sock = ShortSocket(1 << 20)
+        frames = collections.deque([b"one", b"two", memoryview(b"three")])
+        self.assertEqual(send_frames(sock, frames), (3, 11))
+        self.assertEqual(sock.received, b"onetwothree")
+        self.assertEqual(len(frames), 0)
+
+    def test_partial_write_resumes_mid_frame(self):
+        sock = ShortSocket(5)
+        frames = collections.deque([b"abc", b"defgh", b"ij"])
+        self.assertEqual(send_frames(sock, frames), (1, 5))
+        self.assertEqual(bytes(frames[0]), b"fgh")
+        self.assertIsInstance(frames[0], memoryview)
+        self.assertEqual(send_frames(sock, frames), (2, 5))
+        self.assertEqual(sock.received, b"abcdefghij")
+        self.assertEqual(len(frames), 0)
+
+    def test_write_ending_on_a_frame_boundary(self):
+        sock = ShortSocket(3)
+        frames = collections.deque([b"abc", b"def"])
+        self.assertEqual(send_frames(sock, frames), (1, 3))
+        self.assertEqual(list(frames), [b"def"])
+
+    def test_nothing_written_raises(self):
+        frames = collections.deque([b"abc"])
+        with self.assertRaises(BlockingIOError):
+            send_frames(ShortSocket(0), frames)
+        self.assertEqual(list(frames), [b"abc"])
+
+    def test_buffer_filling_up_after_some_progress(self):
+        class FillingSocket(ShortSocket):
+            def sendmsg(self, buffers):
+                sent = super().sendmsg(buffers)
+                self.budget = 0
+                return sent
+
+        sock = FillingSocket(1 << 20)
+        frames = collections.deque([b"x" * 10] * 3)
+        # Two frames per call: the first batch goes out whole, the second would block
+        with mock.patch("sendqueue.IOV_MAX", 2):
+            self.assertEqual(send_frames(sock, frames), (2, 20))
+        self.assertEqual(list(frames), [b"x" * 10])
+
+
+class SendQueueTest(unittest.TestCase):
+    def test_drop_oldest(self):
+        queue = SendQueue(maxsize=2, policy=DROP_OLDEST)
+        for frame in (b"1", b"2", b"3"):
+            self.assertTrue(queue.put(frame))
+        self.assertEqual(queue.take(), [b"2", b"3"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_disconnect(self):
+        queue = SendQueue(maxsize=1, policy=DISCONNECT)
+        self.assertTrue(queue.put(b"1"))
+        self.assertFalse(queue.put(b"2"))
+
+    def test_nonblocking_block_policy_overflows_until_the_timeout(self):
+        queue = SendQueue(maxsize=1, policy=BLOCK, block_timeout=60.0, blocking=False)
+        self.assertTrue(queue.put(b"1"))
+        self.assertTrue(queue.put(b"2"))
+        self.assertEqual(queue.take(block=False), [b"1", b"2"])
+
+        queue = SendQueue(maxsize=1, policy=BLOCK, block_timeout=0.0, blocking=False)
+        self.assertTrue(queue.put(b"1"))
+        self.assertFalse(queue.put(b"2"))
+
+    def test_blocking_block_policy_gives_up(self):
+        queue = SendQueue(maxsize=1, policy=BLOCK, block_timeout=0.01)
+        self.assertTrue(queue.put(b"1"))
+        self.assertFalse(queue.put(b"2"))
+
+    def test_blocking_block_policy_waits_for_the_writer(self):
+        queue = SendQueue(maxsize=1, policy=BLOCK, block_timeout=5.0)
+        queue.put(b"1")
+        writer = threading.Timer(0.05, queue.take)
+        writer.start()
+        self.assertTrue(queue.put(b"2"))
+        writer.join()
+        self.assertEqual(queue.take(block=False), [b"2"])
+
+    def test_take_wakes_on_put(self):
+        queue = SendQueue()
+        threading.Timer(0.05, queue.put, args=(b"late",)).start()
+        self.assertEqual(queue.take(), [b"late"])
+
+    def test_bulk_lane_waits_behind_chat(self):
+        queue = SendQueue(bulk_maxsize=2)
+        self.assertTrue(queue.put_bulk(b"chunk1"))
+        self.assertTrue(queue.put_bulk(b"chunk2"))
+        self.assertTrue(queue.bulk_full())
+        self.assertFalse(queue.put_bulk(b"chunk3"))
+        self.assertTrue(queue.put_bulk(b"cancel", force=True))
+        queue.put(b"chat")
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.take(), [b"chat"])
+        self.assertEqual(queue.take(), [b"chunk1"])
+        self.assertEqual(queue.take(), [b"chunk2"])
+        self.assertEqual(queue.take(), [b"cancel"])
+        self.assertEqual(queue.take(block=False), [])
+
+    def test_close(self):
+        queue = SendQueue()
+        queue.put(b"1")
+        queue.close()
+        self.assertFalse(queue.put(b"2"))
+        self.assertFalse(queue.put_bulk(b"3"))
+        self.assertEqual(queue.take(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,383 @@
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from protocol import (FRAME_CHAT, FRAME_CONTROL, FRAME_LOGGED, FRAME_PRESENCE, FrameDecoder, chat_frame,
+                      control_frame, split_logged)
+
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+TIMEOUT = 5.0
+
+Frame = collections.namedtuple("Frame", "type text seq")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Connection:
+    """One client connection speaking the wire protocol, frame by frame"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=TIMEOUT)
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()
+        self.token = None
+
+    def close(self):
+        self.sock.close()
+
+    def control(self, text):
+        self.sock.sendall(control_frame(text))
+
+    def say(self, text):
+        self.sock.sendall(chat_frame(text))
+
+    def receive(self, timeout=TIMEOUT):
+        """The next frame, or None once the server has hung up"""
+        deadline = time.monotonic() + timeout
+        while not self.frames:
+            self.sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            for frame_type, stream, payload in self.decoder.feed(data):
+                seq = None
+                if frame_type == FRAME_LOGGED:
+                    seq, payload = split_logged(payload)
+                self.frames.append(Frame(frame_type, bytes(payload).decode('utf-8'), seq))
+        return self.frames.popleft()
+
+    def expect(self, match, what):
+        """Skip frames until one matches, and return it"""
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                frame = self.receive(deadline - time.monotonic())
+            except socket.timeout:
+                raise AssertionError(f"timed out waiting for {what}") from None
+            if frame is None:
+                raise AssertionError(f"disconnected while waiting for {what}")
+            if match(frame):
+                return frame
+
+    def expect_control(self, prefix):
+        return self.expect(lambda frame: frame.type == FRAME_CONTROL and frame.text.startswith(prefix), prefix).text
+
+    def expect_chat(self):
+        return self.expect(lambda frame: frame.type in (FRAME_CHAT, FRAME_LOGGED), "a chat line")
+
+    def expect_presence(self, key):
+        """The next presence update with something under key: "roster" for a snapshot, "joined" or "left" for a delta"""
+        frame = self.expect(lambda frame: frame.type == FRAME_PRESENCE and json.loads(frame.text).get(key),
+                            f"presence with {key}")
+        return json.loads(frame.text)
+
+    def pending(self, wait=0.3):
+        """Every frame that arrives within wait seconds"""
+        frames = []
+        try:
+            while True:
+                frame = self.receive(wait)
+                if frame is None:
+                    break
+                frames.append(frame)
+        except socket.timeout:
+            pass
+        return frames
+
+    def expect_closed(self):
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                if self.receive(deadline - time.monotonic()) is None:
+                    return
+            except ConnectionResetError:
+                return
+            except socket.timeout:
+                raise AssertionError("the server kept the connection open") from None
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs server.py on a free port for each test and talks to it over real sockets"""
+
+    ENGINE = "eventloop"
+    PRESENCE_INTERVAL = 0.05
+    ARGS = ()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.port = free_port()
+        self.server = subprocess.Popen(
+            [sys.executable, SERVER, "--host", "127.0.0.1", "--port", str(self.port), "--engine", self.ENGINE,
+             "--history-dir", os.path.join(self.tmp.name, "history"), "--presence-interval", str(self.PRESENCE_INTERVAL),
+             *self.ARGS],
+            cwd=self.tmp.name, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.connections = []
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=TIMEOUT).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline or self.server.poll() is not None:
+                    self.tearDown()
+                    self.fail("the server didn't start")
+                time.sleep(0.05)
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.server.terminate()
+        self.server.wait(TIMEOUT)
+        self.tmp.cleanup()
+
+    def connect(self):
+        connection = Connection(self.port)
+        self.connections.append(connection)
+        connection.expect_control("USERNAME")
+        return connection
+
+    def login(self, username):
+        """Connect as username and wait for the lobby's roster, so the test starts from a quiet connection"""
+        connection = self.connect()
+        connection.control(f"USERNAME {username}")
+        connection.token = connection.expect_control("SESSION ").split(" ", 1)[1]
+        self.assertEqual(connection.expect_control("ROOM "), "ROOM lobby")
+        connection.expect_presence("roster")
+        return connection
+
+    def join(self, connection, room):
+        connection.control(f"JOIN {room}")
+        self.assertEqual(connection.expect_control("ROOM "), f"ROOM {room}")
+        return connection.expect_presence("roster")
+
+
+class RoomsTest(ServerTestCase):
+    def test_chat_stays_in_its_room(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        carol, dave = self.login("carol"), self.login("dave")
+        self.join(carol, "dev")
+        self.join(dave, "dev")
+
+        alice.say("[alice]: hi lobby")
+        self.assertEqual(bob.expect_chat().text, "[alice]: hi lobby")
+        carol.say("[carol]: hi dev")
+        self.assertEqual(dave.expect_chat().text, "[carol]: hi dev")
+        alice.say("[alice]: still the lobby")
+        # carol's line was fanned out before this one, and never reached the lobby
+        self.assertEqual(bob.expect_chat().text, "[alice]: still the lobby")
+        self.assertEqual([frame for frame in dave.pending() if frame.type in (FRAME_CHAT, FRAME_LOGGED)], [])
+
+    def test_senders_get_no_echo(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        alice.say("[alice]: one")
+        self.assertEqual(bob.expect_chat().text, "[alice]: one")
+        bob.say("[bob]: two")
+        self.assertEqual(alice.expect_chat().text, "[bob]: two")
+
+    def test_leave_goes_back_to_the_lobby(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        self.join(alice, "dev")
+        alice.control("LEAVE")
+        self.assertEqual(alice.expect_control("ROOM "), "ROOM lobby")
+        alice.say("[alice]: back")
+        self.assertEqual(bob.expect_chat().text, "[alice]: back")
+
+    def test_bad_room_names_are_refused(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        for room in ("two words", "x" * 33):
+            alice.control(f"JOIN {room}")
+            self.assertTrue(alice.expect_control("ERROR ").startswith("ERROR Room names"))
+        alice.say("[alice]: still here")
+        self.assertEqual(bob.expect_chat().text, "[alice]: still here")
+
+
+class ThreadedRoomsTest(RoomsTest):
+    ENGINE = "threaded"
+
+
+class PresenceTest(ServerTestCase):
+    def test_joiners_get_a_roster_and_members_a_delta(self):
+        alice = self.login("alice")
+        bob = self.connect()
+        bob.control("USERNAME bob")
+        self.assertEqual(bob.expect_presence("roster"), {"room": "lobby", "count": 2, "roster": ["alice", "bob"]})
+        self.assertEqual(alice.expect_presence("joined"), {"room": "lobby", "count": 2, "joined": ["bob"], "left": []})
+        # bob's roster already counted him; no delta about himself follows it
+        self.assertEqual([frame for frame in bob.pending() if frame.type == FRAME_PRESENCE], [])
+
+    def test_moving_rooms(self):
+        alice, bob, carol = self.login("alice"), self.login("bob"), self.login("carol")
+        self.join(carol, "dev")
+        self.assertEqual(alice.expect_presence("left"), {"room": "lobby", "count": 2, "joined": [], "left": ["carol"]})
+
+        self.assertEqual(self.join(bob, "dev"), {"room": "dev", "count": 2, "roster": ["bob", "carol"]})
+        self.assertEqual(carol.expect_presence("joined"), {"room": "dev", "count": 2, "joined": ["bob"], "left": []})
+        self.assertEqual(alice.expect_presence("left")["left"], ["bob"])
+
+    def test_quit_is_announced(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        alice.expect_presence("joined")
+        bob.control("QUIT")
+        bob.expect_closed()
+        self.assertEqual(alice.expect_presence("left"), {"room": "lobby", "count": 1, "joined": [], "left": ["bob"]})
+
+    def test_roster_on_request(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        self.join(bob, "dev")
+        alice.control("ROSTER")
+        self.assertEqual(alice.expect_presence("roster"), {"room": "lobby", "count": 1, "roster": ["alice"]})
+
+
+class CoalescedPresenceTest(ServerTestCase):
+    PRESENCE_INTERVAL = 0.5
+
+    def test_joins_within_a_tick_share_one_update(self):
+        alice = self.login("alice")
+        for name in ("bob", "carol", "dave"):
+            self.connect().control(f"USERNAME {name}")
+        updates = [alice.expect_presence("joined")]
+        while sum(len(update["joined"]) for update in updates) < 3:
+            updates.append(alice.expect_presence("joined"))
+        self.assertEqual(sorted(name for update in updates for name in update["joined"]), ["bob", "carol", "dave"])
+        self.assertEqual(updates[-1]["count"], 4)
+        # Three joins a few milliseconds apart can straddle at most one tick
+        self.assertLessEqual(len(updates), 2)
+
+
+class ThreadedPresenceTest(PresenceTest):
+    ENGINE = "threaded"
+
+
+class ThreadedCoalescedPresenceTest(CoalescedPresenceTest):
+    ENGINE = "threaded"
+
+
+class ResumeTest(ServerTestCase):
+    def resume(self, token, last_seq=None):
+        connection = self.connect()
+        connection.control(f"RESUME {token}" if last_seq is None else f"RESUME {token} {last_seq}")
+        return connection
+
+    def test_a_dropped_user_gets_only_what_it_missed(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        alice.expect_presence("joined")
+        alice.say("[alice]: one")
+        seen = bob.expect_chat()
+        bob.close()
+        alice.say("[alice]: two")
+        alice.say("[alice]: three")
+
+        bob = self.resume(bob.token, seen.seq)
+        self.assertEqual(bob.expect_control("SESSION "), f"SESSION {self.connections[1].token}")
+        self.assertEqual(bob.expect_control("ROOM "), "ROOM lobby")
+        # The roster comes with the next presence tick, which may beat the replay
+        frames = bob.pending()
+        self.assertEqual([frame.text for frame in frames if frame.type == FRAME_LOGGED], ["[alice]: two", "[alice]: three"])
+        self.assertEqual([json.loads(frame.text)["roster"] for frame in frames if frame.type == FRAME_PRESENCE],
+                         [["alice", "bob"]])
+        # The session was held all along, so the lobby never saw bob leave or come back
+        self.assertEqual([frame for frame in alice.pending() if frame.type == FRAME_PRESENCE], [])
+        bob.say("[bob]: back")
+        self.assertEqual(alice.expect_chat().text, "[bob]: back")
+
+    def test_the_name_is_held_while_parked(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        bob.close()
+        other = self.connect()
+        other.control("USERNAME Bob")
+        self.assertEqual(other.expect_control("USERNAME_TAKEN"), "USERNAME_TAKEN Bob")
+        alice.control("ROSTER")
+        self.assertEqual(alice.expect_presence("roster")["roster"], ["alice", "bob"])
+
+    def test_resume_takes_over_a_live_connection(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        alice.expect_presence("joined")
+        second = self.resume(bob.token)
+        self.assertEqual(second.expect_control("SESSION "), f"SESSION {bob.token}")
+        bob.expect_closed()
+        second.say("[bob]: moved")
+        self.assertEqual(alice.expect_chat().text, "[bob]: moved")
+        self.assertEqual([frame for frame in alice.pending() if frame.type == FRAME_PRESENCE], [])
+
+    def test_unknown_token_falls_back_to_a_username(self):
+        connection = self.resume("no-such-token", 5)
+        connection.expect_control("USERNAME")
+        connection.control("USERNAME carol")
+        connection.expect_control("SESSION ")
+        self.assertEqual(connection.expect_control("ROOM "), "ROOM lobby")
+
+    def test_quit_ends_the_session(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        bob.control("QUIT")
+        bob.expect_closed()
+        self.assertEqual(alice.expect_presence("left")["left"], ["bob"])
+        self.resume(bob.token).expect_control("USERNAME")
+        self.login("bob")
+
+
+class SessionExpiryTest(ServerTestCase):
+    ARGS = ("--session-grace", "0.3")
+
+    def test_parked_session_expires(self):
+        alice, bob = self.login("alice"), self.login("bob")
+        bob.close()
+        self.assertEqual(alice.expect_presence("left"), {"room": "lobby", "count": 1, "joined": [], "left": ["bob"]})
+        connection = self.connect()
+        connection.control(f"RESUME {bob.token}")
+        connection.expect_control("USERNAME")
+
+
+class ThreadedResumeTest(ResumeTest):
+    ENGINE = "threaded"
+
+
+class ThreadedSessionExpiryTest(SessionExpiryTest):
+    ENGINE = "threaded"
+
+
+class UsernameTest(ServerTestCase):
+    def refused(self, username):
+        connection = self.connect()
+        connection.control(f"USERNAME {username}")
+        reply = connection.expect_control("")
+        connection.expect_closed()
+        return reply
+
+    def test_names_are_unique_ignoring_case(self):
+        self.login("Ben")
+        self.assertEqual(self.refused("ben"), "USERNAME_TAKEN ben")
+
+    def test_bad_names_are_refused(self):
+        for username in ("", "two\twords", "bell\x07", "x" * 21):
+            self.assertTrue(self.refused(username).startswith("ERROR Usernames"), repr(username))
+        self.login("x" * 20)
+        self.login("zoë")
+
+    def test_direct_messages_find_the_user_by_name(self):
+        alice, bob, carol = self.login("alice"), self.login("Bob"), self.login("carol")
+        self.join(carol, "dev")
+        alice.control("MSG bob psst")
+        self.assertEqual(bob.expect_control("MSG "), "MSG alice psst")
+        alice.control("MSG carol in another room")
+        self.assertEqual(carol.expect_control("MSG "), "MSG alice in another room")
+        alice.control("MSG nobody hello")
+        self.assertEqual(alice.expect_control("ERROR "), "ERROR There is nobody called nobody here")
+
+
+class ThreadedUsernameTest(UsernameTest):
+    ENGINE = "threaded"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from sessions import SessionRegistry
+
+
+class SessionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = SessionRegistry()
+
+    def test_open_indexes_every_way(self):
+        session = self.registry.open("Alice", "conn1")
+        self.assertIs(self.registry.get(session.token), session)
+        self.assertIs(self.registry.of("conn1"), session)
+        self.assertIs(self.registry.find("alice"), session)
+        self.assertIs(self.registry.find("ALICE"), session)
+        self.assertEqual(self.registry.username("conn1"), "Alice")
+        self.assertEqual(self.registry.username("conn2"), "Unknown")
+        self.assertEqual(len(self.registry), 1)
+
+    def test_names_are_unique_ignoring_case(self):
+        self.assertIsNotNone(self.registry.open("Ben", "conn1"))
+        self.assertIsNone(self.registry.open("ben", "conn2"))
+        self.assertIsNone(self.registry.open("BEN", "conn2"))
+        self.assertIsNone(self.registry.of("conn2"))
+        self.assertEqual(len(self.registry), 1)
+
+    def test_tokens_differ(self):
+        first = self.registry.open("a", "conn1")
+        second = self.registry.open("b", "conn2")
+        self.assertNotEqual(first.token, second.token)
+
+    def test_parked_session_keeps_its_name(self):
+        session = self.registry.open("carol", "conn1")
+        self.assertIs(self.registry.detach("conn1"), session)
+        self.assertIsNone(session.client)
+        self.assertIsNone(self.registry.of("conn1"))
+        self.assertEqual(len(self.registry), 0)
+        self.assertIs(self.registry.get(session.token), session)
+        self.assertIsNone(self.registry.open("Carol", "conn2"))
+        self.assertIsNone(self.registry.detach("conn1"))
+
+    def test_attach_moves_a_session_to_a_new_connection(self):
+        session = self.registry.open("dave", "conn1")
+        session.expires = 123.0
+        self.assertEqual(self.registry.attach(session, "conn2"), "conn1")
+        self.assertIsNone(self.registry.of("conn1"))
+        self.assertIs(self.registry.of("conn2"), session)
+        self.assertIsNone(session.expires)
+        self.assertEqual(len(self.registry), 1)
+
+        self.registry.detach("conn2")
+        self.assertIsNone(self.registry.attach(session, "conn3"))
+        self.assertIs(self.registry.of("conn3"), session)
+
+    def test_close_frees_the_token_and_the_name(self):
+        session = self.registry.open("erin", "conn1")
+        self.registry.close(session)
+        self.assertIsNone(self.registry.get(session.token))
+        self.assertIsNone(self.registry.of("conn1"))
+        self.assertIsNone(self.registry.find("erin"))
+        self.assertIsNotNone(self.registry.open("Erin", "conn2"))
+
+    def test_closing_a_stale_session_leaves_its_successor(self):
+        old = self.registry.open("frank", "conn1")
+        self.registry.close(old)
+        new = self.registry.open("frank", "conn2")
+        self.registry.close(old)
+        self.assertIs(self.registry.find("frank"), new)
+        self.assertIs(self.registry.of("conn2"), new)
+
+    def test_add_keeps_a_handed_over_token(self):
+        session = self.registry.add("handed-over", "gina")
+        self.assertIs(self.registry.get("handed-over"), session)
+        self.assertIsNone(session.client)
+        self.assertEqual(len(self.registry), 0)
+        self.registry.attach(session, "conn1")
+        self.assertIs(self.registry.of("conn1"), session)
+
+
+if __name__ == "__main__":
+    unittest.main()
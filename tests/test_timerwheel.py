@@ -0,0 +1,64 @@
+import unittest
+
+from timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_fires_at_its_deadline(self):
+        wheel = TimerWheel(tick=0.5, slots=16, now=0.0)
+        wheel.schedule("a", 2.2)
+        self.assertEqual(wheel.advance(2.0), [])
+        self.assertEqual(wheel.advance(2.1), [])
+        self.assertEqual(wheel.advance(2.2), [("a", 2.2)])
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(wheel.advance(10.0), [])
+
+    def test_reschedule_moves_the_deadline(self):
+        wheel = TimerWheel(tick=0.5, slots=16, now=0.0)
+        wheel.schedule("a", 1.0)
+        wheel.schedule("a", 3.0)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(2.0), [])
+        self.assertEqual(wheel.advance(3.0), [("a", 3.0)])
+
+    def test_cancel(self):
+        wheel = TimerWheel(tick=0.5, slots=16, now=0.0)
+        wheel.schedule("a", 1.0)
+        wheel.schedule("b", 1.0)
+        wheel.cancel("a")
+        wheel.cancel("missing")
+        self.assertNotIn("a", wheel)
+        self.assertEqual(wheel.advance(1.0), [("b", 1.0)])
+
+    def test_deadline_past_one_revolution(self):
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule("far", 20.0)  # shares a slot with ticks 4 and 12
+        for now in range(20):
+            self.assertEqual(wheel.advance(float(now)), [], f"fired early at {now}")
+        self.assertEqual(wheel.advance(20.0), [("far", 20.0)])
+
+    def test_deadline_already_passed_fires_next_advance(self):
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.advance(5.0)
+        wheel.schedule("late", 1.0)
+        self.assertEqual(wheel.advance(5.0), [("late", 1.0)])
+
+    def test_long_stall_returns_everything_due(self):
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        for key in range(50):
+            wheel.schedule(key, key + 0.5)
+        due = wheel.advance(1000.0)
+        self.assertEqual(sorted(key for key, deadline in due), list(range(50)))
+        self.assertEqual(len(wheel), 0)
+
+    def test_next_timeout(self):
+        wheel = TimerWheel(tick=0.5, slots=16, now=0.0)
+        self.assertIsNone(wheel.next_timeout(0.0))
+        wheel.schedule("a", 10.0)
+        self.assertAlmostEqual(wheel.next_timeout(0.2), 0.3)
+        wheel.advance(3.1)
+        self.assertAlmostEqual(wheel.next_timeout(3.1), 0.4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Hashed timer wheel for per-connection deadlines.
+
+Deadlines are hashed into a fixed ring of slots by the tick they fall in,
+so scheduling, rescheduling and cancelling are O(1) dict operations and
+each tick only looks at the one slot it lands on, no matter how many
+connections are being tracked. A deadline more than one revolution away
+simply stays in its slot until a later pass over it finds it due.
+
+Every key has at most one deadline; scheduling it again moves it.
+
+    wheel = TimerWheel(tick=0.5)
+    wheel.schedule(sock, time.monotonic() + 60)
+    for sock, deadline in wheel.advance(time.monotonic()):
+        ...
+"""
+
+import threading
+
+
+class TimerWheel:
+    def __init__(self, tick=0.5, slots=512, now=0.0):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # slot -> {key: deadline}
+        self.slot_of = {}                         # key -> slot index it is in
+        self.current = int(now / tick)            # next tick advance() has to look at
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, key):
+        return key in self.slot_of
+
+    def schedule(self, key, deadline):
+        """Set (or move) key's deadline, a time.monotonic() value"""
+        # Never hash into a tick that has already been passed over
+        index = max(int(deadline / self.tick), self.current) % len(self.slots)
+        with self.lock:
+            old = self.slot_of.get(key)
+            if old is not None:
+                del self.slots[old][key]
+            self.slots[index][key] = deadline
+            self.slot_of[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            index = self.slot_of.pop(key, None)
+            if index is not None:
+                del self.slots[index][key]
+
+    def advance(self, now):
+        """Remove and return (key, deadline) for every deadline at or before now"""
+        due = []
+        with self.lock:
+            last = int(now / self.tick)
+            # After a long stall, one pass over every slot is enough
+            first = max(self.current, last - len(self.slots) + 1)
+            for tick in range(first, last + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for key, deadline in list(slot.items()):
+                    if deadline <= now:
+                        del slot[key]
+                        del self.slot_of[key]
+                        due.append((key, deadline))
+            self.current = last
+        return due
+
+    def next_timeout(self, now):
+        """Seconds until the next tick worth waking up for, or None with no timers"""
+        if not self.slot_of:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - now)